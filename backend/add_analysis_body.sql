@@ -0,0 +1,15 @@
+-- Сокращенный текст писем для модели (без цитат, подписей и дисклеймеров) и оценка токенов
+-- Дата: 2026-10-17
+
+ALTER TABLE letters
+ADD COLUMN IF NOT EXISTS analysis_body TEXT,
+ADD COLUMN IF NOT EXISTS body_tokens INTEGER,
+ADD COLUMN IF NOT EXISTS analysis_body_tokens INTEGER;
+
+-- Существующие письма не заполняются: для них (body_tokens IS NULL)
+-- сокращенный текст вычисляется при анализе, в отчет об экономии они не входят
+
+-- Комментарии
+COMMENT ON COLUMN letters.analysis_body IS 'Текст для модели без цитат, подписей и дисклеймеров; NULL — совпадает с body';
+COMMENT ON COLUMN letters.body_tokens IS 'Оценка токенов исходного текста письма';
+COMMENT ON COLUMN letters.analysis_body_tokens IS 'Оценка токенов текста, передаваемого модели';
@@ -0,0 +1,7 @@
+-- Повтор анализа письма, изменившегося во время выполнения задачи
+-- Дата: 2026-10-17
+
+ALTER TABLE analysis_jobs
+ADD COLUMN IF NOT EXISTS rerun_requested BOOLEAN DEFAULT FALSE NOT NULL;
+
+COMMENT ON COLUMN analysis_jobs.rerun_requested IS 'Письмо изменилось (например, извлечен текст вложений) во время анализа: после завершения задача ставится снова';
@@ -0,0 +1,7 @@
+-- Захват элементов пакетного анализа без удержания транзакции на время запросов к API
+-- Дата: 2026-10-17
+
+ALTER TABLE batch_analysis_items
+ADD COLUMN IF NOT EXISTS locked_at TIMESTAMP WITH TIME ZONE;
+
+COMMENT ON COLUMN batch_analysis_items.locked_at IS 'Элемент захвачен обработчиком на время отправки или опроса операции';
@@ -0,0 +1,9 @@
+-- Короткий захват анализа письма вместо advisory lock на все время запроса к модели
+-- Дата: 2026-10-17
+
+ALTER TABLE letters
+ADD COLUMN IF NOT EXISTS analysis_claimed_until TIMESTAMP WITH TIME ZONE,
+ADD COLUMN IF NOT EXISTS analysis_claimed_by VARCHAR(64);
+
+COMMENT ON COLUMN letters.analysis_claimed_until IS 'Анализ письма выполняется в одной из реплик до этого момента (продлевается, пока анализ идет)';
+COMMENT ON COLUMN letters.analysis_claimed_by IS 'Идентификатор вызова, захватившего анализ';
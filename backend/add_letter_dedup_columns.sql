@@ -0,0 +1,28 @@
+-- Message-ID и хэш содержимого писем для поиска дубликатов по индексу
+-- Дата: 2026-10-17
+
+ALTER TABLE letters
+ADD COLUMN IF NOT EXISTS message_id VARCHAR(998),
+ADD COLUMN IF NOT EXISTS content_hash VARCHAR(64);
+
+-- Заполнение хэша для существующих писем.
+-- Нормализация совпадает с LetterService.content_hash:
+-- адрес в нижнем регистре, CRLF -> LF, без пробелов и переводов строк по краям
+UPDATE letters
+SET content_hash = encode(sha256(convert_to(
+        lower(btrim(coalesce(sender_email, ''), E' \t\r\n')) || E'\n' ||
+        btrim(coalesce(subject, ''), E' \t\r\n') || E'\n' ||
+        btrim(replace(coalesce(body, ''), E'\r\n', E'\n'), E' \t\r\n'),
+        'UTF8'
+    )), 'hex')
+WHERE content_hash IS NULL;
+
+-- Хэш не уникален: письма, созданные через API, и старые записи могут совпадать
+CREATE INDEX IF NOT EXISTS ix_letters_content_hash ON letters(content_hash);
+
+-- Для существующих писем Message-ID неизвестен (исходные сообщения не сохранялись)
+CREATE UNIQUE INDEX IF NOT EXISTS uq_letters_message_id
+    ON letters(message_id) WHERE message_id IS NOT NULL;
+
+COMMENT ON COLUMN letters.message_id IS 'Заголовок Message-ID письма из почты';
+COMMENT ON COLUMN letters.content_hash IS 'sha256 нормализованных отправителя, темы и текста письма';
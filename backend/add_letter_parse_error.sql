@@ -0,0 +1,7 @@
+-- Письма из почты, которые не удалось разобрать, сохраняются заглушкой
+-- Дата: 2026-10-17
+
+ALTER TABLE letters
+ADD COLUMN IF NOT EXISTS parse_error TEXT;
+
+COMMENT ON COLUMN letters.parse_error IS 'Причина ошибки разбора письма; body содержит заглушку, исходное письмо остается в почтовом ящике';
@@ -0,0 +1,16 @@
+-- Заголовки переписки (In-Reply-To, References) и привязка писем к переписке
+-- Дата: 2026-10-17
+
+ALTER TABLE letters
+ADD COLUMN IF NOT EXISTS in_reply_to VARCHAR(998),
+ADD COLUMN IF NOT EXISTS thread_references TEXT,
+ADD COLUMN IF NOT EXISTS thread_id INTEGER;
+
+-- Поиск ответов, полученных раньше исходного письма, и писем переписки
+CREATE INDEX IF NOT EXISTS ix_letters_in_reply_to ON letters(in_reply_to);
+CREATE INDEX IF NOT EXISTS ix_letters_thread_id ON letters(thread_id);
+
+-- Комментарии
+COMMENT ON COLUMN letters.in_reply_to IS 'Message-ID письма, на которое это письмо отвечает';
+COMMENT ON COLUMN letters.thread_references IS 'Заголовок References: Message-ID цепочки через пробел';
+COMMENT ON COLUMN letters.thread_id IS 'id первого письма переписки; NULL у первого письма и писем вне переписки';
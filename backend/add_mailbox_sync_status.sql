@@ -0,0 +1,11 @@
+-- Состояние синхронизации почтовых папок для отставания в /api/mail/status
+-- Дата: 2026-10-17
+
+ALTER TABLE mailbox_sync_state
+ADD COLUMN IF NOT EXISTS pending INTEGER DEFAULT 0 NOT NULL,
+ADD COLUMN IF NOT EXISTS last_sync_at TIMESTAMP WITH TIME ZONE,
+ADD COLUMN IF NOT EXISTS caught_up_at TIMESTAMP WITH TIME ZONE,
+ADD COLUMN IF NOT EXISTS last_error TEXT;
+
+COMMENT ON COLUMN mailbox_sync_state.pending IS 'Писем, не обработанных после последней синхронизации';
+COMMENT ON COLUMN mailbox_sync_state.caught_up_at IS 'Когда папка последний раз была разобрана полностью';
@@ -0,0 +1,10 @@
+-- Добавление флага повторного анализа (анализ выполнен по шаблону при недоступности Yandex GPT)
+-- Дата: 2026-10-16
+
+ALTER TABLE letters 
+ADD COLUMN IF NOT EXISTS needs_reanalysis BOOLEAN DEFAULT FALSE NOT NULL;
+
+-- Частичный индекс: отложенных писем обычно немного
+CREATE INDEX IF NOT EXISTS idx_letters_needs_reanalysis ON letters(needs_reanalysis) WHERE needs_reanalysis;
+
+COMMENT ON COLUMN letters.needs_reanalysis IS 'Анализ выполнен по шаблону из-за недоступности Yandex GPT, требуется повтор';
@@ -1,8 +1,9 @@
-from fastapi import APIRouter, Depends, HTTPException, status, BackgroundTasks
+from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi.responses import StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
 from sqlalchemy.orm import Session
 from typing import List, Optional
-from datetime import timedelta
+from datetime import datetime, timedelta
 from app.database import get_db
 from app.schemas import (
     LetterCreate, LetterResponse, LetterUpdate, 
@@ -11,16 +12,26 @@ from app.schemas import (
     NotificationResponse, NotificationUpdate, UnreadCountResponse
 )
 from app.services.letter_service import letter_service
-from app.services.mail_service import mail_service
+from app.services.mail_service import mail_service, mailboxes, mailbox_statuses
 from app.services.analytics_service import analytics_service
 from app.services import notification_service
-from app.models import LetterStatus, User
+from app.services.yandex_gpt import yandex_gpt_service
+from app.services.llm_cache import llm_cache
+from app.services.knowledge_base import knowledge_base_store
+from app.services.llm_limiter import llm_limiter
+from app.services.llm_circuit_breaker import llm_circuit_breaker
+from app.services.single_flight import letter_single_flight
+from app.services.batch_analysis import batch_analysis_service
+from app.services.analysis_queue import analysis_queue
+from app.services.reanalysis_service import reanalysis_service
+from app.models import LetterStatus, LetterType, ReanalysisRun, User
 from app.auth import (
     get_password_hash, authenticate_user, create_access_token,
     get_current_active_user, require_admin, require_operator,
     require_approver, ACCESS_TOKEN_EXPIRE_MINUTES
 )
 from pydantic import BaseModel
+import json
 
 
 router = APIRouter(prefix="/api/letters", tags=["letters"])
@@ -29,6 +40,7 @@ user_router = APIRouter(prefix="/api/users", tags=["users"])
 auth_router = APIRouter(prefix="/api/auth", tags=["auth"])
 analytics_router = APIRouter(prefix="/api/analytics", tags=["analytics"])
 notification_router = APIRouter(prefix="/api/notifications", tags=["notifications"])
+llm_router = APIRouter(prefix="/api/llm", tags=["llm"])
 
 
 # Auth endpoints
@@ -192,15 +204,12 @@ def delete_user(
 def create_letter(
     letter: LetterCreate,
     db: Session = Depends(get_db),
-    current_user: User = Depends(require_operator),
-    background_tasks: BackgroundTasks = None
+    current_user: User = Depends(require_operator)
 ):
     """Создание нового письма (операторы и админы)"""
     new_letter = letter_service.create_letter(db, letter)
-    # Запуск асинхронного анализа письма сразу после создания
-    if background_tasks is not None:
-        # Передаем id письма и сессию БД
-        background_tasks.add_task(letter_service.run_analysis_sync, db, new_letter.id)
+    # Анализ выполняют обработчики очереди analysis_jobs
+    analysis_queue.enqueue(db, new_letter.id)
     return new_letter
 
 
@@ -256,6 +265,19 @@ def get_letter(
     return letter
 
 
+@router.get("/{letter_id}/thread", response_model=List[LetterResponse])
+def get_letter_thread(
+    letter_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(get_current_active_user)
+):
+    """Переписка, к которой относится письмо (по Message-ID / In-Reply-To)"""
+    letter = letter_service.get_letter(db, letter_id)
+    if not letter:
+        raise HTTPException(status_code=404, detail="Letter not found")
+    return letter_service.get_thread(db, letter)
+
+
 @router.post("/{letter_id}/analyze", response_model=LetterResponse)
 async def analyze_letter(
     letter_id: int, 
@@ -269,6 +291,32 @@ async def analyze_letter(
         raise HTTPException(status_code=404, detail=str(e))
 
 
+@router.get("/{letter_id}/drafts/stream")
+async def stream_drafts(
+    letter_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_operator)
+):
+    """Потоковая генерация черновиков (Server-Sent Events, операторы и админы)"""
+    letter = letter_service.get_letter(db, letter_id)
+    if not letter:
+        raise HTTPException(status_code=404, detail="Letter not found")
+    if not letter.classification_data:
+        raise HTTPException(status_code=409, detail="Письмо еще не проанализировано")
+    
+    async def event_stream():
+        async for event in letter_service.stream_drafts(letter_id):
+            name = event.pop("event")
+            yield f"event: {name}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n"
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        # X-Accel-Buffering отключает буферизацию в nginx фронтенда
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
 @router.patch("/{letter_id}", response_model=LetterResponse)
 def update_letter(
     letter_id: int, 
@@ -377,30 +425,36 @@ def add_approval_comment(
 # Mail endpoints
 @mail_router.post("/check", response_model=dict)
 def check_mail_manually(db: Session = Depends(get_db)):
-    """Ручная проверка почты на новые письма"""
+    """Ручная проверка почты на новые письма (все настроенные ящики и папки)"""
     try:
-        if not mail_service.client:
-            connected = mail_service.connect()
-            if not connected:
-                raise HTTPException(
-                    status_code=503, 
-                    detail="Не удалось подключиться к почтовому серверу. Проверьте настройки в .env"
-                )
+        targets = mailboxes or [mail_service]
+        connected = [mail for mail in targets if mail.client or mail.connect()]
+        if not connected:
+            raise HTTPException(
+                status_code=503, 
+                detail="Не удалось подключиться к почтовому серверу. Проверьте настройки в .env"
+            )
         
-        letters = mail_service.fetch_new_emails(db)
+        by_mailbox = {mail.name: len(mail.fetch_new_emails(db)) for mail in connected}
+        total = sum(by_mailbox.values())
         return {
             "status": "success",
-            "new_letters": len(letters),
-            "message": f"Получено новых писем: {len(letters)}"
+            "new_letters": total,
+            "by_mailbox": by_mailbox,
+            "message": f"Получено новых писем: {total}"
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Ошибка при проверке почты: {str(e)}")
 
 
 @mail_router.get("/status", response_model=dict)
-def get_mail_status():
-    """Статус подключения к почте"""
-    return mail_service.get_status()
+def get_mail_status(db: Session = Depends(get_db)):
+    """Статус подключения к почте и отставание приема по каждой папке"""
+    status = mail_service.get_status()
+    status["mailboxes"] = mailbox_statuses(db)
+    return status
 
 
 # Analytics endpoints
@@ -557,3 +611,145 @@ def delete_notification(
         raise HTTPException(status_code=404, detail="Уведомление не найдено")
     
     return None
+
+
+# LLM endpoints (только для админов)
+@llm_router.get("/metrics", response_model=dict)
+def get_llm_metrics(current_user: User = Depends(require_admin)):
+    """Метрики HTTP-клиента, кэша, ограничителя запросов и circuit breaker Yandex GPT"""
+    return {
+        "http": yandex_gpt_service.get_http_metrics(),
+        "cache": llm_cache.get_metrics(),
+        "limiter": llm_limiter.get_metrics(),
+        "circuit_breaker": llm_circuit_breaker.get_metrics(),
+        "single_flight": letter_single_flight.get_metrics()
+    }
+
+
+@llm_router.get("/compaction", response_model=dict)
+def get_body_compaction(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Экономия токенов от удаления цитат, подписей и дисклеймеров из писем"""
+    return letter_service.compaction_stats(db)
+
+
+@llm_router.get("/knowledge-base", response_model=dict)
+def get_knowledge_base_version(current_user: User = Depends(require_admin)):
+    """Активная версия базы знаний"""
+    return knowledge_base_store.current().info()
+
+
+@llm_router.post("/knowledge-base/reload", response_model=dict)
+def reload_knowledge_base(current_user: User = Depends(require_admin)):
+    """Принудительная перечитка базы знаний с диска"""
+    return knowledge_base_store.reload().info()
+
+
+class BatchAnalysisRequest(BaseModel):
+    letter_ids: Optional[List[int]] = None
+    include_analyzed: bool = False
+
+
+@llm_router.post("/batch", response_model=dict)
+def enqueue_batch_analysis(
+    request: BatchAnalysisRequest,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Постановка писем в пакетный анализ (по умолчанию — неразобранные и отложенные)"""
+    enqueued = batch_analysis_service.enqueue(db, request.letter_ids, request.include_analyzed)
+    return {"enqueued": enqueued}
+
+
+@llm_router.get("/batch", response_model=dict)
+def get_batch_analysis_status(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Состояние очереди пакетного анализа по этапам и статусам"""
+    return batch_analysis_service.get_status(db)
+
+
+@llm_router.get("/queue", response_model=dict)
+def get_analysis_queue(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Глубина очереди анализа по статусам"""
+    return analysis_queue.get_metrics(db)
+
+
+@llm_router.post("/queue/requeue-dead", response_model=dict)
+def requeue_dead_analysis_jobs(
+    letter_ids: Optional[List[int]] = None,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Повторная постановка задач, исчерпавших попытки"""
+    return {"requeued": analysis_queue.requeue_dead(db, letter_ids)}
+
+
+class ReanalysisRequest(BaseModel):
+    status: Optional[LetterStatus] = None
+    letter_type: Optional[LetterType] = None
+    date_from: Optional[datetime] = None
+    date_to: Optional[datetime] = None
+    concurrency: Optional[int] = None
+    force: bool = False  # Анализировать и письма без изменений
+
+
+@llm_router.post("/reanalysis", response_model=dict, status_code=status.HTTP_202_ACCEPTED)
+def start_reanalysis(
+    request: ReanalysisRequest,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Массовый повторный анализ писем по статусу, типу и дате создания"""
+    run = reanalysis_service.create_run(
+        db,
+        status=request.status,
+        letter_type=request.letter_type,
+        date_from=request.date_from,
+        date_to=request.date_to,
+        concurrency=request.concurrency,
+        force=request.force,
+        user_id=current_user.id
+    )
+    return reanalysis_service.run_info(run)
+
+
+@llm_router.get("/reanalysis", response_model=List[dict])
+def list_reanalysis_runs(
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Последние запуски повторного анализа"""
+    return reanalysis_service.list_runs(db)
+
+
+@llm_router.get("/reanalysis/{run_id}", response_model=dict)
+def get_reanalysis_run(
+    run_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Прогресс и оценка оставшегося времени"""
+    run = db.query(ReanalysisRun).filter(ReanalysisRun.id == run_id).first()
+    if not run:
+        raise HTTPException(status_code=404, detail="Запуск не найден")
+    return reanalysis_service.run_info(run)
+
+
+@llm_router.post("/reanalysis/{run_id}/cancel", response_model=dict)
+def cancel_reanalysis_run(
+    run_id: int,
+    db: Session = Depends(get_db),
+    current_user: User = Depends(require_admin)
+):
+    """Отмена запуска (текущие письма дорабатываются)"""
+    run = reanalysis_service.cancel(db, run_id)
+    if not run:
+        raise HTTPException(status_code=404, detail="Запуск не найден")
+    return reanalysis_service.run_info(run)
@@ -0,0 +1,63 @@
+"""
+Фоновые задачи по ролям процесса: API или отдельный обработчик (app.worker)
+"""
+import asyncio
+import logging
+from typing import Iterable, List, Set
+
+from app.config import settings
+from app.services.mail_service import start_mail_monitoring
+from app.services.attachment_service import run_attachment_extraction
+from app.services.priority_service import recalculate_priorities
+from app.services.sla_monitor_service import monitor_sla
+from app.services.letter_service import retry_deferred_analysis
+from app.services.batch_analysis import run_batch_analysis
+from app.services.analysis_queue import run_analysis_workers
+from app.services.reanalysis_service import run_reanalysis_runs
+
+logger = logging.getLogger(__name__)
+
+# ingest — мониторинг почты и загрузка вложений; analyze — обработка очереди анализа, повторный,
+# массовый и пакетный анализ; scheduler — пересчет приоритетов и контроль SLA
+ROLES = ("ingest", "analyze", "scheduler")
+
+
+def parse_roles(value: str) -> Set[str]:
+    """Роли из строки через запятую; неизвестные роли — ошибка конфигурации"""
+    roles = {role.strip() for role in value.split(",") if role.strip()}
+    unknown = roles - set(ROLES)
+    if unknown:
+        raise ValueError(f"Неизвестные роли фоновых задач: {', '.join(sorted(unknown))}")
+    return roles
+
+
+def start_background_tasks(roles: Iterable[str], db_session_factory) -> List[asyncio.Task]:
+    """Запуск фоновых задач для указанных ролей"""
+    roles = set(roles)
+    tasks: List[asyncio.Task] = []
+    if "ingest" in roles:
+        tasks.append(asyncio.create_task(start_mail_monitoring(db_session_factory)))
+        if settings.attachments_enabled:
+            tasks.append(asyncio.create_task(run_attachment_extraction(db_session_factory)))
+    if "analyze" in roles:
+        tasks.append(asyncio.create_task(run_analysis_workers(db_session_factory)))
+        tasks.append(asyncio.create_task(retry_deferred_analysis(db_session_factory)))
+        tasks.append(asyncio.create_task(run_reanalysis_runs(db_session_factory)))
+        if settings.batch_analysis_enabled:
+            tasks.append(asyncio.create_task(run_batch_analysis(db_session_factory)))
+    if "scheduler" in roles:
+        tasks.append(asyncio.create_task(recalculate_priorities(db_session_factory)))
+        tasks.append(asyncio.create_task(monitor_sla(db_session_factory)))
+
+    if roles:
+        logger.info(f"✅ Фоновые задачи запущены, роли: {', '.join(sorted(roles))}")
+    else:
+        logger.info("ℹ️ Фоновые задачи отключены")
+    return tasks
+
+
+async def stop_background_tasks(tasks: List[asyncio.Task]):
+    """Отмена задач с ожиданием (обработчики возвращают незавершенные задачи в очередь)"""
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
@@ -6,13 +6,127 @@ class Settings(BaseSettings):
     yandex_api_key: str
     yandex_folder_id: str
     yandex_model: str = "yandexgpt"
+    # Адрес API Foundation Models (для нагрузочных тестов — локальный mock_yandex_gpt.py)
+    yandex_gpt_base_url: str = "https://llm.api.cloud.yandex.net/foundationModels/v1"
+
+    # HTTP-клиент Yandex GPT (общий пул соединений)
+    yandex_gpt_max_connections: int = 20
+    yandex_gpt_max_keepalive_connections: int = 10
+    yandex_gpt_keepalive_expiry: float = 30.0  # секунды
+    yandex_gpt_http2: bool = False
+    yandex_gpt_connect_timeout: float = 10.0  # секунды
+    yandex_gpt_read_timeout: float = 120.0  # секунды
+
+    # Ограничение нагрузки на Yandex GPT
+    llm_max_concurrency: int = 8
+    llm_requests_per_second: float = 10.0  # 0 — без ограничения
+    llm_tokens_per_minute: int = 0  # 0 — без ограничения
+    llm_max_retries: int = 3  # повторы при 429/5xx и сетевых ошибках
+    llm_backoff_base: float = 1.0  # секунды
+    llm_backoff_max: float = 30.0  # секунды
+    # >0 — общий лимит одновременных запросов для всех реплик (advisory locks Postgres)
+    llm_pg_coordination_slots: int = 0
+
+    # Circuit breaker для Yandex GPT
+    llm_breaker_window: int = 20  # последних вызовов в окне
+    llm_breaker_min_calls: int = 10
+    llm_breaker_error_rate: float = 0.5
+    llm_breaker_slow_call_seconds: float = 60.0
+    llm_breaker_slow_call_rate: float = 0.5
+    llm_breaker_open_seconds: float = 30.0
+    # Хеджирование: второй запрос, если первый дольше перцентиля задержек
+    llm_hedge_enabled: bool = False
+    llm_hedge_percentile: float = 0.95
+    llm_hedge_min_samples: int = 20
+
+    # Пакетный анализ через асинхронные операции (completionAsync)
+    yandex_operation_url: str = "https://operation.api.cloud.yandex.net/operations"
+    batch_analysis_enabled: bool = True
+    batch_analysis_api: str = "yandex"  # yandex / stub (локальная заглушка для тестов)
+    batch_analysis_size: int = 50  # операций за цикл
+    batch_analysis_poll_interval: int = 10  # секунды
+    batch_analysis_max_attempts: int = 3
+
+    # Роли фоновых задач процесса API: ingest, analyze, scheduler.
+    # Пустая строка — API только обслуживает HTTP, задачи выполняет python -m app.worker
+    background_roles: str = "ingest,analyze,scheduler"
+
+    # Очередь анализа писем (таблица analysis_jobs)
+    analysis_worker_concurrency: int = 4  # одновременных анализов в процессе
+    analysis_job_max_attempts: int = 5  # после этого задача уходит в dead
+    analysis_job_backoff_base: float = 30.0  # секунды
+    analysis_job_backoff_max: float = 1800.0  # секунды
+    analysis_job_poll_interval: float = 1.0  # секунды, когда очередь пуста
+    analysis_job_stale_seconds: int = 900  # running дольше — процесс считается упавшим
+    analysis_job_retention_days: int = 7  # хранение завершенных задач
+
+    # Один анализ письма одновременно во всех репликах (захват в letters.analysis_claimed_until)
+    analysis_pg_single_flight: bool = True
+    analysis_claim_ttl_seconds: int = 120  # захват продлевается каждую треть срока, пока анализ идет
+
+    # Массовый повторный анализ (reanalysis_runs)
+    reanalysis_default_concurrency: int = 2
+    reanalysis_max_concurrency: int = 8
+    reanalysis_poll_interval: float = 5.0  # секунды между проверками новых запусков
+    reanalysis_stale_seconds: int = 600  # запуск без heartbeat дольше считается брошенным
+
+    # Кэш результатов LLM (анализ и черновики)
+    llm_cache_enabled: bool = True
+    llm_cache_memory_size: int = 512  # записей в LRU
+    llm_cache_db_enabled: bool = True
+    llm_cache_ttl_hours: int = 168  # 7 дней
+
+    # База знаний (пустой путь — knowledge_base.json в корне backend)
+    knowledge_base_path: str = ""
+    knowledge_base_check_interval: float = 5.0  # секунды между проверками файла
+    # Выбор релевантных разделов базы знаний вместо фиксированной сводки
+    kb_retrieval_enabled: bool = False
+    kb_retrieval_top_k: int = 3
+    kb_retrieval_token_budget: int = 1200
+    kb_retrieval_min_score_ratio: float = 0.5
+
+    # Генерация черновиков: single — один запрос на 4 стиля,
+    # parallel — отдельный запрос на каждый стиль
+    draft_generation_mode: str = "single"
+    draft_parallel_concurrency: int = 4
+    draft_variant_retries: int = 1
     
     # Yandex Mail settings
     yandex_mail_login: str = ""
     yandex_mail_password: str = ""
     yandex_mail_imap_server: str = "imap.yandex.ru"
     yandex_mail_imap_port: int = 993
-    yandex_mail_check_interval: int = 60  # секунды
+    yandex_mail_check_interval: int = 60  # секунды (режим poll)
+    yandex_mail_folders: str = "INBOX"  # папки основного ящика через запятую
+    # Дополнительные ящики, JSON: [{"login": "...", "password": "...", "folders": ["INBOX", "Жалобы"]}]
+    # (imap_server и imap_port необязательны); у каждой папки свое соединение и чекпоинт
+    yandex_mail_accounts: str = ""
+    yandex_mail_ingest_concurrency: int = 2  # одновременных выборок по всем ящикам и папкам
+    # idle — письма забираются сразу по уведомлению IMAP IDLE, poll — опрос по интервалу
+    yandex_mail_mode: str = "idle"
+    yandex_mail_idle_renew_seconds: int = 300  # перезапуск IDLE до таймаута сервера (29 мин по RFC)
+    yandex_mail_idle_fallback_poll: int = 300  # страховочный опрос в режиме idle, секунды
+    yandex_mail_reconnect_max_seconds: float = 300.0  # предел отсрочки переподключения
+    yandex_mail_fetch_batch_size: int = 50  # писем за одну выборку из IMAP
+    yandex_mail_max_body_bytes: int = 1048576  # предел текста письма; вложения не загружаются
+    # Разбор MIME и HTML -> текст в пуле процессов (0 — в потоке приема, без лимита времени)
+    mail_parser_processes: int = 2
+    mail_parser_cpu_seconds: float = 5.0  # лимит процессорного времени на одно письмо
+    # Вложения: загрузка в фоне (роль ingest) и извлечение текста PDF/DOCX/TXT
+    attachments_enabled: bool = True
+    attachments_dir: str = "storage/attachments"
+    attachment_max_bytes: int = 20 * 1024 * 1024  # вложения больше не загружаются
+    attachment_fetch_chunk_bytes: int = 262144  # размер части при потоковой загрузке из IMAP
+    attachment_max_text_chars: int = 100000  # предел извлеченного текста на вложение
+    attachment_analysis_token_budget: int = 1500  # токенов текста вложений в анализе (0 — не использовать)
+    attachment_max_attempts: int = 3
+    attachment_batch_size: int = 20
+    attachment_poll_interval: float = 10.0  # секунды
+    # Переписки (In-Reply-To / References): анализ ответа с кратким содержанием предыдущих писем
+    thread_summary_letters: int = 3  # предыдущих писем в кратком содержании
+    thread_summary_token_budget: int = 400
+    # Ответ в переписке получает тип первого письма, если модель не уверена в другом типе (0..1)
+    thread_reclassify_confidence: float = 0.8
 
     # SMTP для исходящих писем
     yandex_mail_smtp_server: str = "smtp.yandex.ru"
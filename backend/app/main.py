@@ -10,12 +10,15 @@ from app.api.routes import (
     user_router, 
     auth_router, 
     analytics_router,
-    notification_router
+    notification_router,
+    llm_router
 )
 from app.database import engine, Base, get_db
-from app.services.mail_service import start_mail_monitoring
-from app.services.priority_service import recalculate_priorities
-from app.services.sla_monitor_service import monitor_sla
+from app.config import settings
+from app.background import parse_roles, start_background_tasks, stop_background_tasks
+from app.services.yandex_gpt import yandex_gpt_service
+from app.services.llm_cache import llm_cache
+from app.services.mail_parser import mail_parser
 
 # Настройка логирования
 logging.basicConfig(
@@ -30,18 +33,21 @@ Base.metadata.create_all(bind=engine)
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Управление жизненным циклом приложения"""
-    # Запуск фоновых задач
-    mail_task = asyncio.create_task(start_mail_monitoring(get_db))
-    priority_task = asyncio.create_task(recalculate_priorities(get_db))
-    sla_monitor_task = asyncio.create_task(monitor_sla(get_db))
-    logging.info("✅ Приложение запущено, мониторинг почты и SLA активны")
+    # Общий HTTP-клиент для Yandex GPT
+    await yandex_gpt_service.startup()
+    # Очистка устаревших записей кэша LLM
+    await asyncio.to_thread(llm_cache.purge_expired)
+    
+    # Запуск фоновых задач (BACKGROUND_ROLES="" — только HTTP, задачи в app.worker)
+    tasks = start_background_tasks(parse_roles(settings.background_roles), get_db)
+    logging.info("✅ Приложение запущено")
     
     yield
     
     # Остановка фоновых задач
-    mail_task.cancel()
-    priority_task.cancel()
-    sla_monitor_task.cancel()
+    await stop_background_tasks(tasks)
+    await asyncio.to_thread(mail_parser.shutdown)
+    await yandex_gpt_service.shutdown()
     logging.info("⏸️ Приложение остановлено")
 
 
@@ -68,6 +74,7 @@ app.include_router(mail_router)
 app.include_router(user_router)
 app.include_router(analytics_router)
 app.include_router(notification_router)
+app.include_router(llm_router)
 
 
 @app.get("/")
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, DateTime, JSON, Enum as SQLEnum, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, Text, DateTime, JSON, Enum as SQLEnum, Boolean, Index, UniqueConstraint, text
 from sqlalchemy.sql import func
 from app.database import Base
 import enum
@@ -67,12 +67,28 @@ class User(Base):
 
 class Letter(Base):
     __tablename__ = "letters"
+    __table_args__ = (
+        # Повторно полученное из почты письмо не создается второй раз
+        Index(
+            "uq_letters_message_id", "message_id", unique=True,
+            postgresql_where=text("message_id IS NOT NULL")
+        ),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     subject = Column(String(500), nullable=False)
     body = Column(Text, nullable=False)
     sender_email = Column(String(255))
     sender_name = Column(String(255))
+    message_id = Column(String(998), nullable=True)  # Заголовок Message-ID (для писем из почты)
+    content_hash = Column(String(64), nullable=True, index=True)  # sha256 нормализованных отправителя, темы и текста
+    analysis_body = Column(Text, nullable=True)  # Текст для модели без цитат, подписей и дисклеймеров (None — совпадает с body)
+    body_tokens = Column(Integer, nullable=True)  # Оценка токенов body
+    analysis_body_tokens = Column(Integer, nullable=True)  # Оценка токенов текста для модели
+    in_reply_to = Column(String(998), nullable=True, index=True)  # Заголовок In-Reply-To
+    thread_references = Column(Text, nullable=True)  # Заголовок References: Message-ID через пробел
+    thread_id = Column(Integer, nullable=True, index=True)  # id первого письма переписки (None у первого письма и писем вне переписки)
+    parse_error = Column(Text, nullable=True)  # Письмо не удалось разобрать: причина (body — заглушка)
     
     # Классификация
     letter_type = Column(SQLEnum(LetterType), nullable=True)
@@ -83,6 +99,10 @@ class Letter(Base):
     priority = Column(Integer, default=2)  # 1-высокий, 2-средний, 3-низкий
     sla_hours = Column(Integer, nullable=True)
     sla_reasoning = Column(Text, nullable=True)  # Объяснение выбора SLA
+    needs_reanalysis = Column(Boolean, default=False, nullable=False, index=True)  # Анализ выполнен по шаблону, нужен повтор
+    analysis_fingerprint = Column(String(64), nullable=True)  # Входные данные последнего полного анализа
+    analysis_claimed_until = Column(DateTime(timezone=True), nullable=True)  # Анализ идет в одной из реплик до этого момента
+    analysis_claimed_by = Column(String(64), nullable=True)  # Вызов, захвативший анализ
     
     # Анализ (JSON)
     classification_data = Column(JSON, nullable=True)  # Полный результат классификации
@@ -123,3 +143,129 @@ class Notification(Base):
     
     is_read = Column(Boolean, default=False, nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), index=True)
+
+
+class LLMCacheEntry(Base):
+    __tablename__ = "llm_cache"
+
+    key = Column(String(64), primary_key=True)  # sha256 от входных данных запроса
+    kind = Column(String(32), nullable=False, index=True)  # analysis / drafts
+    value = Column(JSON, nullable=False)
+    hits = Column(Integer, default=0, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    expires_at = Column(DateTime(timezone=True), nullable=False, index=True)
+
+
+class BatchAnalysisItem(Base):
+    __tablename__ = "batch_analysis_items"
+
+    id = Column(Integer, primary_key=True, index=True)
+    letter_id = Column(Integer, nullable=False, index=True)
+    stage = Column(String(20), default="analysis", nullable=False)  # analysis -> drafts
+    status = Column(String(20), default="pending", nullable=False, index=True)  # pending / submitted / done / failed
+    operation_id = Column(String(100), nullable=True)  # ID асинхронной операции Yandex
+    analysis = Column(JSON, nullable=True)  # Результат первого этапа (нужен для черновиков)
+    attempts = Column(Integer, default=0, nullable=False)
+    error = Column(Text, nullable=True)
+    locked_at = Column(DateTime(timezone=True), nullable=True)  # Захвачен обработчиком на время запросов к API
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+
+
+class AnalysisJob(Base):
+    __tablename__ = "analysis_jobs"
+    __table_args__ = (
+        # Не больше одной активной задачи на письмо
+        Index(
+            "uq_analysis_jobs_active_letter", "letter_id", unique=True,
+            postgresql_where=text("status IN ('queued', 'running')"),
+            sqlite_where=text("status IN ('queued', 'running')")
+        ),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    letter_id = Column(Integer, nullable=False, index=True)
+    status = Column(String(20), default="queued", nullable=False, index=True)  # queued / running / done / dead
+    attempts = Column(Integer, default=0, nullable=False)
+    run_after = Column(DateTime(timezone=True), server_default=func.now(), nullable=False, index=True)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    locked_by = Column(String(100), nullable=True)  # hostname:pid обработчика
+    rerun_requested = Column(Boolean, default=False, nullable=False)  # Письмо изменилось во время анализа: после завершения поставить снова
+    last_error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class ReanalysisRun(Base):
+    __tablename__ = "reanalysis_runs"
+
+    id = Column(Integer, primary_key=True, index=True)
+    filters = Column(JSON, nullable=True)  # status, letter_type, date_from, date_to
+    force = Column(Boolean, default=False, nullable=False)  # Анализировать даже без изменений
+    concurrency = Column(Integer, default=2, nullable=False)
+    status = Column(String(20), default="queued", nullable=False, index=True)  # queued / running / cancelling / completed / cancelled
+    created_by = Column(Integer, nullable=True)  # ID администратора
+
+    total = Column(Integer, default=0, nullable=False)
+    processed = Column(Integer, default=0, nullable=False)
+    skipped = Column(Integer, default=0, nullable=False)  # Входные данные не изменились
+    failed = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    started_at = Column(DateTime(timezone=True), nullable=True)
+    heartbeat_at = Column(DateTime(timezone=True), nullable=True)
+    finished_at = Column(DateTime(timezone=True), nullable=True)
+
+
+class MailboxSyncState(Base):
+    __tablename__ = "mailbox_sync_state"
+    __table_args__ = (
+        UniqueConstraint("account", "mailbox", name="uq_mailbox_sync_state_account_mailbox"),
+    )
+
+    id = Column(Integer, primary_key=True, index=True)
+    account = Column(String(255), nullable=False)  # Логин почтового ящика
+    mailbox = Column(String(255), nullable=False)  # Папка IMAP, например INBOX
+    uidvalidity = Column(BigInteger, nullable=True)  # При смене все UID недействительны
+    last_uid = Column(BigInteger, default=0, nullable=False)  # Последний обработанный UID
+    pending = Column(Integer, default=0, nullable=False)  # Не обработано после последней синхронизации
+    last_sync_at = Column(DateTime(timezone=True), nullable=True)
+    caught_up_at = Column(DateTime(timezone=True), nullable=True)  # Когда папка была разобрана полностью
+    last_error = Column(Text, nullable=True)
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+
+
+class LetterAttachment(Base):
+    __tablename__ = "letter_attachments"
+
+    id = Column(Integer, primary_key=True, index=True)
+    letter_id = Column(Integer, nullable=False, index=True)
+
+    # Где лежит вложение в почте (загружается в фоне по BODY.PEEK[section])
+    account = Column(String(255), nullable=False)
+    mailbox = Column(String(255), nullable=False)
+    uidvalidity = Column(BigInteger, nullable=True)
+    uid = Column(BigInteger, nullable=False)
+    section = Column(String(50), nullable=False)
+
+    filename = Column(String(500), nullable=False)
+    content_type = Column(String(255), nullable=False)
+    charset = Column(String(50), nullable=True)
+    encoding = Column(String(50), nullable=True)  # Content-Transfer-Encoding
+    size = Column(BigInteger, default=0, nullable=False)  # Размер в письме (до декодирования)
+
+    # pending / processing / done / no_text / unsupported / skipped / expired / failed
+    status = Column(String(20), default="pending", nullable=False, index=True)
+    attempts = Column(Integer, default=0, nullable=False)
+    locked_at = Column(DateTime(timezone=True), nullable=True)
+    storage_path = Column(String(500), nullable=True)  # Файл в attachments_dir
+    content_hash = Column(String(64), nullable=True, index=True)  # sha256 содержимого
+    extracted_text = Column(Text, nullable=True)
+    error = Column(Text, nullable=True)
+
+    created_at = Column(DateTime(timezone=True), server_default=func.now())
+    processed_at = Column(DateTime(timezone=True), nullable=True)
@@ -93,6 +93,11 @@ class LetterResponse(BaseModel):
     priority: int
     sla_hours: Optional[int]
     sla_reasoning: Optional[str]
+    needs_reanalysis: Optional[bool] = None
+    body_tokens: Optional[int] = None  # Оценка токенов исходного текста
+    analysis_body_tokens: Optional[int] = None  # Оценка токенов текста, переданного модели
+    thread_id: Optional[int] = None  # id первого письма переписки
+    parse_error: Optional[str] = None  # Письмо из почты не удалось разобрать
     classification_data: Optional[Dict[str, Any]]
     extracted_entities: Optional[Dict[str, Any]]
     risks: Optional[List[Dict[str, Any]]]
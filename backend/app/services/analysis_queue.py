@@ -0,0 +1,324 @@
+"""
+Очередь анализа писем в Postgres (analysis_jobs) и пул обработчиков.
+
+Задачи забираются через SELECT ... FOR UPDATE SKIP LOCKED, поэтому обработчиков
+может быть несколько в разных процессах. Ошибки повторяются с экспоненциальной
+отсрочкой, после analysis_job_max_attempts задача переходит в dead.
+"""
+import asyncio
+import logging
+import os
+import random
+import socket
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import AnalysisJob
+from app.services.letter_service import LetterService
+
+logger = logging.getLogger(__name__)
+
+ACTIVE_STATUSES = ("queued", "running")
+
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+
+class AnalysisQueue:
+    """Постановка, выборка и завершение задач анализа"""
+
+    @staticmethod
+    def enqueue(db: Session, letter_id: int) -> AnalysisJob:
+        """Постановка письма в очередь; активная задача по письму не дублируется.
+
+        Если анализ уже выполняется, он мог прочитать письмо до изменения:
+        задача помечается, и после ее завершения письмо ставится в очередь снова.
+        """
+        existing = db.query(AnalysisJob).filter(
+            AnalysisJob.letter_id == letter_id,
+            AnalysisJob.status.in_(ACTIVE_STATUSES)
+        ).first()
+        if existing:
+            if existing.status == "running" and not existing.rerun_requested:
+                existing.rerun_requested = True
+                db.commit()
+            return existing
+
+        job = AnalysisJob(letter_id=letter_id)
+        db.add(job)
+        try:
+            db.commit()
+        except IntegrityError:
+            # Параллельно задачу поставил другой процесс
+            db.rollback()
+            return db.query(AnalysisJob).filter(
+                AnalysisJob.letter_id == letter_id,
+                AnalysisJob.status.in_(ACTIVE_STATUSES)
+            ).first()
+        return job
+
+    @staticmethod
+    def claim(db: Session, limit: int) -> List[tuple[int, int]]:
+        """Захват до limit готовых задач; возвращает пары (id задачи, id письма)"""
+        jobs = (
+            db.query(AnalysisJob)
+            .filter(AnalysisJob.status == "queued", AnalysisJob.run_after <= func.now())
+            .order_by(AnalysisJob.run_after, AnalysisJob.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for job in jobs:
+            job.status = "running"
+            job.attempts += 1
+            job.locked_at = func.now()
+            job.locked_by = WORKER_ID
+        db.commit()
+        return [(job.id, job.letter_id) for job in jobs]
+
+    @staticmethod
+    def complete(db: Session, job_id: int, rerun: bool = False):
+        """Завершение задачи; rerun или повтор, запрошенный во время анализа, ставит письмо снова"""
+        job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).first()
+        if job:
+            job.status = "done"
+            job.last_error = None
+            job.finished_at = func.now()
+            if rerun or job.rerun_requested:
+                # Сначала снимаем активный статус: не больше одной активной задачи на письмо
+                db.flush()
+                db.add(AnalysisJob(letter_id=job.letter_id))
+                logger.info(f"🔁 Письмо {job.letter_id} изменилось во время анализа, поставлено в очередь снова")
+            db.commit()
+
+    @staticmethod
+    def fail(db: Session, job_id: int, error: str):
+        """Повтор с отсрочкой или перевод в dead"""
+        job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).first()
+        if not job:
+            return
+        job.last_error = error[:2000]
+        job.locked_at = None
+        job.locked_by = None
+        if job.attempts >= settings.analysis_job_max_attempts:
+            job.status = "dead"
+            job.finished_at = func.now()
+            logger.error(f"☠️ Анализ письма {job.letter_id} не удался после {job.attempts} попыток: {error}")
+        else:
+            delay = min(
+                settings.analysis_job_backoff_max,
+                settings.analysis_job_backoff_base * (2 ** (job.attempts - 1))
+            ) * random.uniform(0.5, 1.0)
+            job.status = "queued"
+            job.run_after = datetime.now(timezone.utc) + timedelta(seconds=delay)
+            logger.warning(f"🔁 Анализ письма {job.letter_id} повторится через {delay:.0f} с: {error}")
+        db.commit()
+
+    @staticmethod
+    def release(db: Session, job_id: int):
+        """Возврат задачи в очередь без учета попытки (остановка обработчика)"""
+        job = db.query(AnalysisJob).filter(AnalysisJob.id == job_id).first()
+        if job and job.status == "running":
+            job.status = "queued"
+            job.attempts = max(0, job.attempts - 1)
+            job.locked_at = None
+            job.locked_by = None
+            db.commit()
+
+    @staticmethod
+    def heartbeat(db: Session, job_id: int):
+        """Продление захвата выполняющейся задачи, чтобы recover_stale ее не вернул"""
+        db.query(AnalysisJob).filter(
+            AnalysisJob.id == job_id,
+            AnalysisJob.status == "running",
+            AnalysisJob.locked_by == WORKER_ID
+        ).update({"locked_at": func.now()}, synchronize_session=False)
+        db.commit()
+
+    @staticmethod
+    def recover_stale(db: Session) -> int:
+        """Возврат в очередь задач упавших процессов и удаление старых завершенных.
+
+        Попытка уже засчитана при захвате (claim), поэтому здесь счетчик не
+        меняется: письмо, на котором процесс падает каждый раз, уходит в dead,
+        когда попытки исчерпаны.
+        """
+        now = datetime.now(timezone.utc)
+        stale = (
+            AnalysisJob.status == "running",
+            AnalysisJob.locked_at < now - timedelta(seconds=settings.analysis_job_stale_seconds)
+        )
+        dead = db.query(AnalysisJob).filter(
+            *stale, AnalysisJob.attempts >= settings.analysis_job_max_attempts
+        ).update(
+            {
+                "status": "dead",
+                "last_error": "Обработчик не завершил задачу (процесс упал или завис)",
+                "locked_at": None, "locked_by": None, "finished_at": func.now(),
+            },
+            synchronize_session=False
+        )
+        recovered = db.query(AnalysisJob).filter(*stale).update(
+            {"status": "queued", "locked_at": None, "locked_by": None},
+            synchronize_session=False
+        )
+        db.query(AnalysisJob).filter(
+            AnalysisJob.status == "done",
+            AnalysisJob.finished_at < now - timedelta(days=settings.analysis_job_retention_days)
+        ).delete(synchronize_session=False)
+        db.commit()
+        if dead:
+            logger.error(f"☠️ Зависших задач анализа с исчерпанными попытками: {dead}")
+        if recovered:
+            logger.warning(f"♻️ Возвращено в очередь зависших задач анализа: {recovered}")
+        return recovered + dead
+
+    @staticmethod
+    def requeue_dead(db: Session, letter_ids: Optional[List[int]] = None) -> int:
+        """Повторная постановка задач из dead с новым счетчиком попыток"""
+        query = db.query(AnalysisJob).filter(AnalysisJob.status == "dead")
+        if letter_ids:
+            query = query.filter(AnalysisJob.letter_id.in_(letter_ids))
+        active = {
+            row.letter_id for row in db.query(AnalysisJob.letter_id)
+            .filter(AnalysisJob.status.in_(ACTIVE_STATUSES))
+            .all()
+        }
+        requeued = 0
+        for job in query.order_by(AnalysisJob.id.desc()).all():
+            if job.letter_id in active:
+                continue
+            job.status = "queued"
+            job.attempts = 0
+            job.run_after = func.now()
+            job.finished_at = None
+            active.add(job.letter_id)
+            requeued += 1
+        db.commit()
+        return requeued
+
+    @staticmethod
+    def get_metrics(db: Session) -> Dict[str, Any]:
+        """Глубина очереди по статусам и возраст самой старой готовой задачи"""
+        counts = dict(
+            db.query(AnalysisJob.status, func.count(AnalysisJob.id))
+            .group_by(AnalysisJob.status)
+            .all()
+        )
+        oldest = db.query(func.min(AnalysisJob.run_after)).filter(
+            AnalysisJob.status == "queued",
+            AnalysisJob.run_after <= func.now()
+        ).scalar()
+        return {
+            "queued": counts.get("queued", 0),
+            "running": counts.get("running", 0),
+            "done": counts.get("done", 0),
+            "dead": counts.get("dead", 0),
+            "oldest_ready_seconds": (
+                round((datetime.now(timezone.utc) - oldest).total_seconds(), 1) if oldest else 0.0
+            ),
+            "worker_concurrency": settings.analysis_worker_concurrency,
+        }
+
+
+analysis_queue = AnalysisQueue()
+
+
+def _with_session(db_session_factory, method, *args):
+    """Вызов метода очереди в отдельной сессии (выполняется в потоке)"""
+    db: Session = next(db_session_factory())
+    try:
+        return method(db, *args)
+    finally:
+        db.close()
+
+
+async def _heartbeat(db_session_factory, job_id: int):
+    """Периодическое обновление locked_at, пока задача выполняется"""
+    interval = max(1.0, settings.analysis_job_stale_seconds / 3)
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await asyncio.to_thread(_with_session, db_session_factory, AnalysisQueue.heartbeat, job_id)
+        except Exception as e:
+            logger.warning(f"⚠️ Не удалось продлить захват задачи анализа {job_id}: {e}")
+
+
+async def _process_job(db_session_factory, job_id: int, letter_id: int):
+    """Анализ одного письма в собственной сессии"""
+    db: Session = next(db_session_factory())
+    heartbeat = asyncio.create_task(_heartbeat(db_session_factory, job_id))
+    try:
+        try:
+            letter = await LetterService.analyze_letter(db, letter_id)
+        except asyncio.CancelledError:
+            db.rollback()
+            await asyncio.shield(asyncio.to_thread(AnalysisQueue.release, db, job_id))
+            raise
+        except ValueError as e:
+            # Письмо удалено — повторять бессмысленно
+            db.rollback()
+            await asyncio.to_thread(AnalysisQueue.complete, db, job_id)
+            logger.warning(f"⚠️ Задача анализа письма {letter_id} пропущена: {e}")
+            return
+        except Exception as e:
+            db.rollback()
+            await asyncio.to_thread(AnalysisQueue.fail, db, job_id, str(e) or e.__class__.__name__)
+            return
+        try:
+            # Текст вложений мог появиться, пока шел анализ
+            outdated = await asyncio.to_thread(LetterService.analysis_outdated, db, letter)
+        except Exception as e:
+            db.rollback()
+            outdated = False
+            logger.warning(f"⚠️ Не удалось сверить входные данные анализа письма {letter_id}: {e}")
+        await asyncio.to_thread(AnalysisQueue.complete, db, job_id, outdated)
+    finally:
+        heartbeat.cancel()
+        db.close()
+
+
+async def run_analysis_workers(db_session_factory, concurrency: Optional[int] = None):
+    """Фоновая задача: пул обработчиков очереди анализа"""
+    concurrency = concurrency or settings.analysis_worker_concurrency
+    logger.info(f"🧠 Запущены обработчики очереди анализа: {concurrency} ({WORKER_ID})")
+    running: set = set()
+    last_recovery = 0.0
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            try:
+                if loop.time() - last_recovery > 60:
+                    await asyncio.to_thread(_with_session, db_session_factory, AnalysisQueue.recover_stale)
+                    last_recovery = loop.time()
+
+                claimed = []
+                free = concurrency - len(running)
+                if free > 0:
+                    claimed = await asyncio.to_thread(_with_session, db_session_factory, AnalysisQueue.claim, free)
+                for job_id, letter_id in claimed:
+                    task = asyncio.create_task(_process_job(db_session_factory, job_id, letter_id))
+                    running.add(task)
+                    task.add_done_callback(running.discard)
+
+                if running and (free <= 0 or not claimed):
+                    # Ждем освобождения слота, но не дольше интервала опроса
+                    await asyncio.wait(
+                        running, timeout=settings.analysis_job_poll_interval,
+                        return_when=asyncio.FIRST_COMPLETED
+                    )
+                elif not claimed:
+                    await asyncio.sleep(settings.analysis_job_poll_interval)
+            except Exception as e:
+                logger.error(f"❌ Ошибка обработчика очереди анализа: {e}")
+                await asyncio.sleep(settings.analysis_job_poll_interval)
+    finally:
+        # Незавершенные задачи возвращаются в очередь и достанутся другому процессу
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running, return_exceptions=True)
@@ -0,0 +1,306 @@
+"""
+Фоновая загрузка вложений писем и извлечение из них текста.
+
+При приеме почты сохраняются только описания вложений из BODYSTRUCTURE, поэтому
+прием письма не ждет вложений. Здесь вложение потоково, частями
+BODY.PEEK[section]<offset.size>, записывается на диск (в память целиком не
+попадает), а текст PDF/DOCX/TXT извлекается в пуле процессов mail_parser.
+Для одинаковых файлов (по sha256 содержимого) текст берется из уже разобранного.
+"""
+import asyncio
+import base64
+import binascii
+import hashlib
+import logging
+import os
+import quopri
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import Dict, List, Optional, Set
+
+from sqlalchemy import func
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import Letter, LetterAttachment, LetterStatus
+from app.services.analysis_queue import analysis_queue
+from app.services.attachment_text import UnsupportedAttachment, attachment_kind, extract_text
+from app.services.letter_service import LetterService
+from app.services.mail_parser import ParseTimeout, mail_parser
+from app.services.mail_service import YandexMailService, mailboxes
+
+logger = logging.getLogger(__name__)
+
+# Вложение в processing дольше этого считается брошенным упавшим процессом
+STALE_AFTER = timedelta(minutes=15)
+
+
+class AttachmentTooLarge(Exception):
+    """Вложение больше attachment_max_bytes"""
+
+
+class AttachmentGone(Exception):
+    """Письмо удалено или UIDVALIDITY папки изменился"""
+
+
+class _StreamDecoder:
+    """Снятие Content-Transfer-Encoding по частям"""
+
+    def __init__(self, encoding: Optional[str]):
+        self.encoding = encoding
+        self._rest = b''
+
+    def feed(self, data: bytes) -> bytes:
+        if self.encoding == 'base64':
+            data = self._rest + b''.join(data.split())
+            cut = len(data) - len(data) % 4
+            self._rest = data[cut:]
+            return base64.b64decode(data[:cut])
+        if self.encoding == 'quoted-printable':
+            # Декодируем только завершенные строки: мягкий перенос "=" может оказаться на границе части
+            data = self._rest + data
+            cut = data.rfind(b'\n') + 1
+            self._rest = data[cut:]
+            return quopri.decodestring(data[:cut])
+        return data
+
+    def flush(self) -> bytes:
+        rest, self._rest = self._rest, b''
+        if not rest:
+            return b''
+        if self.encoding == 'base64':
+            try:
+                return base64.b64decode(rest + b'=' * (-len(rest) % 4))
+            except binascii.Error:
+                return b''
+        if self.encoding == 'quoted-printable':
+            return quopri.decodestring(rest)
+        return rest
+
+
+class AttachmentService:
+    """Выборка вложений из очереди, загрузка, извлечение текста"""
+
+    @staticmethod
+    def claim(db: Session, limit: int) -> List[LetterAttachment]:
+        """Захват ожидающих вложений (SKIP LOCKED) с возвратом брошенных"""
+        db.query(LetterAttachment).filter(
+            LetterAttachment.status == "processing",
+            LetterAttachment.locked_at < datetime.now(timezone.utc) - STALE_AFTER
+        ).update({"status": "pending", "locked_at": None}, synchronize_session=False)
+
+        attachments = (
+            db.query(LetterAttachment)
+            .filter(LetterAttachment.status == "pending")
+            .order_by(LetterAttachment.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for attachment in attachments:
+            attachment.status = "processing"
+            attachment.attempts += 1
+            attachment.locked_at = func.now()
+        db.commit()
+        return attachments
+
+    @staticmethod
+    def _mailbox(account: str, mailbox: str) -> Optional[YandexMailService]:
+        """Настроенная папка, из которой получено письмо (нужны учетные данные)"""
+        for mail in mailboxes:
+            if mail.login == account and mail.mailbox == mailbox:
+                return mail
+        return None
+
+    @staticmethod
+    def _download(client, attachment: LetterAttachment) -> tuple[str, str]:
+        """Потоковая загрузка вложения на диск; возвращает (sha256, путь)"""
+        limit = settings.attachment_max_bytes
+        chunk = settings.attachment_fetch_chunk_bytes
+        os.makedirs(settings.attachments_dir, exist_ok=True)
+
+        decoder = _StreamDecoder(attachment.encoding)
+        digest = hashlib.sha256()
+        size = 0
+        offset = 0
+        fd, tmp_path = tempfile.mkstemp(dir=settings.attachments_dir, suffix=".part")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                while True:
+                    response = client.fetch(
+                        [attachment.uid], [f"BODY.PEEK[{attachment.section}]<{offset}.{chunk}>"]
+                    )
+                    if attachment.uid not in response:
+                        raise AttachmentGone("письмо удалено из папки")
+                    piece = YandexMailService._section_data(response[attachment.uid], attachment.section)
+                    offset += len(piece)
+                    last = len(piece) < chunk
+                    data = decoder.feed(piece) + (decoder.flush() if last else b'')
+                    size += len(data)
+                    if size > limit:
+                        raise AttachmentTooLarge(f"больше {limit} байт")
+                    digest.update(data)
+                    f.write(data)
+                    if last:
+                        break
+
+            content_hash = digest.hexdigest()
+            # Файлы хранятся по хэшу содержимого: одинаковые вложения — один файл
+            path = os.path.join(settings.attachments_dir, content_hash[:2], content_hash)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                os.remove(tmp_path)
+            else:
+                os.replace(tmp_path, path)
+            return content_hash, path
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+
+    @staticmethod
+    def _extract(db: Session, attachment: LetterAttachment, kind: str) -> str:
+        """Текст вложения; для уже разобранного содержимого — из кэша"""
+        cached = db.query(LetterAttachment.extracted_text).filter(
+            LetterAttachment.content_hash == attachment.content_hash,
+            LetterAttachment.status.in_(("done", "no_text")),
+            LetterAttachment.id != attachment.id
+        ).first()
+        if cached:
+            return cached.extracted_text or ""
+        return mail_parser.call(
+            extract_text, attachment.storage_path, kind,
+            settings.attachment_max_text_chars, attachment.charset
+        )
+
+    def _process(self, db: Session, client, uidvalidity: Optional[int], attachment: LetterAttachment):
+        """Загрузка и разбор одного вложения; статус записывается в attachment"""
+        # Размер в письме — до снятия base64, поэтому сравниваем с запасом
+        if attachment.size > settings.attachment_max_bytes * 4 // 3 + 4:
+            raise AttachmentTooLarge(f"больше {settings.attachment_max_bytes} байт")
+        if attachment.uidvalidity and uidvalidity and attachment.uidvalidity != uidvalidity:
+            raise AttachmentGone("UIDVALIDITY папки изменился")
+
+        attachment.content_hash, attachment.storage_path = self._download(client, attachment)
+        kind = attachment_kind(attachment.content_type, attachment.filename)
+        if kind is None:
+            # Файл сохранен, но текст из такого формата не извлекается
+            attachment.status = "unsupported"
+            return
+        text = self._extract(db, attachment, kind)
+        attachment.extracted_text = text or None
+        attachment.status = "done" if text else "no_text"
+
+    def _finish(self, db: Session, attachment: LetterAttachment, status: Optional[str] = None, error: Optional[str] = None):
+        if status:
+            attachment.status = status
+        if error:
+            attachment.error = error[:2000]
+        attachment.locked_at = None
+        attachment.processed_at = func.now()
+        db.commit()
+
+    def _process_mailbox(self, db: Session, account: str, mailbox: str, attachments: List[LetterAttachment]) -> Set[int]:
+        """Вложения одной папки по отдельному соединению; возвращает письма с новым текстом"""
+        mail = self._mailbox(account, mailbox)
+        if mail is None:
+            for attachment in attachments:
+                self._finish(db, attachment, "failed", f"Папка {account}/{mailbox} не настроена")
+            return set()
+
+        letters_with_text: Set[int] = set()
+        client = mail.create_client()
+        try:
+            folder = client.select_folder(mailbox, readonly=True)
+            uidvalidity = folder.get(b'UIDVALIDITY')
+            for attachment in attachments:
+                try:
+                    self._process(db, client, uidvalidity, attachment)
+                    if attachment.status == "done":
+                        letters_with_text.add(attachment.letter_id)
+                    self._finish(db, attachment)
+                except AttachmentTooLarge as e:
+                    self._finish(db, attachment, "skipped", str(e))
+                except AttachmentGone as e:
+                    self._finish(db, attachment, "expired", str(e))
+                except (UnsupportedAttachment, ParseTimeout, TimeoutError) as e:
+                    self._finish(db, attachment, "unsupported", str(e) or e.__class__.__name__)
+                except Exception as e:
+                    db.rollback()
+                    retry = attachment.attempts < settings.attachment_max_attempts
+                    logger.warning(f"⚠️ Вложение #{attachment.id} ({attachment.filename}) не обработано: {e}")
+                    self._finish(db, attachment, "pending" if retry else "failed", str(e) or e.__class__.__name__)
+        finally:
+            try:
+                client.logout()
+            except Exception:
+                pass
+        return letters_with_text
+
+    @staticmethod
+    def _requeue_analysis(db: Session, letter_ids: Set[int]):
+        """Повторный анализ писем, проанализированных без текста вложений.
+
+        Только письма во входящих (NEW) и в анализе (ANALYZING): анализ сбрасывает
+        статус, SLA, дедлайн и маршрут согласования, а письмо в работе их уже
+        получило. Идущий анализ мог прочитать письмо до появления текста вложений —
+        очередь повторит его после завершения.
+        """
+        if settings.attachment_analysis_token_budget <= 0:
+            return
+        letters = db.query(Letter).filter(
+            Letter.id.in_(letter_ids),
+            Letter.status.in_((LetterStatus.NEW, LetterStatus.ANALYZING))
+        ).all()
+        for letter in letters:
+            if letter.status == LetterStatus.ANALYZING or LetterService.analysis_outdated(db, letter):
+                analysis_queue.enqueue(db, letter.id)
+                logger.info(f"📎 Письмо #{letter.id} поставлено на повторный анализ с текстом вложений")
+
+    def run_cycle(self, db: Session) -> int:
+        """Один цикл: захват, загрузка, разбор; возвращает число обработанных вложений"""
+        attachments = self.claim(db, settings.attachment_batch_size)
+        groups: Dict[tuple, List[LetterAttachment]] = {}
+        for attachment in attachments:
+            groups.setdefault((attachment.account, attachment.mailbox), []).append(attachment)
+
+        letters_with_text: Set[int] = set()
+        for (account, mailbox), group in groups.items():
+            try:
+                letters_with_text |= self._process_mailbox(db, account, mailbox, group)
+            except Exception as e:
+                # Нет соединения с ящиком: вложения вернутся в очередь
+                db.rollback()
+                logger.error(f"❌ Ошибка загрузки вложений из {account}/{mailbox}: {e}")
+                for attachment in group:
+                    if attachment.status == "processing":
+                        retry = attachment.attempts < settings.attachment_max_attempts
+                        self._finish(db, attachment, "pending" if retry else "failed", str(e))
+
+        if letters_with_text:
+            self._requeue_analysis(db, letters_with_text)
+        if attachments:
+            logger.info(f"📎 Обработано вложений: {len(attachments)}")
+        return len(attachments)
+
+
+attachment_service = AttachmentService()
+
+
+async def run_attachment_extraction(db_session_factory, interval_seconds: Optional[float] = None):
+    """Фоновая задача загрузки вложений и извлечения текста"""
+    interval_seconds = interval_seconds or settings.attachment_poll_interval
+    logger.info("📎 Запущена обработка вложений писем")
+    while True:
+        try:
+            db: Session = next(db_session_factory())
+            try:
+                processed = await asyncio.to_thread(attachment_service.run_cycle, db)
+            finally:
+                db.close()
+
+            if not processed:
+                await asyncio.sleep(interval_seconds)
+        except Exception as e:
+            logger.error(f"❌ Ошибка обработки вложений: {e}")
+            await asyncio.sleep(interval_seconds)
@@ -0,0 +1,111 @@
+"""
+Извлечение текста из вложений: PDF с текстовым слоем, DOCX и TXT.
+
+Функции выполняются в пуле процессов mail_parser и работают с файлом на диске,
+чтобы вложение не загружалось в память целиком. Сканы (PDF без текстового слоя)
+дают пустой текст.
+"""
+import os
+import zipfile
+from typing import Optional
+from xml.etree import ElementTree
+
+# Предел распакованного document.xml в DOCX (защита от zip-бомб)
+DOCX_XML_LIMIT = 50 * 1024 * 1024
+
+WORD_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+
+KINDS = {
+    "application/pdf": "pdf",
+    "application/vnd.openxmlformats-officedocument.wordprocessingml.document": "docx",
+    "text/plain": "txt",
+}
+EXTENSIONS = {".pdf": "pdf", ".docx": "docx", ".txt": "txt"}
+
+
+class UnsupportedAttachment(Exception):
+    """Формат вложения не поддерживается, файл поврежден (или не установлен pypdf)"""
+
+
+def attachment_kind(content_type: str, filename: str) -> Optional[str]:
+    """pdf / docx / txt по типу содержимого, для application/octet-stream — по расширению"""
+    kind = KINDS.get((content_type or "").lower())
+    if kind:
+        return kind
+    return EXTENSIONS.get(os.path.splitext(filename or "")[1].lower())
+
+
+def _pdf_text(path: str, max_chars: int) -> str:
+    try:
+        from pypdf import PdfReader
+        from pypdf.errors import PyPdfError
+    except ImportError:
+        raise UnsupportedAttachment("для PDF нужен пакет pypdf")
+
+    try:
+        reader = PdfReader(path)
+        pages = []
+        total = 0
+        for page in reader.pages:
+            text = (page.extract_text() or "").strip()
+            if text:
+                pages.append(text)
+                total += len(text)
+            if total >= max_chars:
+                break
+    except (PyPdfError, ValueError, KeyError, TypeError) as e:
+        # Поврежденный PDF: повторная попытка даст ту же ошибку
+        raise UnsupportedAttachment(f"PDF поврежден: {e.__class__.__name__}: {e}")
+    return "\n\n".join(pages)
+
+
+def _docx_text(path: str, max_chars: int) -> str:
+    try:
+        return _docx_paragraphs(path, max_chars)
+    except (zipfile.BadZipFile, KeyError, ElementTree.ParseError) as e:
+        # Не ZIP, нет word/document.xml или битый XML: повторная попытка даст ту же ошибку
+        raise UnsupportedAttachment(f"DOCX поврежден: {e.__class__.__name__}: {e}")
+
+
+def _docx_paragraphs(path: str, max_chars: int) -> str:
+    with zipfile.ZipFile(path) as archive:
+        info = archive.getinfo("word/document.xml")
+        if info.file_size > DOCX_XML_LIMIT:
+            raise UnsupportedAttachment("document.xml слишком большой")
+        paragraphs = []
+        total = 0
+        with archive.open(info) as document:
+            # Потоковый разбор: абзацы собираются по мере чтения
+            for event, element in ElementTree.iterparse(document, events=("end",)):
+                if element.tag != f"{WORD_NS}p":
+                    continue
+                text = "".join(node.text or "" for node in element.iter(f"{WORD_NS}t")).strip()
+                element.clear()
+                if text:
+                    paragraphs.append(text)
+                    total += len(text)
+                if total >= max_chars:
+                    break
+    return "\n".join(paragraphs)
+
+
+def _txt_text(path: str, max_chars: int, charset: Optional[str]) -> str:
+    with open(path, "rb") as f:
+        data = f.read(max_chars * 4)
+    try:
+        return data.decode(charset or "utf-8", errors="ignore")
+    except LookupError:
+        return data.decode("utf-8", errors="ignore")
+
+
+def extract_text(path: str, kind: str, max_chars: int, charset: Optional[str] = None) -> str:
+    """Текст вложения (не длиннее max_chars)"""
+    if kind == "pdf":
+        text = _pdf_text(path, max_chars)
+    elif kind == "docx":
+        text = _docx_text(path, max_chars)
+    elif kind == "txt":
+        text = _txt_text(path, max_chars, charset)
+    else:
+        raise UnsupportedAttachment(f"формат {kind} не поддерживается")
+    return text.strip()[:max_chars]
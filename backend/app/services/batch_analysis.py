@@ -0,0 +1,315 @@
+"""
+Пакетный анализ писем через асинхронные операции Yandex GPT (completionAsync).
+
+Подходит для бэклога и ночной переобработки: запросы отправляются пачкой,
+результаты забираются опросом операций. Состояние хранится в таблице
+batch_analysis_items, поэтому после перезапуска обработка продолжается.
+"""
+import asyncio
+import json
+import logging
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy import func, or_
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.models import BatchAnalysisItem, Letter
+from app.services.letter_service import LetterService
+from app.services.single_flight import letter_single_flight
+from app.services.yandex_gpt import yandex_gpt_service, DRAFT_TONES
+from app.services.llm_circuit_breaker import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+STAGE_ANALYSIS = "analysis"
+STAGE_DRAFTS = "drafts"
+
+ACTIVE_STATUSES = ("pending", "submitted")
+
+# Захват элемента дольше этого считается брошенным упавшим процессом
+STALE_AFTER = timedelta(minutes=10)
+
+
+class YandexOperationAPI:
+    """Асинхронные операции Yandex GPT"""
+
+    async def submit(self, stage: str, prompt: str, system_prompt: str) -> str:
+        return await yandex_gpt_service.submit_operation(prompt, system_prompt)
+
+    async def get(self, operation_id: str) -> Optional[str]:
+        return await yandex_gpt_service.get_operation(operation_id)
+
+
+class StubOperationAPI:
+    """Локальная заглушка: операции завершаются через delay секунд
+    валидным по схеме ответом (для проверки конвейера без Yandex Cloud)"""
+
+    def __init__(self, delay: float = 2.0):
+        self.delay = delay
+        self._operations: Dict[str, tuple[float, str]] = {}
+
+    async def submit(self, stage: str, prompt: str, system_prompt: str) -> str:
+        if stage == STAGE_ANALYSIS:
+            result = yandex_gpt_service.default_analysis()
+        else:
+            result = {tone: f"Тестовый ответ ({title})" for tone, (title, _, _) in DRAFT_TONES.items()}
+        operation_id = f"stub-{uuid.uuid4().hex}"
+        self._operations[operation_id] = (
+            time.monotonic() + self.delay,
+            json.dumps(result, ensure_ascii=False)
+        )
+        return operation_id
+
+    async def get(self, operation_id: str) -> Optional[str]:
+        if operation_id not in self._operations:
+            raise RuntimeError(f"Операция {operation_id} не найдена")
+        ready_at, text = self._operations[operation_id]
+        if time.monotonic() < ready_at:
+            return None
+        del self._operations[operation_id]
+        return text
+
+
+class BatchAnalysisService:
+    """Очередь пакетного анализа: постановка, отправка операций, опрос и сохранение"""
+
+    def __init__(self, operation_api):
+        self.api = operation_api
+
+    @staticmethod
+    def enqueue(db: Session, letter_ids: Optional[List[int]] = None, include_analyzed: bool = False) -> int:
+        """Постановка писем в очередь; письма с незавершенной обработкой пропускаются"""
+        query = db.query(Letter.id)
+        if letter_ids:
+            query = query.filter(Letter.id.in_(letter_ids))
+        elif not include_analyzed:
+            query = query.filter(or_(
+                Letter.classification_data.is_(None),
+                Letter.needs_reanalysis == True
+            ))
+
+        active = db.query(BatchAnalysisItem.letter_id).filter(
+            BatchAnalysisItem.status.in_(ACTIVE_STATUSES)
+        )
+        ids = [row.id for row in query.filter(~Letter.id.in_(active)).all()]
+        for letter_id in ids:
+            db.add(BatchAnalysisItem(letter_id=letter_id))
+        db.commit()
+        if ids:
+            logger.info(f"📦 В пакетный анализ поставлено писем: {len(ids)}")
+        return len(ids)
+
+    @staticmethod
+    def get_status(db: Session) -> Dict[str, Any]:
+        """Количество элементов очереди по этапам и статусам"""
+        counts: Dict[str, Dict[str, int]] = {}
+        for item in db.query(BatchAnalysisItem.stage, BatchAnalysisItem.status).all():
+            stage = counts.setdefault(item.stage, {})
+            stage[item.status] = stage.get(item.status, 0) + 1
+        return counts
+
+    def _fail(self, item: BatchAnalysisItem, error: str):
+        """Ошибка операции: повторная отправка или перевод в failed"""
+        item.attempts += 1
+        item.error = error[:2000]
+        item.operation_id = None
+        item.status = "failed" if item.attempts >= settings.batch_analysis_max_attempts else "pending"
+        if item.status == "failed":
+            logger.error(f"❌ Пакетный анализ письма {item.letter_id} не удался: {error}")
+
+    def _complete(self, db: Session, item: BatchAnalysisItem, letter: Letter, text: str):
+        """Сохранение результата операции в письмо"""
+        if item.stage == STAGE_ANALYSIS:
+            analysis = yandex_gpt_service.parse_analysis(text) or yandex_gpt_service.default_analysis()
+            analysis = LetterService.align_with_thread(db, letter, analysis)
+            LetterService.apply_analysis(letter, analysis, LetterService.in_workflow(letter))
+            letter.needs_reanalysis = False
+            item.analysis = analysis
+            # Для уведомлений ответ не требуется
+            if analysis.get("classification", {}).get("type") == "notification":
+                letter.draft_responses = None
+                letter.analysis_fingerprint = LetterService.analysis_fingerprint(db, letter)
+                item.status = "done"
+            else:
+                item.stage = STAGE_DRAFTS
+                item.status = "pending"
+            item.operation_id = None
+        else:
+            drafts = yandex_gpt_service.parse_drafts(text)
+            if drafts is None:
+                drafts = yandex_gpt_service.fallback_responses(letter.subject, item.analysis or {})
+            letter.draft_responses = drafts
+            letter.analysis_fingerprint = LetterService.analysis_fingerprint(db, letter)
+            item.status = "done"
+
+    @staticmethod
+    def _claim(db: Session, status: str, limit: int) -> List[int]:
+        """Захват элементов на время запросов к API (locked_at).
+
+        Транзакция с FOR UPDATE только ставит отметку и сразу фиксируется:
+        блокировки строк и соединение пула не удерживаются на время сетевых
+        запросов, а другой процесс пропускает захваченные элементы.
+        """
+        items = (
+            db.query(BatchAnalysisItem)
+            .filter(
+                BatchAnalysisItem.status == status,
+                or_(
+                    BatchAnalysisItem.locked_at.is_(None),
+                    BatchAnalysisItem.locked_at < datetime.now(timezone.utc) - STALE_AFTER
+                )
+            )
+            .order_by(BatchAnalysisItem.id)
+            .limit(limit)
+            .with_for_update(skip_locked=True)
+            .all()
+        )
+        for item in items:
+            item.locked_at = func.now()
+        item_ids = [item.id for item in items]
+        db.commit()
+        return item_ids
+
+    @staticmethod
+    def _release(db: Session, item_ids: List[int]):
+        """Снятие захвата без изменения статуса"""
+        if item_ids:
+            db.query(BatchAnalysisItem).filter(BatchAnalysisItem.id.in_(item_ids)).update(
+                {"locked_at": None}, synchronize_session=False
+            )
+        db.commit()
+
+    async def _store_result(self, db: Session, item_id: int, letter_id: int, text: str):
+        """Сохранение результата операции в письмо через single-flight.
+
+        Интерактивный анализ того же письма идет под тем же захватом, поэтому
+        результаты не перезаписывают друг друга; если письмо в это время
+        проанализировано другим вызовом, результат операции устарел.
+        """
+        async def apply():
+            item = db.get(BatchAnalysisItem, item_id)
+            letter = db.query(Letter).filter(Letter.id == letter_id).first()
+            if letter is None:
+                item.status = "failed"
+                item.error = "Письмо удалено"
+            else:
+                self._complete(db, item, letter, text)
+            item.locked_at = None
+            db.commit()
+
+        executed, _ = await letter_single_flight.run(letter_id, apply)
+        if not executed:
+            item = db.get(BatchAnalysisItem, item_id)
+            item.status = "done"
+            item.error = "Письмо проанализировано другим вызовом, результат операции не применен"
+            item.locked_at = None
+            db.commit()
+
+    async def _poll(self, db: Session) -> int:
+        """Опрос отправленных операций; возвращает число завершенных"""
+        item_ids = self._claim(db, "submitted", settings.batch_analysis_size * 4)
+        finished = 0
+        for item_id in item_ids:
+            item = db.get(BatchAnalysisItem, item_id)
+            operation_id, letter_id = item.operation_id, item.letter_id
+            # Запрос к API — вне транзакции
+            db.commit()
+            try:
+                text = await self.api.get(operation_id)
+            except Exception as e:
+                item = db.get(BatchAnalysisItem, item_id)
+                self._fail(item, f"Ошибка операции {operation_id}: {e}")
+                item.locked_at = None
+                db.commit()
+                continue
+            if text is None:
+                self._release(db, [item_id])
+                continue
+            await self._store_result(db, item_id, letter_id, text)
+            finished += 1
+        return finished
+
+    async def _submit(self, db: Session) -> int:
+        """Отправка ожидающих элементов; возвращает число отправленных операций"""
+        item_ids = self._claim(db, "pending", settings.batch_analysis_size)
+        submitted = 0
+        for index, item_id in enumerate(item_ids):
+            item = db.get(BatchAnalysisItem, item_id)
+            letter = db.query(Letter).filter(Letter.id == item.letter_id).first()
+            if letter is None:
+                item.status = "failed"
+                item.error = "Письмо удалено"
+                item.locked_at = None
+                db.commit()
+                continue
+            content = LetterService.analysis_text(db, letter)
+            stage = item.stage
+            if stage == STAGE_ANALYSIS:
+                system_prompt, prompt = yandex_gpt_service.analysis_request(letter.subject, content)
+            else:
+                system_prompt, prompt, _ = yandex_gpt_service.drafts_request(
+                    letter.subject, content, item.analysis or {}
+                )
+            # Запрос к API — вне транзакции
+            db.commit()
+            try:
+                operation_id = await self.api.submit(stage, prompt, system_prompt)
+            except CircuitOpenError:
+                # Провайдер недоступен: остальные элементы ждут следующего цикла
+                self._release(db, item_ids[index:])
+                break
+            except Exception as e:
+                item = db.get(BatchAnalysisItem, item_id)
+                self._fail(item, f"Ошибка отправки операции: {e}")
+                item.locked_at = None
+                db.commit()
+                continue
+            item = db.get(BatchAnalysisItem, item_id)
+            item.operation_id = operation_id
+            item.status = "submitted"
+            item.locked_at = None
+            db.commit()
+            submitted += 1
+        return submitted
+
+    async def run_cycle(self, db: Session) -> Dict[str, int]:
+        """Один цикл: сначала забираем готовые результаты, затем отправляем новые"""
+        finished = await self._poll(db)
+        submitted = await self._submit(db)
+        return {"finished": finished, "submitted": submitted}
+
+
+def _build_operation_api():
+    if settings.batch_analysis_api == "stub":
+        return StubOperationAPI()
+    return YandexOperationAPI()
+
+
+batch_analysis_service = BatchAnalysisService(_build_operation_api())
+
+
+async def run_batch_analysis(db_session_factory, interval_seconds: Optional[int] = None):
+    """Фоновая задача пакетного анализа"""
+    interval_seconds = interval_seconds or settings.batch_analysis_poll_interval
+    logger.info(f"📦 Запущен пакетный анализ (операции: {settings.batch_analysis_api})")
+    while True:
+        try:
+            db: Session = next(db_session_factory())
+            try:
+                result = await batch_analysis_service.run_cycle(db)
+                if result["finished"] or result["submitted"]:
+                    logger.info(
+                        f"📦 Пакетный анализ: завершено {result['finished']}, "
+                        f"отправлено {result['submitted']}"
+                    )
+            finally:
+                db.close()
+
+            await asyncio.sleep(interval_seconds)
+        except Exception as e:
+            logger.error(f"❌ Ошибка пакетного анализа: {e}")
+            await asyncio.sleep(interval_seconds)
@@ -0,0 +1,127 @@
+"""
+Сокращение текста письма перед отправкой в модель.
+
+Из тела письма убираются цитаты предыдущей переписки, подписи почтовых
+клиентов и юридические дисклеймеры. Исходный текст письма не меняется:
+результат хранится отдельно (Letter.analysis_body) и используется только
+в запросах к модели.
+"""
+import re
+from typing import List
+
+# Строки длиннее не проверяются шаблонами заголовков цитат
+MAX_HEADER_LINE = 300
+
+# Сколько строк после «С уважением» оставить: имя, должность, организация
+SIGNATURE_KEEP_LINES = 3
+# Подпись ищется только в последних строках письма: выше «--» и «С уважением» —
+# это текст письма (разделитель в перечне, обращение)
+SIGNATURE_TAIL_LINES = 15
+
+# Заголовки, после которых идет процитированное предыдущее письмо
+QUOTE_SEPARATOR = re.compile(
+    r'^\s*-{2,}\s*(original message|исходное сообщение|пересылаемое сообщение|forwarded message)\s*-{2,}\s*$',
+    re.IGNORECASE
+)
+# «Иван <a@b.ru> пишет:», «On ... wrote:», у Яндекс Почты — «15.10.2026, 12:00, "Банк" <info@bank.ru>:».
+# Цитатой считается, только если в строке есть дата или адрес, а за ней идут строки с «>»:
+# «Клиент мне написал:» в тексте жалобы — не заголовок цитаты
+QUOTE_ATTRIBUTION = re.compile(
+    r'((wrote|пишет|писал[аи]?|писал\(а\)|написал[аи]?|написал\(а\))|<[^<>\s]+@[^<>\s]+>):\s*$',
+    re.IGNORECASE
+)
+EMAIL = re.compile(r'[^\s<>@"\'\[\]():;,]+@[^\s<>@"\'\[\]():;,]+\.[a-zа-я]{2,}', re.IGNORECASE)
+DATE = re.compile(
+    r'\b\d{1,2}[./]\d{1,2}[./]\d{2,4}\b|\b\d{4}-\d{2}-\d{2}\b|\b\d{1,2}:\d{2}\b'
+    r'|\b\d{1,2}\s+(янв|фев|мар|апр|ма[йя]|июн|июл|авг|сен|окт|ноя|дек|jan|feb|mar|apr|may|jun|jul|aug|sep|oct|nov|dec)',
+    re.IGNORECASE
+)
+# Заголовок Outlook: «От: Иван <a@b.ru>» (с адресом), а в следующих строках «Отправлено: ...».
+# Без адреса «От: 12.10.2026 № 45-1» — реквизиты письма регулятора, а не цитата
+HEADER_FROM = re.compile(r'^\s*\*?(от|from)\s*:\s*\S', re.IGNORECASE)
+HEADER_SENT = re.compile(r'^\s*\*?(отправлено|дата|sent|date)\s*:\s*\S', re.IGNORECASE)
+
+SIGNATURE_DELIMITER = re.compile(r'^--\s?$')
+SIGN_OFF = re.compile(
+    r'^\s*(с уважением|с наилучшими пожеланиями|всего доброго|best regards|kind regards|regards)\b[\s,.!]*',
+    re.IGNORECASE
+)
+MOBILE_FOOTER = re.compile(
+    r'^\s*(отправлено (с|из) |sent from my |get outlook for )',
+    re.IGNORECASE
+)
+# Дисклеймер: упоминание конфиденциальности вместе с указанием адресату
+DISCLAIMER = re.compile(r'конфиденциальн|не являетесь|confidential|intended recipient', re.IGNORECASE)
+DISCLAIMER_ADDRESSEE = re.compile(
+    r'предназначен|получили (это|данное)|уничтож|удалите|intended|received this|delete',
+    re.IGNORECASE
+)
+
+
+def _followed_by_quote(lines: List[str], index: int) -> bool:
+    """Первая непустая строка после index — процитированная («>»)"""
+    for line in lines[index + 1:]:
+        if line.strip():
+            return line.lstrip().startswith('>')
+    return False
+
+
+def _quote_start(lines: List[str]) -> int:
+    """Номер строки, с которой начинается цитата предыдущего письма (или len(lines))"""
+    for index, line in enumerate(lines):
+        if len(line) > MAX_HEADER_LINE:
+            continue
+        if QUOTE_SEPARATOR.match(line):
+            return index
+        if (QUOTE_ATTRIBUTION.search(line) and (EMAIL.search(line) or DATE.search(line))
+                and _followed_by_quote(lines, index)):
+            return index
+        if (HEADER_FROM.match(line) and EMAIL.search(line)
+                and any(HEADER_SENT.match(next_line) for next_line in lines[index + 1:index + 5])):
+            return index
+    return len(lines)
+
+
+def _strip_signature(lines: List[str]) -> List[str]:
+    """Отрезание подписи: после «-- » целиком, после «С уважением» — кроме первых строк"""
+    tail = max(0, len(lines) - SIGNATURE_TAIL_LINES)
+    for index in range(tail, len(lines)):
+        if SIGNATURE_DELIMITER.match(lines[index]):
+            return lines[:index]
+    # Прощание ищем только в конце письма: в начале это может быть обращение
+    for index in range(len(lines) - 1, tail - 1, -1):
+        if SIGN_OFF.match(lines[index]):
+            kept = []
+            for line in lines[index + 1:]:
+                if len(kept) >= SIGNATURE_KEEP_LINES:
+                    break
+                if line.strip():
+                    kept.append(line)
+            return lines[:index + 1] + kept
+    return lines
+
+
+def _strip_disclaimers(text: str) -> str:
+    """Удаление дисклеймеров в конце письма (первый абзац — всегда текст письма)"""
+    paragraphs = re.split(r'\n\s*\n', text)
+    while len(paragraphs) > 1 and DISCLAIMER.search(paragraphs[-1]) and DISCLAIMER_ADDRESSEE.search(paragraphs[-1]):
+        paragraphs.pop()
+    return '\n\n'.join(paragraphs)
+
+
+def compact_body(body: str) -> str:
+    """Текст письма без цитат, подписей и дисклеймеров.
+
+    Если после очистки ничего не осталось (например, пересланное письмо
+    без комментария), возвращается исходный текст.
+    """
+    original = (body or '').replace('\r\n', '\n').strip()
+    lines = original.split('\n')
+
+    lines = lines[:_quote_start(lines)]
+    lines = [line for line in lines if not line.lstrip().startswith('>') and not MOBILE_FOOTER.match(line)]
+    lines = _strip_signature(lines)
+
+    text = _strip_disclaimers('\n'.join(lines))
+    text = re.sub(r'\n{3,}', '\n\n', text).strip()
+    return text or original
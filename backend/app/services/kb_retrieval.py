@@ -0,0 +1,297 @@
+"""
+Выбор релевантных разделов базы знаний для промпта (BM25 + стемминг, без сети)
+"""
+import math
+import re
+from collections import Counter
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional
+
+# Реквизиты и контакты нужны в любом ответе, остальное выбирается по релевантности
+BASE_SECTION = "bank_info"
+BASE_KEYS = ("full_name", "short_name", "legal_details", "contact_info")
+
+_TOKEN_RE = re.compile(r"[а-яёa-z0-9]+")
+
+_STOP_WORDS = {
+    "и", "в", "во", "не", "что", "он", "на", "я", "с", "со", "как", "а", "то", "все", "она",
+    "так", "его", "но", "да", "ты", "к", "у", "же", "вы", "за", "бы", "по", "только", "ее",
+    "мне", "было", "вот", "от", "меня", "еще", "нет", "о", "из", "ему", "теперь", "когда",
+    "даже", "ну", "ли", "если", "уже", "или", "ни", "быть", "был", "него", "до", "вас",
+    "нибудь", "опять", "уж", "вам", "ведь", "там", "потом", "себя", "ничего", "ей", "может",
+    "они", "тут", "где", "есть", "надо", "ней", "для", "мы", "тебя", "их", "чем", "была",
+    "сам", "чтоб", "без", "будто", "чего", "раз", "тоже", "себе", "под", "будет", "ж",
+    "тогда", "кто", "этот", "того", "потому", "этого", "какой", "совсем", "ним", "здесь",
+    "этом", "один", "почти", "мой", "тем", "чтобы", "нее", "сейчас", "были", "куда",
+    "зачем", "всех", "никогда", "можно", "при", "наконец", "два", "об", "другой", "хоть",
+    "после", "над", "больше", "тот", "через", "эти", "нас", "про", "всего", "них", "какая",
+    "много", "разве", "три", "эту", "моя", "впрочем", "хорошо", "свою", "этой", "перед",
+    "иногда", "лучше", "чуть", "том", "нельзя", "такой", "им", "более", "всегда", "конечно",
+    "всю", "между", "это", "ваш", "ваше", "вашего", "прошу", "просим", "уважаемые",
+    "уважаемый", "здравствуйте", "добрый", "день", "спасибо", "уважением",
+}
+
+
+# --- Стеммер Портера для русского языка (Snowball) ---
+
+_VOWELS = "аеиоуыэюя"
+
+_PERFECTIVE_GERUND_1 = ("вшись", "вши", "в")
+_PERFECTIVE_GERUND_2 = ("ившись", "ывшись", "ивши", "ывши", "ив", "ыв")
+_REFLEXIVE = ("ся", "сь")
+_ADJECTIVE = (
+    "ими", "ыми", "его", "ого", "ему", "ому", "ее", "ие", "ые", "ое", "ей", "ий", "ый",
+    "ой", "ем", "им", "ым", "ом", "их", "ых", "ую", "юю", "ая", "яя", "ою", "ею",
+)
+_PARTICIPLE_1 = ("ем", "нн", "вш", "ющ", "щ")
+_PARTICIPLE_2 = ("ивш", "ывш", "ующ")
+_VERB_1 = (
+    "ете", "йте", "ешь", "нно", "ла", "на", "ли", "ем", "ло", "но", "ет", "ют", "ны",
+    "ть", "й", "л", "н",
+)
+_VERB_2 = (
+    "ейте", "уйте", "ила", "ыла", "ена", "ите", "или", "ыли", "ило", "ыло", "ено", "ует",
+    "уют", "ены", "ить", "ыть", "ишь", "ей", "уй", "ил", "ыл", "им", "ым", "ен", "ят",
+    "ит", "ыт", "ую", "ю",
+)
+_NOUN = (
+    "иями", "ями", "ами", "ией", "иям", "ием", "иях", "ев", "ов", "ие", "ье", "еи", "ии",
+    "ей", "ой", "ий", "ям", "ем", "ам", "ом", "ах", "ях", "ию", "ью", "ия", "ья", "а",
+    "е", "и", "й", "о", "у", "ы", "ь", "ю", "я",
+)
+_SUPERLATIVE = ("ейше", "ейш")
+_DERIVATIONAL = ("ость", "ост")
+
+
+def _strip_suffix(word: str, suffixes, after_a_ya: bool = False) -> Optional[str]:
+    for suffix in sorted(suffixes, key=len, reverse=True):
+        if word.endswith(suffix):
+            stem = word[:-len(suffix)]
+            if after_a_ya and not stem.endswith(("а", "я")):
+                continue
+            return stem
+    return None
+
+
+def _regions(word: str) -> tuple[int, int]:
+    """Начала областей RV и R2 по правилам Snowball"""
+    rv = len(word)
+    for i, ch in enumerate(word):
+        if ch in _VOWELS:
+            rv = i + 1
+            break
+
+    def after_vc(start: int) -> int:
+        for i in range(start, len(word) - 1):
+            if word[i] in _VOWELS and word[i + 1] not in _VOWELS:
+                return i + 2
+        return len(word)
+
+    r1 = after_vc(0)
+    return rv, after_vc(r1)
+
+
+def stem(word: str) -> str:
+    """Основа русского слова; латиница и числа возвращаются без изменений"""
+    word = word.lower().replace("ё", "е")
+    if not re.fullmatch(r"[а-я]+", word):
+        return word
+
+    rv, r2 = _regions(word)
+    prefix, rv_part = word[:rv], word[rv:]
+
+    # Шаг 1
+    stemmed = (_strip_suffix(rv_part, _PERFECTIVE_GERUND_1, after_a_ya=True)
+               or _strip_suffix(rv_part, _PERFECTIVE_GERUND_2))
+    if stemmed is not None:
+        rv_part = stemmed
+    else:
+        rv_part = _strip_suffix(rv_part, _REFLEXIVE) or rv_part
+        adjective = _strip_suffix(rv_part, _ADJECTIVE)
+        if adjective is not None:
+            rv_part = (_strip_suffix(adjective, _PARTICIPLE_1, after_a_ya=True)
+                       or _strip_suffix(adjective, _PARTICIPLE_2)
+                       or adjective)
+        else:
+            verb = (_strip_suffix(rv_part, _VERB_1, after_a_ya=True)
+                    or _strip_suffix(rv_part, _VERB_2))
+            if verb is not None:
+                rv_part = verb
+            else:
+                rv_part = _strip_suffix(rv_part, _NOUN) or rv_part
+
+    # Шаг 2
+    if rv_part.endswith("и"):
+        rv_part = rv_part[:-1]
+
+    # Шаг 3: словообразовательный суффикс в R2
+    r2_in_rv = max(0, r2 - rv)
+    for suffix in _DERIVATIONAL:
+        if rv_part.endswith(suffix) and len(rv_part) - len(suffix) >= r2_in_rv:
+            rv_part = rv_part[:-len(suffix)]
+            break
+
+    # Шаг 4
+    if rv_part.endswith("нн"):
+        rv_part = rv_part[:-1]
+    else:
+        superlative = _strip_suffix(rv_part, _SUPERLATIVE)
+        if superlative is not None:
+            rv_part = superlative
+            if rv_part.endswith("нн"):
+                rv_part = rv_part[:-1]
+        elif rv_part.endswith("ь"):
+            rv_part = rv_part[:-1]
+
+    return prefix + rv_part
+
+
+def tokenize(text: str) -> List[str]:
+    """Токены для индекса: нижний регистр, без стоп-слов, после стемминга"""
+    return [
+        stem(token)
+        for token in _TOKEN_RE.findall(text.lower())
+        if token not in _STOP_WORDS and len(token) > 1
+    ]
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов модели (~3 символа на токен для русского текста)"""
+    return len(text) // 3 + 1
+
+
+# --- Разделы базы знаний ---
+
+def _render(value: Any, indent: int = 0) -> List[str]:
+    """Компактное построчное представление фрагмента JSON"""
+    pad = "  " * indent
+    lines: List[str] = []
+    if isinstance(value, dict):
+        for key, item in value.items():
+            if isinstance(item, list) and not any(isinstance(x, (dict, list)) for x in item):
+                lines.append(f"{pad}{key}: {'; '.join(str(x) for x in item)}")
+            elif isinstance(item, (dict, list)):
+                lines.append(f"{pad}{key}:")
+                lines.extend(_render(item, indent + 1))
+            else:
+                lines.append(f"{pad}{key}: {item}")
+    elif isinstance(value, list):
+        for item in value:
+            if isinstance(item, (dict, list)):
+                lines.append(f"{pad}-")
+                lines.extend(_render(item, indent + 1))
+            else:
+                lines.append(f"{pad}- {item}")
+    else:
+        lines.append(f"{pad}{value}")
+    return lines
+
+
+def _flatten_text(value: Any) -> str:
+    """Все ключи и значения фрагмента одной строкой (для индексации)"""
+    if isinstance(value, dict):
+        return " ".join(f"{key} {_flatten_text(item)}" for key, item in value.items())
+    if isinstance(value, list):
+        return " ".join(_flatten_text(item) for item in value)
+    return str(value)
+
+
+@dataclass(frozen=True)
+class KBSection:
+    key: str  # например credit_products.mortgage
+    text: str  # текст для промпта
+    tokens: int
+
+
+class KnowledgeBaseIndex:
+    """BM25-индекс по разделам второго уровня базы знаний"""
+
+    k1 = 1.5
+    b = 0.75
+
+    def __init__(self, kb: Dict[str, Any]):
+        self.base: Optional[KBSection] = None
+        self.sections: List[KBSection] = []
+        self._term_freqs: List[Counter] = []
+        self._lengths: List[int] = []
+
+        for section_key, section in kb.items():
+            if isinstance(section, dict):
+                parts = list(section.items())
+            else:
+                parts = [(None, section)]
+
+            if section_key == BASE_SECTION and isinstance(section, dict):
+                base = {key: section[key] for key in BASE_KEYS if key in section}
+                text = "\n".join([f"[{section_key}]", *_render(base)])
+                self.base = KBSection(section_key, text, estimate_tokens(text))
+                parts = [(key, part) for key, part in parts if key not in BASE_KEYS]
+
+            for part_key, part in parts:
+                key = f"{section_key}.{part_key}" if part_key else section_key
+                text = "\n".join([f"[{key}]", *_render(part)])
+                terms = tokenize(f"{key.replace('_', ' ')} {_flatten_text(part)}")
+                self.sections.append(KBSection(key, text, estimate_tokens(text)))
+                self._term_freqs.append(Counter(terms))
+                self._lengths.append(len(terms))
+
+        self._avg_length = (sum(self._lengths) / len(self._lengths)) if self._lengths else 0.0
+        doc_freq: Counter = Counter()
+        for freqs in self._term_freqs:
+            doc_freq.update(freqs.keys())
+        total = len(self.sections)
+        self._idf = {
+            term: math.log(1 + (total - df + 0.5) / (df + 0.5))
+            for term, df in doc_freq.items()
+        }
+
+    def score(self, query: str) -> List[tuple[float, KBSection]]:
+        """Разделы с ненулевой релевантностью, по убыванию"""
+        query_terms = set(tokenize(query))
+        scored = []
+        for section, freqs, length in zip(self.sections, self._term_freqs, self._lengths):
+            score = 0.0
+            norm = self.k1 * (1 - self.b + self.b * length / (self._avg_length or 1))
+            for term in query_terms:
+                tf = freqs.get(term)
+                if tf:
+                    score += self._idf[term] * tf * (self.k1 + 1) / (tf + norm)
+            if score > 0:
+                scored.append((score, section))
+        scored.sort(key=lambda item: item[0], reverse=True)
+        return scored
+
+    def select(self, query: str, top_k: int, token_budget: int,
+               min_score_ratio: float = 0.0) -> List[KBSection]:
+        """Базовый раздел плюс до top_k релевантных разделов в пределах бюджета токенов.
+
+        Разделы со score ниже min_score_ratio от лучшего отбрасываются, поэтому
+        на простых письмах в промпт попадает только самое нужное.
+        """
+        selected: List[KBSection] = []
+        used = 0
+        if self.base is not None:
+            selected.append(self.base)
+            used = self.base.tokens
+
+        scored = self.score(query)
+        threshold = scored[0][0] * min_score_ratio if scored else 0.0
+        picked = 0
+        for score, section in scored:
+            if picked >= top_k or score < threshold:
+                break
+            if used + section.tokens > token_budget:
+                continue
+            selected.append(section)
+            used += section.tokens
+            picked += 1
+        return selected
+
+    def prompt_block(self, query: str, top_k: int, token_budget: int,
+                     min_score_ratio: float = 0.0) -> str:
+        """Блок базы знаний для промпта из выбранных разделов"""
+        sections = self.select(query, top_k, token_budget, min_score_ratio)
+        if not sections:
+            return ""
+        body = "\n\n".join(section.text for section in sections)
+        return f"\n\n=== БАЗА ЗНАНИЙ БАНКА (релевантные разделы) ===\n\n{body}\n"
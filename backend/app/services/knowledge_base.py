@@ -0,0 +1,196 @@
+"""
+База знаний банка: скомпилированный блок промпта с версией и горячей перезагрузкой
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Dict, Optional
+
+from app.config import settings
+from app.services.kb_retrieval import KnowledgeBaseIndex
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_KB_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(__file__))), "knowledge_base.json"
+)
+
+
+def compile_prompt_block(kb: Dict[str, Any]) -> str:
+    """Форматирование базы знаний для промпта"""
+    if not kb:
+        return ""
+    
+    kb_text = "\n\n=== БАЗА ЗНАНИЙ БАНКА ===\n\n"
+    
+    # Основная информация о банке
+    if "bank_info" in kb:
+        info = kb["bank_info"]
+        kb_text += f"**{info.get('full_name')}**\n"
+        kb_text += f"Краткое название: {info.get('short_name')}\n"
+        kb_text += f"Слоган: {info.get('slogan')}\n\n"
+        
+        if "legal_details" in info:
+            legal = info["legal_details"]
+            kb_text += f"ИНН: {legal.get('inn')}, КПП: {legal.get('kpp')}\n"
+            kb_text += f"ОГРН: {legal.get('ogrn')}, БИК: {legal.get('bik')}\n"
+            kb_text += f"Юр. адрес: {legal.get('legal_address')}\n\n"
+        
+        if "contact_info" in info:
+            contact = info["contact_info"]
+            kb_text += f"Телефон: {contact.get('main_phone')}\n"
+            kb_text += f"Email: {contact.get('email_general')}\n"
+            kb_text += f"Сайт: {contact.get('website')}\n\n"
+    
+    # Кредитные продукты
+    if "credit_products" in kb:
+        kb_text += "**КРЕДИТНЫЕ ПРОДУКТЫ:**\n\n"
+        credits = kb["credit_products"]
+        
+        if "consumer_loans" in credits:
+            cl = credits["consumer_loans"]
+            kb_text += f"1. {cl.get('name')}: ставка от {cl['interest_rate']['min']}%, "
+            kb_text += f"сумма от {cl['amount']['min']:,} до {cl['amount']['max']:,} руб, "
+            kb_text += f"срок до {cl['term']['max_months']} мес\n"
+        
+        if "mortgage" in credits:
+            mort = credits["mortgage"]
+            kb_text += f"2. {mort.get('name')}: ставка от {mort['programs']['standard']['interest_rate']['min']}%, "
+            kb_text += f"первый взнос от {mort['programs']['standard']['initial_payment']['min_percent']}%\n"
+        
+        if "car_loan" in credits:
+            car = credits["car_loan"]
+            kb_text += f"3. {car.get('name')}: ставка от {car['new_car']['interest_rate']['min']}%, "
+            kb_text += f"сумма до {car['new_car']['amount']['max']:,} руб\n"
+        
+        if "credit_cards" in credits:
+            cc = credits["credit_cards"]
+            kb_text += f"4. {cc.get('name')}: лимит до {cc['limit']['max']:,} руб, "
+            kb_text += f"льготный период {cc['interest_rate']['grace_period_days']} дней, кэшбэк {cc['cashback']['standard']}\n"
+        
+        kb_text += "\n"
+    
+    # Депозиты
+    if "deposit_products" in kb:
+        kb_text += "**ВКЛАДЫ:**\n\n"
+        deposits = kb["deposit_products"]
+        
+        for key, dep in deposits.items():
+            if isinstance(dep, dict) and "name" in dep:
+                rates = dep.get("interest_rate", {})
+                if isinstance(rates, dict):
+                    max_rate = max([v for v in rates.values() if isinstance(v, (int, float))], default=0)
+                    kb_text += f"- {dep['name']}: до {max_rate}% годовых\n"
+        
+        kb_text += "\n"
+    
+    # Тарифы
+    if "tariffs_and_fees" in kb:
+        kb_text += "**ОСНОВНЫЕ ТАРИФЫ:**\n"
+        tariffs = kb["tariffs_and_fees"]
+        
+        if "transfers" in tariffs:
+            kb_text += "- Переводы внутри банка: бесплатно\n"
+            kb_text += "- Переводы по СБП: бесплатно\n"
+        
+        if "account_services" in tariffs:
+            services = tariffs["account_services"]
+            if "sms_notifications" in services:
+                kb_text += f"- СМС-уведомления: {services['sms_notifications']['fee_per_month']} руб/мес\n"
+    
+    return kb_text
+
+
+@dataclass(frozen=True)
+class KnowledgeBaseArtifact:
+    """Неизменяемый результат компиляции базы знаний"""
+    data: Dict[str, Any]
+    prompt_block: str
+    index: KnowledgeBaseIndex
+    content_hash: str
+    version: int
+    path: str
+    mtime: Optional[float] = None
+    loaded_at: datetime = field(default_factory=datetime.now)
+
+    def info(self) -> Dict[str, Any]:
+        return {
+            "version": self.version,
+            "content_hash": self.content_hash,
+            "path": self.path,
+            "mtime": datetime.fromtimestamp(self.mtime).isoformat() if self.mtime else None,
+            "loaded_at": self.loaded_at.isoformat(),
+            "sections": list(self.data.keys()),
+            "prompt_block_chars": len(self.prompt_block),
+            "indexed_sections": len(self.index.sections),
+        }
+
+
+class KnowledgeBaseStore:
+    """Хранит текущий артефакт и пересобирает его только при изменении файла"""
+
+    def __init__(self, path: str, check_interval: float):
+        self.path = path
+        self.check_interval = check_interval
+        self._lock = threading.Lock()
+        self._last_check = 0.0
+        self._stat: Optional[tuple] = None
+        self._artifact = KnowledgeBaseArtifact(
+            data={}, prompt_block="", index=KnowledgeBaseIndex({}), content_hash=hashlib.sha256(b"{}").hexdigest()[:16],
+            version=0, path=path
+        )
+        self.reload(force=True)
+
+    def current(self) -> KnowledgeBaseArtifact:
+        """Актуальный артефакт; файл проверяется не чаще check_interval секунд"""
+        if time.monotonic() - self._last_check >= self.check_interval:
+            self.reload()
+        return self._artifact
+
+    def reload(self, force: bool = False) -> KnowledgeBaseArtifact:
+        """Пересборка артефакта, если изменились mtime/размер и содержимое файла"""
+        with self._lock:
+            self._last_check = time.monotonic()
+            try:
+                stat = os.stat(self.path)
+                stat_key = (stat.st_mtime_ns, stat.st_size)
+                if not force and stat_key == self._stat:
+                    return self._artifact
+
+                with open(self.path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                canonical = json.dumps(data, ensure_ascii=False, sort_keys=True)
+                content_hash = hashlib.sha256(canonical.encode("utf-8")).hexdigest()[:16]
+                self._stat = stat_key
+
+                # Файл «тронут», но содержимое не изменилось — артефакт прежний
+                if content_hash == self._artifact.content_hash:
+                    return self._artifact
+
+                self._artifact = KnowledgeBaseArtifact(
+                    data=data,
+                    prompt_block=compile_prompt_block(data),
+                    index=KnowledgeBaseIndex(data),
+                    content_hash=content_hash,
+                    version=self._artifact.version + 1,
+                    path=self.path,
+                    mtime=stat.st_mtime,
+                )
+                logger.info(
+                    f"📚 База знаний загружена: версия {self._artifact.version}, хеш {content_hash}"
+                )
+            except Exception as e:
+                # При ошибке (например, файл в процессе записи) оставляем прежнюю версию
+                logger.error(f"Ошибка загрузки базы знаний: {e}")
+            return self._artifact
+
+
+knowledge_base_store = KnowledgeBaseStore(
+    path=settings.knowledge_base_path or DEFAULT_KB_PATH,
+    check_interval=settings.knowledge_base_check_interval,
+)
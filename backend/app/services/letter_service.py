@@ -1,30 +1,258 @@
+from sqlalchemy import and_, or_
 from sqlalchemy.orm import Session
-from app.models import Letter, LetterStatus
+from app.database import SessionLocal
+from app.models import Letter, LetterAttachment, LetterStatus
 from app.schemas import LetterCreate, LetterUpdate
 from app.services.yandex_gpt import yandex_gpt_service
+from app.services.llm_circuit_breaker import llm_circuit_breaker, CircuitOpenError
+from app.services.single_flight import letter_single_flight
 from app.services.email_sender import send_email
 from app.services.priority_service import _calc_priority
+from app.services.kb_retrieval import estimate_tokens
+from app.services.body_normalizer import compact_body
+from app.config import settings
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import List, Optional, Dict, Any, AsyncIterator
+import asyncio
+import hashlib
+import logging
+import re
+
+logger = logging.getLogger(__name__)
 
 
 class LetterService:
     
     @staticmethod
-    def run_analysis_sync(db: Session, letter_id: int):
-        """Синхронный запуск асинхронного анализа для BackgroundTasks"""
-        import asyncio
+    def content_hash(subject: str, sender_email: Optional[str], body: str) -> str:
+        """Хэш содержимого для поиска дубликатов.
+
+        Нормализация совпадает с заполнением в add_letter_dedup_columns.sql:
+        адрес в нижнем регистре, переводы строк CRLF -> LF, без пробелов по краям.
+        """
+        trim = " \t\r\n"
+        normalized = "\n".join((
+            (sender_email or "").strip(trim).lower(),
+            (subject or "").strip(trim),
+            (body or "").replace("\r\n", "\n").strip(trim),
+        ))
+        return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+    
+    @staticmethod
+    def compaction_fields(body: str) -> Dict[str, Any]:
+        """Поля письма с сокращенным текстом для модели и оценкой токенов"""
+        compact = compact_body(body)
+        body_tokens = estimate_tokens(body or "")
+        return {
+            "analysis_body": compact if compact != body else None,
+            "body_tokens": body_tokens,
+            "analysis_body_tokens": estimate_tokens(compact) if compact != body else body_tokens,
+        }
+    
+    @staticmethod
+    def compaction_stats(db: Session) -> Dict[str, Any]:
+        """Экономия токенов от сокращения текста писем перед отправкой в модель"""
+        from sqlalchemy import func
+        
+        letters, body_tokens, analysis_tokens, compacted = db.query(
+            func.count(Letter.id),
+            func.coalesce(func.sum(Letter.body_tokens), 0),
+            func.coalesce(func.sum(Letter.analysis_body_tokens), 0),
+            func.count(Letter.analysis_body)
+        ).filter(Letter.body_tokens.isnot(None)).one()
+        # SUM по integer в Postgres возвращает numeric
+        body_tokens, analysis_tokens = int(body_tokens), int(analysis_tokens)
+        saved = body_tokens - analysis_tokens
+        return {
+            "letters": letters,
+            "compacted_letters": compacted,
+            "body_tokens": body_tokens,
+            "analysis_body_tokens": analysis_tokens,
+            "saved_tokens": saved,
+            "saved_ratio": round(saved / body_tokens, 3) if body_tokens else 0.0,
+        }
+    
+    @staticmethod
+    def analysis_body(letter: Letter) -> str:
+        """Текст письма для модели; для писем, принятых до сокращения, вычисляется на лету"""
+        if letter.body_tokens is None:
+            return compact_body(letter.body)
+        return letter.analysis_body or letter.body
+    
+    @staticmethod
+    def message_ids(header: Optional[str]) -> List[str]:
+        """Message-ID из заголовков In-Reply-To и References"""
+        return re.findall(r'<[^<>\s]+>', header or "")
+    
+    @staticmethod
+    def find_thread(db: Session, in_reply_to: Optional[str], references: List[str]) -> Optional[int]:
+        """Переписка письма: по In-Reply-To, затем по References начиная с последнего"""
+        candidates = list(dict.fromkeys(([in_reply_to] if in_reply_to else []) + references[::-1]))[:50]
+        if not candidates:
+            return None
+        found = {
+            message_id: thread_id or letter_id
+            for letter_id, thread_id, message_id in db.query(
+                Letter.id, Letter.thread_id, Letter.message_id
+            ).filter(Letter.message_id.in_(candidates))
+        }
+        for message_id in candidates:
+            if message_id in found:
+                return found[message_id]
+        return None
+    
+    @staticmethod
+    def adopt_replies(db: Session, letter_id: int, message_id: str, thread_id: Optional[int]):
+        """Привязка к переписке ответов, полученных раньше самого письма"""
+        replies = [
+            row.id for row in db.query(Letter.id).filter(
+                Letter.in_reply_to == message_id,
+                Letter.thread_id.is_(None),
+                Letter.id != letter_id
+            )
+        ]
+        if replies:
+            db.query(Letter).filter(
+                or_(Letter.id.in_(replies), Letter.thread_id.in_(replies))
+            ).update({"thread_id": thread_id or letter_id}, synchronize_session=False)
+    
+    @staticmethod
+    def thread_history(db: Session, letter: Letter) -> List[Letter]:
+        """Проанализированные предыдущие письма переписки, от последнего к первому"""
+        if not letter.thread_id:
+            return []
+        return db.query(Letter).filter(
+            or_(
+                Letter.id == letter.thread_id,
+                and_(Letter.thread_id == letter.thread_id, Letter.id < letter.id)
+            ),
+            Letter.id != letter.id,
+            Letter.classification_data.isnot(None)
+        ).order_by(Letter.id.desc()).limit(settings.thread_summary_letters).all()
+    
+    @staticmethod
+    def thread_summary(history: List[Letter]) -> str:
+        """Краткое содержание переписки из сохраненных результатов анализа"""
+        lines = []
+        for item in reversed(history):
+            classification = item.classification_data or {}
+            line = f"- {item.subject} (тип: {classification.get('type', 'other')}, SLA: {item.sla_hours} ч)"
+            summary = (item.extracted_entities or {}).get("request_summary")
+            if summary:
+                line += f": {summary}"
+            if item.final_response:
+                line += f". Ответ банка: {item.final_response[:300]}"
+            lines.append(line)
+        text = "\n".join(lines)
+        limit = settings.thread_summary_token_budget * 3
+        # При превышении бюджета сохраняются последние письма переписки
+        return text if len(text) <= limit else "…" + text[-limit:]
+    
+    @staticmethod
+    def classification_confidence(analysis: Dict[str, Any]) -> float:
+        """Уверенность модели в типе письма (0, если не указана)"""
         try:
-            # Создаем новый event loop для фоновой задачи
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(LetterService.analyze_letter(db, letter_id))
-        except Exception as e:
-            import logging
-            logger = logging.getLogger(__name__)
-            logger.error(f"Ошибка при анализе письма {letter_id}: {e}")
-        finally:
-            loop.close()
+            return float((analysis.get("classification") or {}).get("confidence") or 0)
+        except (TypeError, ValueError):
+            return 0.0
+    
+    @staticmethod
+    def align_with_thread(db: Session, letter: Letter, analysis: Dict[str, Any]) -> Dict[str, Any]:
+        """Согласование анализа ответа с перепиской.
+
+        Тип, отделы и маршрут согласования берутся из первого письма переписки,
+        если модель не уверена в другом типе: уверенность ниже
+        thread_reclassify_confidence или тип other. Уровень формальности берется
+        из предыдущего письма, SLA ответа не длиннее SLA предыдущего письма.
+        """
+        history = LetterService.thread_history(db, letter)
+        if not history:
+            return analysis
+        previous = history[0]
+        # Первое письмо переписки может не попасть в history (ограничена thread_summary_letters)
+        root = next((item for item in history if item.id == letter.thread_id), None)
+        if root is None:
+            root = db.query(Letter).filter(
+                Letter.id == letter.thread_id,
+                Letter.classification_data.isnot(None)
+            ).first() or history[-1]
+        analysis = dict(analysis)
+        
+        root_classification = root.classification_data or {}
+        letter_type = (analysis.get("classification") or {}).get("type", "other")
+        confident = (
+            letter_type != "other"
+            and LetterService.classification_confidence(analysis) >= settings.thread_reclassify_confidence
+        )
+        if root_classification.get("type") and not confident and letter_type != root_classification.get("type"):
+            analysis["classification"] = root_classification
+            for key in ("required_departments", "approval_route"):
+                analysis[key] = getattr(root, key) or []
+        if previous.formality_level:
+            analysis["formality_level"] = getattr(previous.formality_level, "value", previous.formality_level)
+        
+        sla = analysis.get("sla_hours")
+        if (analysis.get("classification") or {}).get("type") != "notification" and previous.sla_hours:
+            if not isinstance(sla, int) or sla <= 0 or sla > previous.sla_hours:
+                analysis["sla_hours"] = previous.sla_hours
+                analysis["sla_reasoning"] = (
+                    f"{analysis.get('sla_reasoning') or ''} SLA согласован с перепиской (письмо #{previous.id})."
+                ).strip()
+        return analysis
+    
+    @staticmethod
+    def analysis_text(db: Session, letter: Letter) -> str:
+        """Текст письма для анализа: тело без цитат и подписей, краткое содержание
+        переписки (для ответов) и текст вложений.
+
+        Текст вложений ограничен attachment_analysis_token_budget токенов на письмо.
+        """
+        body = LetterService.analysis_body(letter)
+        history = LetterService.thread_history(db, letter)
+        if history:
+            # Ответ в переписке: только новый текст и краткое содержание предыдущих писем
+            body = (
+                f"Краткое содержание предыдущей переписки:\n{LetterService.thread_summary(history)}"
+                f"\n\nНовое письмо:\n{body}"
+            )
+        budget = settings.attachment_analysis_token_budget
+        if budget <= 0:
+            return body
+        attachments = db.query(LetterAttachment.filename, LetterAttachment.extracted_text).filter(
+            LetterAttachment.letter_id == letter.id,
+            LetterAttachment.status == "done"
+        ).order_by(LetterAttachment.id).all()
+
+        blocks = []
+        for filename, text in attachments:
+            block = f"--- Вложение: {filename or 'без имени'} ---\n{text}"
+            tokens = estimate_tokens(block)
+            if tokens > budget:
+                block = block[:budget * 3].rstrip() + "…"
+                tokens = budget
+            blocks.append(block)
+            budget -= tokens
+            if budget <= 0:
+                break
+        return "\n\n".join([body] + blocks)
+    
+    @staticmethod
+    def analysis_fingerprint(db: Session, letter: Letter) -> str:
+        """Отпечаток входных данных анализа с учетом текста вложений"""
+        return yandex_gpt_service.analysis_fingerprint(letter.subject, LetterService.analysis_text(db, letter))
+    
+    @staticmethod
+    def analysis_outdated(db: Session, letter: Letter) -> bool:
+        """Входные данные изменились после анализа (например, извлечен текст вложений).
+
+        Только для писем во входящих: письмо в работе уже получило статус,
+        SLA и маршрут согласования.
+        """
+        return (
+            letter.analysis_fingerprint is not None
+            and not LetterService.in_workflow(letter)
+            and letter.analysis_fingerprint != LetterService.analysis_fingerprint(db, letter)
+        )
     
     @staticmethod
     def create_letter(db: Session, letter_data: LetterCreate) -> Letter:
@@ -34,6 +262,10 @@ class LetterService:
             body=letter_data.body,
             sender_email=letter_data.sender_email,
             sender_name=letter_data.sender_name,
+            content_hash=LetterService.content_hash(
+                letter_data.subject, letter_data.sender_email, letter_data.body
+            ),
+            **LetterService.compaction_fields(letter_data.body),
             status=LetterStatus.NEW
         )
         db.add(letter)
@@ -42,60 +274,145 @@ class LetterService:
         return letter
     
     @staticmethod
-    async def analyze_letter(db: Session, letter_id: int) -> Letter:
-        """Анализ письма через Yandex GPT"""
+    def in_workflow(letter: Letter) -> bool:
+        """Письмо уже взято в работу: статус, дедлайн и маршрут задал процесс обработки"""
+        return letter.status not in (LetterStatus.NEW, LetterStatus.ANALYZING)
+    
+    @staticmethod
+    def apply_analysis(letter: Letter, analysis: Dict[str, Any], refresh_only: bool = False):
+        """Перенос результата анализа в поля письма (SLA, дедлайн, приоритет, маршрут).
+
+        refresh_only — обновление только классификации, сущностей и рисков:
+        SLA, дедлайн, приоритет, отделы и маршрут согласования письма в работе
+        не меняются.
+        """
+        letter.classification_data = analysis.get("classification")
+        letter.letter_type = analysis.get("classification", {}).get("type", "other")
+        letter.formality_level = analysis.get("formality_level", "neutral")
+        letter.extracted_entities = analysis.get("extracted_entities")
+        letter.risks = analysis.get("risks", [])
+        if refresh_only:
+            return
+        
+        # SLA может вернуться None из анализа — подставляем безопасное значение
+        sla = analysis.get("sla_hours", 24)
+        try:
+            letter.sla_hours = int(sla) if sla is not None else 24
+        except (ValueError, TypeError):
+            letter.sla_hours = 24
+        
+        # Сохраняем объяснение выбора SLA
+        letter.sla_reasoning = analysis.get("sla_reasoning")
+        
+        # Рассчитываем дедлайн
+        # Защита от None/нечислового значения
+        safe_sla = letter.sla_hours if isinstance(letter.sla_hours, int) else 24
+        letter.deadline = datetime.now() + timedelta(hours=safe_sla)
+        
+        # Рассчитываем приоритет на основе дедлайна (игнорируем приоритет от GPT)
+        letter.priority = _calc_priority(letter)
+        
+        letter.required_departments = analysis.get("required_departments", [])
+        letter.approval_route = analysis.get("approval_route", [])
+    
+    @staticmethod
+    async def analyze_letter(db: Session, letter_id: int, refresh_only: bool = False) -> Letter:
+        """Анализ письма через Yandex GPT.
+
+        Одновременные вызовы по одному письму (в процессе и между репликами)
+        не дублируют запросы к модели: второй вызов дожидается первого.
+        С refresh_only письмо, уже взятое в работу, сохраняет статус, SLA,
+        дедлайн и маршрут согласования — обновляются классификация и черновики
+        (повторный анализ после смены промпта или базы знаний).
+        """
+        executed, letter = await letter_single_flight.run(
+            letter_id, lambda: LetterService._analyze_letter(db, letter_id, refresh_only)
+        )
+        if executed:
+            return letter
+        
+        # Анализ выполнил другой вызов — читаем его результат
+        db.expire_all()
+        letter = db.query(Letter).filter(Letter.id == letter_id).first()
+        if not letter:
+            raise ValueError("Letter not found")
+        return letter
+    
+    @staticmethod
+    async def _analyze_letter(db: Session, letter_id: int, refresh_only: bool = False) -> Letter:
         letter = db.query(Letter).filter(Letter.id == letter_id).first()
         if not letter:
             raise ValueError("Letter not found")
         
+        refresh_only = refresh_only and LetterService.in_workflow(letter)
         try:
-            # НЕ меняем статус на ANALYZING при автоматическом анализе
-            # Письмо остается в NEW и сразу попадает во входящие
-            
+            content = LetterService.analysis_text(db, letter)
             # Анализ через GPT
-            analysis = await yandex_gpt_service.analyze_letter(letter.subject, letter.body)
-            
-            # Сохранение результатов анализа
-            letter.classification_data = analysis.get("classification")
-            letter.letter_type = analysis.get("classification", {}).get("type", "other")
-            letter.formality_level = analysis.get("formality_level", "neutral")
-            # SLA может вернуться None из анализа — подставляем безопасное значение
-            sla = analysis.get("sla_hours", 24)
+            # При разомкнутом circuit breaker не ждем таймаутов: сохраняем
+            # шаблонный результат и помечаем письмо для повторного анализа
+            degraded = False
             try:
-                letter.sla_hours = int(sla) if sla is not None else 24
-            except (ValueError, TypeError):
-                letter.sla_hours = 24
+                analysis = await yandex_gpt_service.analyze_letter(letter.subject, content)
+            except CircuitOpenError:
+                logger.warning(f"⛔ Yandex GPT недоступен, письмо {letter_id} отложено для повторного анализа")
+                analysis = yandex_gpt_service.default_analysis()
+                degraded = True
             
-            # Сохраняем объяснение выбора SLA
-            letter.sla_reasoning = analysis.get("sla_reasoning")
+            # Уже проанализированное письмо при недоступности модели сохраняет
+            # прежние результат и черновики — шаблонами они не заменяются
+            previous_drafts = letter.draft_responses or None
+            if degraded and letter.classification_data:
+                analysis = LetterService.stored_analysis(letter)
+            else:
+                # Сохранение результатов анализа (для ответа — с учетом переписки)
+                analysis = LetterService.align_with_thread(db, letter, analysis)
+                LetterService.apply_analysis(letter, analysis, refresh_only)
             
-            # Рассчитываем дедлайн
-            # Защита от None/нечислового значения
-            safe_sla = letter.sla_hours if isinstance(letter.sla_hours, int) else 24
-            letter.deadline = datetime.now() + timedelta(hours=safe_sla)
+            # Первая фиксация: классификация, SLA, дедлайн, приоритет и маршрут
+            # видны сразу; пока генерируются черновики, письмо в статусе ANALYZING
+            classification = analysis.get("classification") or {}
+            if not degraded and not refresh_only and classification.get("type") != "notification":
+                letter.status = LetterStatus.ANALYZING
+            db.commit()
             
-            # Рассчитываем приоритет на основе дедлайна (игнорируем приоритет от GPT)
-            letter.priority = _calc_priority(letter)
+            # Генерация вариантов ответов
+            # В параллельном режиме каждый готовый вариант сохраняется сразу
+            fresh_drafts = {}
             
-            letter.required_departments = analysis.get("required_departments", [])
-            letter.extracted_entities = analysis.get("extracted_entities")
-            letter.risks = analysis.get("risks", [])
-            letter.approval_route = analysis.get("approval_route", [])
+            async def save_variant(tone: str, text: str):
+                fresh_drafts[tone] = text
+                letter.draft_responses = {**(previous_drafts or {}), **fresh_drafts}
+                db.commit()
             
-            # Генерация вариантов ответов
-            draft_responses = await yandex_gpt_service.generate_responses(
-                letter.subject, 
-                letter.body, 
-                analysis
-            )
+            fallback_drafts = previous_drafts or yandex_gpt_service.fallback_responses(letter.subject, analysis)
+            if degraded:
+                draft_responses = fallback_drafts
+            else:
+                try:
+                    draft_responses = await yandex_gpt_service.generate_responses(
+                        letter.subject, 
+                        content, 
+                        analysis,
+                        on_variant=save_variant
+                    )
+                except CircuitOpenError:
+                    logger.warning(f"⛔ Yandex GPT недоступен, черновики письма {letter_id} будут перегенерированы")
+                    draft_responses = {**fallback_drafts, **fresh_drafts}
+                    degraded = True
+            # Вторая фиксация: черновики
             letter.draft_responses = draft_responses
+            letter.needs_reanalysis = degraded
+            letter.analysis_fingerprint = (
+                None if degraded else yandex_gpt_service.analysis_fingerprint(letter.subject, content)
+            )
             
             # После анализа письмо всегда остается в статусе NEW (входящие)
             # Сотрудник вручную решает, что с ним делать:
             # - перенести в обработку (IN_PROGRESS)
             # - отправить на согласование (если есть approval_route)
             # - отправить напрямую (если согласование не требуется)
-            letter.status = LetterStatus.NEW
+            if not refresh_only:
+                letter.status = LetterStatus.NEW
             
             db.commit()
             db.refresh(letter)
@@ -103,18 +420,67 @@ class LetterService:
         
         except Exception as e:
             # При ошибке возвращаем письмо в статус NEW
-            import logging
-            logger = logging.getLogger(__name__)
             logger.error(f"Ошибка анализа письма {letter_id}: {e}")
-            letter.status = LetterStatus.NEW
+            if not refresh_only:
+                letter.status = LetterStatus.NEW
             db.commit()
             raise
     
+    @staticmethod
+    def stored_analysis(letter: Letter) -> Dict[str, Any]:
+        """Результат анализа, восстановленный из полей письма"""
+        return {
+            "classification": letter.classification_data or {},
+            "sla_hours": letter.sla_hours,
+            "extracted_entities": letter.extracted_entities or {},
+            "risks": letter.risks or [],
+            "approval_route": letter.approval_route or [],
+        }
+    
+    @staticmethod
+    async def stream_drafts(letter_id: int) -> AsyncIterator[Dict[str, Any]]:
+        """Потоковая генерация черновиков для SSE; итог сохраняется в письмо.
+
+        Использует собственную сессию БД: генерация длится дольше запроса.
+        """
+        db = SessionLocal()
+        try:
+            letter = db.query(Letter).filter(Letter.id == letter_id).first()
+            if not letter:
+                raise ValueError("Letter not found")
+            
+            # Сохраняются только сгенерированные варианты: шаблон, подставленный
+            # при ошибке, не заменяет уже имеющийся черновик
+            drafts: Dict[str, str] = {}
+            async for tone, text, final, fallback in yandex_gpt_service.stream_responses(
+                letter.subject,
+                LetterService.analysis_text(db, letter),
+                LetterService.stored_analysis(letter)
+            ):
+                if final and not fallback:
+                    drafts[tone] = text
+                yield {"event": "draft", "tone": tone, "text": text, "final": final, "fallback": fallback}
+            
+            if drafts:
+                letter.draft_responses = {**(letter.draft_responses or {}), **drafts}
+                db.commit()
+            yield {"event": "done", "draft_responses": letter.draft_responses}
+        finally:
+            db.close()
+    
     @staticmethod
     def get_letter(db: Session, letter_id: int) -> Optional[Letter]:
         """Получение письма по ID"""
         return db.query(Letter).filter(Letter.id == letter_id).first()
     
+    @staticmethod
+    def get_thread(db: Session, letter: Letter) -> List[Letter]:
+        """Все письма переписки, к которой относится письмо, по порядку получения"""
+        root = letter.thread_id or letter.id
+        return db.query(Letter).filter(
+            or_(Letter.id == root, Letter.thread_id == root)
+        ).order_by(Letter.id).all()
+    
     @staticmethod
     def get_letters(
         db: Session, 
@@ -126,7 +492,7 @@ class LetterService:
         reserved_filter: Optional[bool] = None
     ) -> List[Letter]:
         """Получение списка писем с фильтрацией"""
-        from sqlalchemy import or_, text
+        from sqlalchemy import text
         
         query = db.query(Letter)
         
@@ -294,3 +660,40 @@ class LetterService:
 
 
 letter_service = LetterService()
+
+
+async def retry_deferred_analysis(db_session_factory, interval_seconds: int = 60, batch_size: int = 20):
+    """Фоновая задача повторного анализа писем, отложенных при недоступности Yandex GPT"""
+    logger.info("🔁 Запущен повторный анализ отложенных писем")
+    while True:
+        try:
+            if llm_circuit_breaker.is_closed:
+                db: Session = next(db_session_factory())
+                try:
+                    letters = (
+                        db.query(Letter.id, Letter.status)
+                        .filter(Letter.needs_reanalysis == True)
+                        .order_by(Letter.created_at)
+                        .limit(batch_size)
+                        .all()
+                    )
+                    letter_ids = [row.id for row in letters]
+                    for row in letters:
+                        # Провайдер снова деградировал — ждем следующего цикла
+                        if not llm_circuit_breaker.is_closed:
+                            break
+                        try:
+                            # Письмо, которое сотрудник уже взял в работу, сохраняет
+                            # статус, дедлайн и маршрут согласования
+                            await LetterService.analyze_letter(db, row.id, refresh_only=LetterService.in_workflow(row))
+                        except Exception as e:
+                            logger.error(f"❌ Ошибка повторного анализа письма {row.id}: {e}")
+                    if letter_ids:
+                        logger.info(f"🔁 Повторно проанализировано писем: {len(letter_ids)}")
+                finally:
+                    db.close()
+
+            await asyncio.sleep(interval_seconds)
+        except Exception as e:
+            logger.error(f"❌ Ошибка повторного анализа: {e}")
+            await asyncio.sleep(interval_seconds)
@@ -0,0 +1,164 @@
+"""
+Кэш результатов Yandex GPT с адресацией по содержимому
+"""
+import copy
+import hashlib
+import json
+import logging
+import re
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, Optional
+
+from app.config import settings
+from app.database import SessionLocal
+from app.models import LLMCacheEntry
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_body(body: str) -> str:
+    """Нормализация текста письма для ключа кэша (пробелы, переносы строк)"""
+    return re.sub(r"\s+", " ", body or "").strip()
+
+
+def make_cache_key(kind: str, subject: str, body: str, prompt_version: str,
+                   kb_version: str, model: str, extra: Optional[Dict[str, Any]] = None) -> str:
+    """SHA-256 от всех входных данных, влияющих на ответ модели"""
+    material = {
+        "kind": kind,
+        "subject": (subject or "").strip(),
+        "body": normalize_body(body),
+        "prompt_version": prompt_version,
+        "kb_version": kb_version,
+        "model": model,
+        "extra": extra or {},
+    }
+    raw = json.dumps(material, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """Двухуровневый кэш: LRU в памяти процесса + таблица llm_cache в Postgres"""
+
+    def __init__(self, memory_size: int, ttl_hours: int, db_enabled: bool):
+        self.memory_size = memory_size
+        self.ttl = timedelta(hours=ttl_hours)
+        self.db_enabled = db_enabled
+        self._memory: "OrderedDict[str, tuple[datetime, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {
+            "memory_hits": 0,
+            "db_hits": 0,
+            "misses": 0,
+            "stores": 0,
+            "evictions": 0,
+            "db_errors": 0,
+        }
+
+    def _now(self) -> datetime:
+        return datetime.now(timezone.utc)
+
+    def _remember(self, key: str, expires_at: datetime, value: Any):
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_size:
+                self._memory.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def get(self, key: str) -> Optional[Any]:
+        """Поиск результата: сначала память, затем Postgres"""
+        now = self._now()
+        with self._lock:
+            item = self._memory.get(key)
+            if item is not None:
+                expires_at, value = item
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.stats["memory_hits"] += 1
+                    return copy.deepcopy(value)
+                del self._memory[key]
+
+        if self.db_enabled:
+            db = SessionLocal()
+            try:
+                entry = db.query(LLMCacheEntry).filter(LLMCacheEntry.key == key).first()
+                if entry is not None:
+                    if entry.expires_at > now:
+                        entry.hits = (entry.hits or 0) + 1
+                        db.commit()
+                        self._remember(key, entry.expires_at, entry.value)
+                        self.stats["db_hits"] += 1
+                        return copy.deepcopy(entry.value)
+                    db.delete(entry)
+                    db.commit()
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка чтения кэша LLM: {e}")
+                self.stats["db_errors"] += 1
+                db.rollback()
+            finally:
+                db.close()
+
+        self.stats["misses"] += 1
+        return None
+
+    def set(self, key: str, kind: str, value: Any):
+        """Сохранение результата в оба уровня кэша"""
+        expires_at = self._now() + self.ttl
+        self._remember(key, expires_at, copy.deepcopy(value))
+        self.stats["stores"] += 1
+
+        if self.db_enabled:
+            db = SessionLocal()
+            try:
+                entry = db.query(LLMCacheEntry).filter(LLMCacheEntry.key == key).first()
+                if entry is None:
+                    db.add(LLMCacheEntry(key=key, kind=kind, value=value, expires_at=expires_at))
+                else:
+                    entry.value = value
+                    entry.expires_at = expires_at
+                db.commit()
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка записи в кэш LLM: {e}")
+                self.stats["db_errors"] += 1
+                db.rollback()
+            finally:
+                db.close()
+
+    def purge_expired(self) -> int:
+        """Удаление устаревших записей из Postgres"""
+        if not self.db_enabled:
+            return 0
+        db = SessionLocal()
+        try:
+            deleted = db.query(LLMCacheEntry).filter(
+                LLMCacheEntry.expires_at <= self._now()
+            ).delete(synchronize_session=False)
+            db.commit()
+            if deleted:
+                logger.info(f"🧹 Удалено устаревших записей кэша LLM: {deleted}")
+            return deleted
+        except Exception as e:
+            logger.warning(f"⚠️ Ошибка очистки кэша LLM: {e}")
+            db.rollback()
+            return 0
+        finally:
+            db.close()
+
+    def get_metrics(self) -> Dict[str, Any]:
+        """Счетчики попаданий и промахов"""
+        metrics = dict(self.stats)
+        hits = metrics["memory_hits"] + metrics["db_hits"]
+        lookups = hits + metrics["misses"]
+        metrics["memory_entries"] = len(self._memory)
+        metrics["hit_rate"] = round(hits / lookups, 3) if lookups else 0.0
+        return metrics
+
+
+llm_cache = LLMCache(
+    memory_size=settings.llm_cache_memory_size,
+    ttl_hours=settings.llm_cache_ttl_hours,
+    db_enabled=settings.llm_cache_db_enabled,
+)
@@ -0,0 +1,157 @@
+"""
+Circuit breaker для Yandex GPT: быстрый отказ при деградации провайдера
+"""
+import logging
+import threading
+import time
+from collections import deque
+from typing import Any, Dict, Optional
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitOpenError(Exception):
+    """Запрос отклонен: circuit breaker разомкнут"""
+
+
+class CircuitBreaker:
+    """Размыкается по доле ошибок или медленных вызовов в скользящем окне.
+
+    После open_seconds пропускает один пробный вызов (half-open): успех
+    замыкает цепь, ошибка снова размыкает ее.
+    """
+
+    def __init__(self, window: int, min_calls: int, error_rate: float,
+                 slow_call_seconds: float, slow_call_rate: float, open_seconds: float):
+        self.window = window
+        self.min_calls = min_calls
+        self.error_rate = error_rate
+        self.slow_call_seconds = slow_call_seconds
+        self.slow_call_rate = slow_call_rate
+        self.open_seconds = open_seconds
+        self.state = CLOSED
+        self._opened_at = 0.0
+        self._trial_in_flight = False
+        self._outcomes: deque = deque(maxlen=window)  # (успех, задержка)
+        self._latencies: deque = deque(maxlen=200)  # успешные вызовы для перцентилей
+        self._lock = threading.Lock()
+        self.stats = {"rejected": 0, "opened": 0, "successes": 0, "failures": 0}
+
+    @property
+    def is_closed(self) -> bool:
+        return self.state == CLOSED
+
+    def _admit(self) -> Optional[bool]:
+        """None — отказ, True — вызов занял пробный вызов half-open, False — обычный вызов"""
+        with self._lock:
+            if self.state == CLOSED:
+                return False
+            if self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds:
+                self.state = HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+            self.stats["rejected"] += 1
+            return None
+
+    def allow(self) -> bool:
+        """Можно ли выполнить запрос сейчас"""
+        return self._admit() is not None
+
+    def precheck(self):
+        """Быстрый отказ до ожидания очереди; пробный вызов half-open не занимает.
+
+        Сам пробный вызов берется через check() уже после получения слота,
+        иначе отмена во время ожидания слота оставила бы его занятым.
+        """
+        with self._lock:
+            if self.state == CLOSED:
+                return
+            expired = self.state == OPEN and time.monotonic() - self._opened_at >= self.open_seconds
+            if expired or (self.state == HALF_OPEN and not self._trial_in_flight):
+                return
+            self.stats["rejected"] += 1
+        raise CircuitOpenError("Yandex GPT временно недоступен (circuit breaker разомкнут)")
+
+    def check(self) -> bool:
+        """То же, что allow(), но с исключением CircuitOpenError.
+
+        Возвращает True, если вызов занял пробный вызов half-open: только такой
+        вызов освобождает его через abandon(), если завершился без результата.
+        """
+        trial = self._admit()
+        if trial is None:
+            raise CircuitOpenError("Yandex GPT временно недоступен (circuit breaker разомкнут)")
+        return trial
+
+    def record(self, success: bool, latency: float):
+        """Учет результата вызова"""
+        with self._lock:
+            self.stats["successes" if success else "failures"] += 1
+            if success:
+                self._latencies.append(latency)
+
+            if self.state == HALF_OPEN:
+                self._trial_in_flight = False
+                if success and latency < self.slow_call_seconds:
+                    self.state = CLOSED
+                    self._outcomes.clear()
+                    logger.info("✅ Circuit breaker Yandex GPT замкнут")
+                else:
+                    self._open()
+                return
+
+            self._outcomes.append((success, latency))
+            if self.state == CLOSED and len(self._outcomes) >= self.min_calls:
+                total = len(self._outcomes)
+                errors = sum(1 for ok, _ in self._outcomes if not ok)
+                slow = sum(1 for _, took in self._outcomes if took >= self.slow_call_seconds)
+                if errors / total >= self.error_rate or slow / total >= self.slow_call_rate:
+                    self._open()
+
+    def abandon(self):
+        """Пробный вызов прерван без результата (отмена); вызывает только его владелец"""
+        with self._lock:
+            if self.state == HALF_OPEN:
+                self._trial_in_flight = False
+
+    def _open(self):
+        self.state = OPEN
+        self._opened_at = time.monotonic()
+        self.stats["opened"] += 1
+        logger.warning(f"⛔ Circuit breaker Yandex GPT разомкнут на {self.open_seconds:.0f} с")
+
+    def latency_percentile(self, percentile: float, min_samples: int) -> Optional[float]:
+        """Перцентиль задержки успешных вызовов (None, если данных мало)"""
+        with self._lock:
+            if len(self._latencies) < min_samples:
+                return None
+            ordered = sorted(self._latencies)
+        index = min(len(ordered) - 1, int(percentile * len(ordered)))
+        return ordered[index]
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = dict(self.stats)
+        metrics["state"] = self.state
+        metrics["window_calls"] = len(self._outcomes)
+        metrics["window_errors"] = sum(1 for ok, _ in self._outcomes if not ok)
+        p95 = self.latency_percentile(0.95, 1)
+        metrics["latency_p95_seconds"] = round(p95, 2) if p95 is not None else None
+        return metrics
+
+
+llm_circuit_breaker = CircuitBreaker(
+    window=settings.llm_breaker_window,
+    min_calls=settings.llm_breaker_min_calls,
+    error_rate=settings.llm_breaker_error_rate,
+    slow_call_seconds=settings.llm_breaker_slow_call_seconds,
+    slow_call_rate=settings.llm_breaker_slow_call_rate,
+    open_seconds=settings.llm_breaker_open_seconds,
+)
@@ -0,0 +1,298 @@
+"""
+Ограничение нагрузки на Yandex GPT: очередь одновременных запросов,
+token bucket по запросам и токенам, пауза по Retry-After
+"""
+import asyncio
+import logging
+import random
+import threading
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import Any, Dict, Optional
+
+from sqlalchemy import text
+
+from app.config import settings
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory lock для межрепличного лимита (произвольная константа приложения)
+PG_LOCK_NAMESPACE = 47211
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+
+class _FairSlots:
+    """FIFO-очередь на ограниченное число слотов.
+
+    Ожидающий будится через call_soon_threadsafe в своем event loop, поэтому
+    очередь не привязана к одному loop (скрипты запускают свой asyncio.run).
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_use = 0
+        self._waiters: deque = deque()
+        self._lock = threading.Lock()
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            if self.in_use < self.limit and not self._waiters:
+                self.in_use += 1
+                return
+            waiter = (loop, loop.create_future())
+            self._waiters.append(waiter)
+
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            with self._lock:
+                queued = waiter in self._waiters
+                if queued:
+                    self._waiters.remove(waiter)
+            if not queued and waiter[1].done() and not waiter[1].cancelled():
+                # Слот уже передан (_grant отработал), но задачу отменили до возобновления
+                self.release()
+            # Если передача слота еще в пути, _grant увидит отмену и освободит его
+            raise
+
+    def _grant(self, future: asyncio.Future):
+        if future.cancelled():
+            self.release()
+        else:
+            future.set_result(None)
+
+    def release(self):
+        with self._lock:
+            if self._waiters:
+                # Слот переходит следующему в очереди, счетчик не меняется
+                loop, future = self._waiters.popleft()
+                loop.call_soon_threadsafe(self._grant, future)
+                return
+            self.in_use -= 1
+
+
+class _TokenBucket:
+    """Потокобезопасный token bucket; rate — единиц в секунду"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self._level = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return self.rate > 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self._level = min(self.capacity, self._level + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def level(self) -> float:
+        with self._lock:
+            self._refill()
+            return self._level
+
+    async def take(self, amount: float):
+        """Ожидание, пока в ведре не наберется amount единиц"""
+        if not self.enabled:
+            return
+        # Запрос больше емкости иначе ждал бы вечно
+        amount = min(amount, self.capacity)
+        while True:
+            with self._lock:
+                self._refill()
+                if self._level >= amount:
+                    self._level -= amount
+                    return
+                wait = (amount - self._level) / self.rate
+            await asyncio.sleep(wait)
+
+    def adjust(self, delta: float):
+        """Поправка после ответа: фактический расход отличается от оценки"""
+        if not self.enabled:
+            return
+        with self._lock:
+            self._refill()
+            self._level = min(self.capacity, self._level - delta)
+
+
+class LLMSlot:
+    """Разрешение на запрос; позволяет уточнить фактический расход токенов"""
+
+    def __init__(self, limiter: "LLMRateLimiter", estimated_tokens: int):
+        self._limiter = limiter
+        self.estimated_tokens = estimated_tokens
+
+    def record_usage(self, total_tokens: int):
+        self._limiter.tokens.adjust(total_tokens - self.estimated_tokens)
+        self._limiter.stats["tokens_used"] += total_tokens
+
+
+class LLMRateLimiter:
+    """Общий для процесса ограничитель запросов к Yandex GPT"""
+
+    def __init__(self, max_concurrency: int, requests_per_second: float,
+                 tokens_per_minute: int, pg_slots: int):
+        self.slots = _FairSlots(max(1, max_concurrency))
+        self.requests = _TokenBucket(requests_per_second, max(1.0, requests_per_second))
+        self.tokens = _TokenBucket(tokens_per_minute / 60.0, float(tokens_per_minute))
+        self.pg_slots = pg_slots
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+        self.stats = {
+            "acquired": 0,
+            "waited": 0,
+            "wait_seconds_total": 0.0,
+            "wait_seconds_max": 0.0,
+            "throttled": 0,
+            "retries": 0,
+            "tokens_used": 0,
+        }
+
+    # --- Пауза после 429 ---
+
+    def pause(self, seconds: float):
+        """Приостановка всех новых запросов (например, по Retry-After)"""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    async def _wait_pause(self):
+        while True:
+            delay = self._paused_until - time.monotonic()
+            if delay <= 0:
+                return
+            await asyncio.sleep(delay)
+
+    async def charge(self, estimated_tokens: int = 0):
+        """Учет дополнительного запроса без слота (хеджированная копия): пауза и лимиты"""
+        await self._wait_pause()
+        await self.requests.take(1)
+        await self.tokens.take(estimated_tokens)
+
+    # --- Межрепличный лимит через advisory locks ---
+
+    def _pg_try_lock(self):
+        """Попытка занять один из pg_slots; возвращает (соединение, слот) или None"""
+        connection = engine.connect()
+        try:
+            for slot in range(self.pg_slots):
+                locked = connection.execute(
+                    text("SELECT pg_try_advisory_lock(:ns, :slot)"),
+                    {"ns": PG_LOCK_NAMESPACE, "slot": slot}
+                ).scalar()
+                if locked:
+                    return connection, slot
+        except Exception:
+            connection.close()
+            raise
+        connection.close()
+        return None
+
+    def _pg_unlock(self, held):
+        connection, slot = held
+        try:
+            connection.execute(
+                text("SELECT pg_advisory_unlock(:ns, :slot)"),
+                {"ns": PG_LOCK_NAMESPACE, "slot": slot}
+            )
+        finally:
+            connection.close()
+
+    async def _pg_acquire(self):
+        while True:
+            try:
+                held = await asyncio.to_thread(self._pg_try_lock)
+            except Exception as e:
+                # Без Postgres продолжаем с локальным лимитом
+                logger.warning(f"⚠️ Межрепличный лимит LLM недоступен: {e}")
+                return None
+            if held is not None:
+                return held
+            await asyncio.sleep(0.2 + random.random() * 0.3)
+
+    # --- Основной интерфейс ---
+
+    @asynccontextmanager
+    async def slot(self, estimated_tokens: int = 0):
+        """Ожидание очереди, лимитов и паузы; слот освобождается на выходе"""
+        started = time.monotonic()
+        await self.slots.acquire()
+        held = None
+        try:
+            await self._wait_pause()
+            await self.requests.take(1)
+            await self.tokens.take(estimated_tokens)
+            if self.pg_slots > 0:
+                held = await self._pg_acquire()
+
+            waited = time.monotonic() - started
+            self.stats["acquired"] += 1
+            if waited > 0.01:
+                self.stats["waited"] += 1
+            self.stats["wait_seconds_total"] += waited
+            self.stats["wait_seconds_max"] = max(self.stats["wait_seconds_max"], waited)
+
+            yield LLMSlot(self, estimated_tokens)
+        finally:
+            if held is not None:
+                await asyncio.to_thread(self._pg_unlock, held)
+            self.slots.release()
+
+    def retry_delay(self, attempt: int, retry_after: Optional[str] = None) -> float:
+        """Задержка перед повтором: Retry-After или экспонента с полным джиттером"""
+        if retry_after:
+            delay = _parse_retry_after(retry_after)
+            if delay is not None:
+                return min(delay, settings.llm_backoff_max)
+        ceiling = min(settings.llm_backoff_max, settings.llm_backoff_base * (2 ** attempt))
+        return random.uniform(0, ceiling)
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = dict(self.stats)
+        metrics["queue_depth"] = self.slots.queue_depth
+        metrics["in_flight"] = self.slots.in_use
+        metrics["max_concurrency"] = self.slots.limit
+        metrics["wait_seconds_avg"] = (
+            round(metrics["wait_seconds_total"] / metrics["acquired"], 3) if metrics["acquired"] else 0.0
+        )
+        metrics["paused_for_seconds"] = round(max(0.0, self._paused_until - time.monotonic()), 1)
+        if self.requests.enabled:
+            metrics["requests_bucket"] = round(self.requests.level(), 2)
+        if self.tokens.enabled:
+            metrics["tokens_bucket"] = int(self.tokens.level())
+        metrics["pg_slots"] = self.pg_slots
+        return metrics
+
+
+def _parse_retry_after(value: str) -> Optional[float]:
+    """Retry-After: число секунд или HTTP-дата"""
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        moment = parsedate_to_datetime(value)
+        return max(0.0, (moment - datetime.now(timezone.utc)).total_seconds())
+    except (TypeError, ValueError):
+        return None
+
+
+llm_limiter = LLMRateLimiter(
+    max_concurrency=settings.llm_max_concurrency,
+    requests_per_second=settings.llm_requests_per_second,
+    tokens_per_minute=settings.llm_tokens_per_minute,
+    pg_slots=settings.llm_pg_coordination_slots,
+)
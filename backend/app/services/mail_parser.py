@@ -0,0 +1,356 @@
+"""
+Разбор MIME и преобразование HTML в текст при приеме почты.
+
+html2text написан на чистом Python и очень медленный на тяжелых HTML-рассылках
+и выписках, поэтому HTML-разделы и письма целиком разбираются в пуле процессов
+с лимитом процессорного времени на письмо. text/plain декодируется сразу
+в потоке приема — это быстрый путь для большинства писем.
+"""
+import base64
+import email
+import email.message
+import html
+import logging
+import multiprocessing
+import quopri
+import re
+import signal
+import threading
+import time
+from concurrent.futures import CancelledError, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+
+from html2text import HTML2Text
+
+from app.config import settings
+
+logger = logging.getLogger(__name__)
+
+# Конвертер создается один раз в каждом процессе
+_html_converter: Optional[HTML2Text] = None
+
+
+class ParseTimeout(Exception):
+    """Превышен лимит процессорного времени на разбор письма"""
+
+
+def _converter() -> HTML2Text:
+    global _html_converter
+    if _html_converter is None:
+        _html_converter = HTML2Text()
+        _html_converter.ignore_links = False
+        _html_converter.body_width = 0
+    return _html_converter
+
+
+def strip_tags(html_content: str) -> str:
+    """Грубое извлечение текста из HTML (когда html2text не уложился в лимит)"""
+    text = re.sub(r'(?is)<(script|style)\b.*?</\1\s*>', ' ', html_content)
+    text = re.sub(r'(?i)<br\s*/?>|</(p|div|tr|li|h\d)\s*>', '\n', text)
+    text = html.unescape(re.sub(r'<[^>]*>', ' ', text))
+    lines = (re.sub(r'[ \t\xa0]+', ' ', line).strip() for line in text.splitlines())
+    return '\n'.join(line for line in lines if line)
+
+
+def decode_payload(data: bytes, encoding: str, charset: str) -> str:
+    """Снятие Content-Transfer-Encoding и декодирование кодировки"""
+    if encoding == 'base64':
+        data = b''.join(data.split())
+        # Раздел может быть обрезан лимитом размера — отбрасываем неполную группу
+        data = base64.b64decode(data[:len(data) - len(data) % 4])
+    elif encoding == 'quoted-printable':
+        data = quopri.decodestring(data)
+    try:
+        return data.decode(charset or 'utf-8', errors='ignore')
+    except LookupError:
+        return data.decode('utf-8', errors='ignore')
+
+
+def decode_part(data: bytes, encoding: str, charset: str, subtype: str) -> str:
+    """Текст раздела письма; HTML преобразуется в текст"""
+    text = decode_payload(data, encoding, charset)
+    if subtype == 'html':
+        text = _converter().handle(text)
+    return text.strip()
+
+
+def message_body(msg: email.message.Message, convert_html: Optional[Callable[[str], str]] = None) -> str:
+    """Извлечение текста письма: первый text/plain, иначе первый text/html"""
+    convert_html = convert_html or _converter().handle
+    body = ""
+
+    if msg.is_multipart():
+        for part in msg.walk():
+            content_type = part.get_content_type()
+            disposition = str(part.get('Content-Disposition', ''))
+
+            if 'attachment' in disposition:
+                continue
+
+            try:
+                if content_type == 'text/plain':
+                    payload = part.get_payload(decode=True)
+                    if payload:
+                        charset = part.get_content_charset() or 'utf-8'
+                        body = payload.decode(charset, errors='ignore')
+                        break
+                elif content_type == 'text/html' and not body:
+                    payload = part.get_payload(decode=True)
+                    if payload:
+                        charset = part.get_content_charset() or 'utf-8'
+                        html_content = payload.decode(charset, errors='ignore')
+                        body = convert_html(html_content)
+            except ParseTimeout:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка декодирования части: {e}")
+                continue
+    else:
+        content_type = msg.get_content_type()
+        try:
+            payload = msg.get_payload(decode=True)
+            if payload:
+                charset = msg.get_content_charset() or 'utf-8'
+                if content_type == 'text/html':
+                    html_content = payload.decode(charset, errors='ignore')
+                    body = convert_html(html_content)
+                else:
+                    body = payload.decode(charset, errors='ignore')
+        except ParseTimeout:
+            raise
+        except Exception as e:
+            logger.error(f"Ошибка декодирования: {e}")
+
+    return body.strip()
+
+
+def parse_message_body(raw: bytes) -> str:
+    """Текст письма из исходного сообщения целиком"""
+    return message_body(email.message_from_bytes(raw))
+
+
+# --- Выполнение в процессах пула ---
+
+def _on_cpu_limit(signum, frame):
+    raise ParseTimeout()
+
+
+def _init_worker():
+    # SIGPROF приходит по таймеру процессорного времени (ITIMER_PROF)
+    signal.signal(signal.SIGPROF, _on_cpu_limit)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+def _run_limited(cpu_seconds: float, func, *args):
+    """Вызов func с лимитом процессорного времени процесса пула"""
+    signal.setitimer(signal.ITIMER_PROF, cpu_seconds)
+    try:
+        return func(*args)
+    finally:
+        signal.setitimer(signal.ITIMER_PROF, 0)
+
+
+class MailParser:
+    """Пул процессов для разбора писем.
+
+    processes=0 или платформа без setitimer — разбор в вызывающем потоке
+    без лимита времени.
+    """
+
+    def __init__(self, processes: int, cpu_seconds: float):
+        self.processes = processes if hasattr(signal, 'setitimer') else 0
+        self.cpu_seconds = cpu_seconds
+        # Ожидание задачи по стене: страховка от процесса, зависшего вне CPU
+        self.wall_seconds = cpu_seconds * 4 + 10
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self._lock = threading.Lock()
+        # resubmitted — задачи, прерванные пересозданием пула из-за соседней задачи
+        self.stats = {"inline": 0, "pool": 0, "timeouts": 0, "errors": 0, "pool_restarts": 0, "resubmitted": 0}
+
+    def _pool(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # spawn: процессы не наследуют соединения БД и потоки приложения
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context("spawn"),
+                    initializer=_init_worker
+                )
+            return self._executor
+
+    def _reset_pool(self, executor: Optional[ProcessPoolExecutor] = None, terminate: bool = False):
+        """Замена пула; executor — только если пул еще не заменен другим потоком.
+
+        terminate — завершение процессов: зависший процесс иначе продолжает
+        занимать место в пуле и не дает ему остановиться.
+        """
+        with self._lock:
+            if self._executor is None or (executor is not None and self._executor is not executor):
+                return
+            if terminate:
+                for process in list((getattr(self._executor, "_processes", None) or {}).values()):
+                    try:
+                        process.terminate()
+                    except Exception:
+                        pass
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+            self.stats["pool_restarts"] += 1
+
+    def _run_pool(self, tasks: Sequence[Tuple[Callable, tuple]]) -> List[Any]:
+        """Выполнение задач (func, args) в пуле; результат или исключение по каждой задаче.
+
+        Ожидание по стене — страховка от зависшего процесса, которому не помогает
+        лимит процессорного времени (например, блокировка в C-коде). Оно отсчитывается
+        от начала задачи, а не от начала ожидания: задача начинается не позже
+        постановки в пул и не позже завершения задачи, стоящей на processes позиций
+        раньше (очередь пула — FIFO). Зависший процесс завершается вместе с пулом;
+        соседние задачи, прерванные этим, один раз выполняются в новом пуле.
+        """
+        results: List[Any] = [None] * len(tasks)
+        pending = list(range(len(tasks)))
+        resubmitted = set()
+
+        while pending:
+            futures = []
+            executor = None
+            try:
+                executor = self._pool()
+                for index in pending:
+                    func, args = tasks[index]
+                    futures.append((index, time.monotonic(), executor.submit(_run_limited, self.cpu_seconds, func, *args)))
+            except BrokenProcessPool as e:
+                self._reset_pool(executor)
+                for index in pending[len(futures):]:
+                    results[index] = e
+                pending = pending[:len(futures)]
+                if not futures:
+                    break
+
+            retry = []
+            finished_at: List[float] = []
+            for position, (index, submitted_at, future) in enumerate(futures):
+                started = submitted_at
+                if position >= self.processes:
+                    started = max(started, finished_at[position - self.processes])
+                try:
+                    results[index] = future.result(timeout=max(0.0, started + self.wall_seconds - time.monotonic()))
+                    self.stats["pool"] += 1
+                except (CancelledError, BrokenProcessPool, TimeoutError) as e:
+                    replaced = self._executor is not executor
+                    if isinstance(e, TimeoutError) and not replaced:
+                        logger.warning("⏱️ Процесс разбора писем не ответил, пул процессов пересоздается")
+                        self._reset_pool(executor, terminate=True)
+                        self.stats["timeouts"] += 1
+                        results[index] = e
+                    elif index not in resubmitted:
+                        # Задача прервана вместе с пулом, сама она могла быть исправной
+                        self._reset_pool(executor)
+                        resubmitted.add(index)
+                        retry.append(index)
+                        self.stats["resubmitted"] += 1
+                    else:
+                        self._reset_pool(executor)
+                        self.stats["errors"] += 1
+                        results[index] = e if isinstance(e, BrokenProcessPool) else BrokenProcessPool("пул процессов пересоздан")
+                except ParseTimeout as e:
+                    self.stats["timeouts"] += 1
+                    results[index] = e
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    results[index] = e
+                finally:
+                    finished_at.append(time.monotonic())
+            pending = retry
+        return results
+
+    def decode_parts(self, parts: Sequence[Tuple[bytes, Dict[str, str]]]) -> List[Union[str, Exception]]:
+        """Декодирование текстовых разделов (данные, описание из BODYSTRUCTURE).
+
+        text/plain — сразу, text/html — в пуле; HTML, не уложившийся в лимит,
+        упрощается до текста без разметки.
+        """
+        results: List[Union[str, Exception, None]] = []
+        in_pool: List[int] = []
+        for index, (data, part) in enumerate(parts):
+            if part['subtype'] == 'html' and self.processes > 0:
+                in_pool.append(index)
+                results.append(None)
+                continue
+            try:
+                results.append(decode_part(data, part['encoding'], part['charset'], part['subtype']))
+                self.stats["inline"] += 1
+            except Exception as e:
+                self.stats["errors"] += 1
+                results.append(e)
+
+        pooled = self._run_pool([
+            (decode_part, (parts[index][0], parts[index][1]['encoding'], parts[index][1]['charset'], 'html'))
+            for index in in_pool
+        ])
+        for index, result in zip(in_pool, pooled):
+            if not isinstance(result, Exception):
+                results[index] = result
+                continue
+            data, part = parts[index]
+            logger.warning(f"⏱️ HTML письма не разобран html2text ({result.__class__.__name__}), упрощенный текст")
+            try:
+                results[index] = strip_tags(decode_payload(data, part['encoding'], part['charset']))
+            except Exception as decode_error:
+                results[index] = decode_error
+        return results
+
+    def parse_bodies(self, raws: Sequence[bytes]) -> List[Union[str, Exception]]:
+        """Текст писем из исходных сообщений целиком (нестандартная структура)"""
+        if self.processes <= 0:
+            results: List[Union[str, Exception]] = []
+            for raw in raws:
+                try:
+                    results.append(parse_message_body(raw))
+                    self.stats["inline"] += 1
+                except Exception as e:
+                    self.stats["errors"] += 1
+                    results.append(e)
+            return results
+
+        results = []
+        for raw, result in zip(raws, self._run_pool([(parse_message_body, (raw,)) for raw in raws])):
+            if not isinstance(result, Exception):
+                results.append(result)
+                continue
+            logger.warning(f"⏱️ Письмо не разобрано в пуле ({result.__class__.__name__}), упрощенный разбор")
+            try:
+                results.append(message_body(email.message_from_bytes(raw), strip_tags))
+            except Exception as e:
+                results.append(e)
+        return results
+
+    def call(self, func, *args) -> Any:
+        """Вызов func в пуле с лимитом процессорного времени (при processes=0 — сразу)"""
+        if self.processes <= 0:
+            self.stats["inline"] += 1
+            return func(*args)
+        result = self._run_pool([(func, args)])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = dict(self.stats)
+        metrics["processes"] = self.processes
+        metrics["cpu_seconds"] = self.cpu_seconds
+        metrics["wall_seconds"] = self.wall_seconds
+        return metrics
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=True, cancel_futures=True)
+                self._executor = None
+
+
+mail_parser = MailParser(
+    processes=settings.mail_parser_processes,
+    cpu_seconds=settings.mail_parser_cpu_seconds
+)
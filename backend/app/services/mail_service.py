@@ -1,56 +1,90 @@
 import email
+import json
 import logging
 import re
 import asyncio
 import ssl
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from email.header import decode_header
-from typing import List, Optional
-from datetime import datetime
+from email.parser import BytesParser
+from typing import Callable, Dict, List, Optional
+from urllib.parse import unquote
+from datetime import datetime, timezone
 from imapclient import IMAPClient
-from html2text import HTML2Text
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 from sqlalchemy.orm import Session
 
-from app.models import Letter, LetterType, LetterStatus
+from app.models import AnalysisJob, Letter, LetterAttachment, LetterType, LetterStatus, MailboxSyncState
+from app.services.letter_service import LetterService
+from app.services.mail_parser import mail_parser
 from app.config import settings
 
 logger = logging.getLogger(__name__)
 
 
+class UnparsedMessage(Exception):
+    """Письмо не удалось разобрать; заголовки сохраняются, если их удалось прочитать"""
+
+    def __init__(self, error: Exception, headers=None):
+        super().__init__(str(error) or error.__class__.__name__)
+        self.headers = headers
+
+
 class YandexMailService:
-    """Сервис для работы с Яндекс Почтой через IMAP"""
+    """Сервис для работы с Яндекс Почтой через IMAP.
+
+    Экземпляр обслуживает одну папку одного ящика и держит собственное соединение.
+    """
     
-    def __init__(self):
+    def __init__(
+        self,
+        login: Optional[str] = None,
+        password: Optional[str] = None,
+        mailbox: str = 'INBOX',
+        imap_server: Optional[str] = None,
+        imap_port: Optional[int] = None
+    ):
+        self.login = settings.yandex_mail_login if login is None else login
+        self.password = settings.yandex_mail_password if password is None else password
+        self.mailbox = mailbox
+        self.imap_server = imap_server or settings.yandex_mail_imap_server
+        self.imap_port = imap_port or settings.yandex_mail_imap_port
         self.client: Optional[IMAPClient] = None
-        self.html_converter = HTML2Text()
-        self.html_converter.ignore_links = False
-        self.html_converter.body_width = 0
+    
+    @property
+    def name(self) -> str:
+        return f"{self.login}/{self.mailbox}"
+        
+    def create_client(self) -> IMAPClient:
+        """Новое авторизованное IMAP-соединение"""
+        # Создаем SSL контекст с поддержкой современных протоколов
+        ssl_context = ssl.create_default_context()
+        # Разрешаем TLS 1.2 и выше
+        ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
+        
+        client = IMAPClient(
+            host=self.imap_server,
+            port=self.imap_port,
+            ssl=True,
+            ssl_context=ssl_context,
+            timeout=30
+        )
         
+        client.login(self.login, self.password)
+        return client
+    
     def connect(self) -> bool:
         """Подключение к Яндекс Почте"""
         try:
-            if not settings.yandex_mail_login or not settings.yandex_mail_password:
+            if not self.login or not self.password:
                 logger.warning("⚠️ Настройки почты не заданы")
                 return False
             
-            # Создаем SSL контекст с поддержкой современных протоколов
-            ssl_context = ssl.create_default_context()
-            # Разрешаем TLS 1.2 и выше
-            ssl_context.minimum_version = ssl.TLSVersion.TLSv1_2
-            
-            self.client = IMAPClient(
-                host=settings.yandex_mail_imap_server,
-                port=settings.yandex_mail_imap_port,
-                ssl=True,
-                ssl_context=ssl_context,
-                timeout=30
-            )
-            
-            self.client.login(
-                settings.yandex_mail_login,
-                settings.yandex_mail_password
-            )
+            self.client = self.create_client()
             
-            logger.info(f"✅ Успешное подключение к {settings.yandex_mail_login}")
+            logger.info(f"✅ Успешное подключение к {self.name}")
             return True
             
         except Exception as e:
@@ -93,148 +127,390 @@ class YandexMailService:
             return match.group(1).strip(), match.group(2).strip()
         return email_str.strip(), email_str.strip()
     
-    def _get_email_body(self, msg: email.message.Message) -> str:
-        """Извлечение текста письма"""
-        body = ""
+    def _get_sync_state(self, db: Session, mailbox: str) -> MailboxSyncState:
+        """Чекпоинт синхронизации папки (создается при первом обращении)"""
+        account = self.login
+        state = db.query(MailboxSyncState).filter(
+            MailboxSyncState.account == account,
+            MailboxSyncState.mailbox == mailbox
+        ).first()
+        if state is None:
+            state = MailboxSyncState(account=account, mailbox=mailbox, last_uid=0)
+            db.add(state)
+            db.commit()
+        return state
+    
+    @staticmethod
+    def _text(value) -> str:
+        """Поле BODYSTRUCTURE в виде строки в нижнем регистре"""
+        if isinstance(value, bytes):
+            value = value.decode('ascii', errors='ignore')
+        return (value or '').lower()
+    
+    def _params(self, params) -> Dict[str, str]:
+        """Параметры части BODYSTRUCTURE; имена с * (RFC 2231) декодируются"""
+        result = {}
+        params = params or ()
+        for key, value in zip(params[::2], params[1::2]):
+            key = self._text(key)
+            if isinstance(value, bytes):
+                value = value.decode('utf-8', errors='ignore')
+            value = value or ''
+            if key.endswith('*'):
+                key = key[:-1]
+                charset, _, encoded = value.partition("'")
+                value = unquote(encoded.partition("'")[2], encoding=charset or 'utf-8', errors='ignore')
+            result[key] = value
+        return result
+    
+    def _walk_parts(self, structure, prefix: str = ''):
+        """Листовые части BODYSTRUCTURE с номерами разделов IMAP (1, 2.1, ...)"""
+        if isinstance(structure[0], list):
+            for index, part in enumerate(structure[0], start=1):
+                yield from self._walk_parts(part, f"{prefix}.{index}" if prefix else str(index))
+        else:
+            yield prefix or '1', structure
+    
+    def _find_text_part(self, structure) -> Optional[dict]:
+        """Раздел с текстом письма: первый text/plain, иначе первый text/html (как mail_parser.message_body)"""
+        html_part = None
+        for section, part in self._walk_parts(structure):
+            if self._text(part[0]) != 'text':
+                continue
+            # Для text/*: 7 — строки, 8 — MD5, 9 — Content-Disposition
+            disposition = part[9] if len(part) > 9 else None
+            if disposition and self._text(disposition[0]) == 'attachment':
+                continue
+            info = {
+                'section': section,
+                'subtype': self._text(part[1]),
+                'charset': self._params(part[2]).get('charset', '').lower() or 'utf-8',
+                'encoding': self._text(part[5]),
+            }
+            if info['subtype'] == 'plain':
+                return info
+            if info['subtype'] == 'html' and html_part is None:
+                html_part = info
+        return html_part
+    
+    def _find_attachments(self, structure) -> List[dict]:
+        """Вложения по BODYSTRUCTURE; сами данные позже загружает attachment_service"""
+        attachments = []
+        for section, part in self._walk_parts(structure):
+            maintype = self._text(part[0])
+            if maintype == 'message':
+                continue
+            # Content-Disposition: у text/* после строк и MD5, у остальных — после MD5
+            index = 9 if maintype == 'text' else 8
+            disposition = part[index] if len(part) > index else None
+            is_attachment = bool(disposition) and self._text(disposition[0]) == 'attachment'
+            disposition_params = self._params(disposition[1]) if disposition and len(disposition) > 1 else {}
+            params = self._params(part[2])
+            filename = disposition_params.get('filename') or params.get('name')
+            # Текст письма не вложение; файлы без disposition узнаем по имени
+            if not is_attachment and not (filename and maintype != 'text'):
+                continue
+            attachments.append({
+                'section': section,
+                'filename': (self._decode_header(filename) if filename else f"attachment-{section}")[:500],
+                'content_type': f"{maintype}/{self._text(part[1])}",
+                'charset': params.get('charset'),
+                'encoding': self._text(part[5]),
+                'size': part[6] or 0,
+            })
+        return attachments
+    
+    @staticmethod
+    def _section_data(data: dict, section: str) -> bytes:
+        """Данные раздела из ответа FETCH (ключ вида BODY[1]<0> при частичной выборке)"""
+        prefix = f"BODY[{section}]".encode()
+        for key, value in data.items():
+            if isinstance(key, bytes) and key.startswith(prefix):
+                return value or b''
+        return b''
+    
+    def _fetch_chunk(self, uids: List[int]) -> Dict[int, tuple]:
+        """Загрузка пачки писем без вложений.
+
+        Сначала заголовки и BODYSTRUCTURE, затем только текстовый раздел каждого
+        письма через BODY.PEEK (флаг \\Seen не меняется) с ограничением размера.
+        Возвращает {uid: (заголовки, текст, вложения)}; письма с ошибкой разбора — {uid: исключение}.
+        """
+        limit = settings.yandex_mail_max_body_bytes
+        meta = self.client.fetch(uids, ['BODY.PEEK[HEADER]', 'BODYSTRUCTURE', 'RFC822.SIZE'])
         
-        if msg.is_multipart():
-            for part in msg.walk():
-                content_type = part.get_content_type()
-                disposition = str(part.get('Content-Disposition', ''))
-                
-                if 'attachment' in disposition:
-                    continue
-                
+        parts: Dict[int, Optional[dict]] = {}
+        attachments: Dict[int, List[dict]] = {}
+        result: Dict[int, tuple] = {}
+        whole: List[int] = []
+        for uid, data in meta.items():
+            try:
+                parts[uid] = self._find_text_part(data[b'BODYSTRUCTURE'])
+                attachments[uid] = self._find_attachments(data[b'BODYSTRUCTURE'])
+            except Exception as e:
+                # Нестандартная структура: разбираем письмо целиком, если оно в пределах лимита
+                if data.get(b'RFC822.SIZE', 0) <= limit:
+                    whole.append(uid)
+                else:
+                    result[uid] = e
+        
+        if whole:
+            raws = {uid: self._section_data(data, '') for uid, data in self.client.fetch(whole, ['BODY.PEEK[]']).items()}
+            for (uid, raw), body in zip(raws.items(), mail_parser.parse_bodies(list(raws.values()))):
                 try:
-                    if content_type == 'text/plain':
-                        payload = part.get_payload(decode=True)
-                        if payload:
-                            charset = part.get_content_charset() or 'utf-8'
-                            body = payload.decode(charset, errors='ignore')
-                            break
-                    elif content_type == 'text/html' and not body:
-                        payload = part.get_payload(decode=True)
-                        if payload:
-                            charset = part.get_content_charset() or 'utf-8'
-                            html_content = payload.decode(charset, errors='ignore')
-                            body = self.html_converter.handle(html_content)
+                    headers = BytesParser().parsebytes(raw, headersonly=True)
+                    result[uid] = body if isinstance(body, Exception) else (headers, body, [])
                 except Exception as e:
-                    logger.error(f"Ошибка декодирования части: {e}")
-                    continue
-        else:
-            content_type = msg.get_content_type()
+                    result[uid] = e
+        
+        # FETCH применяет одни и те же элементы ко всем письмам, поэтому группируем по разделу
+        by_section: Dict[str, List[int]] = {}
+        for uid, part in parts.items():
+            if part:
+                by_section.setdefault(part['section'], []).append(uid)
+        bodies: Dict[int, bytes] = {}
+        for section, section_uids in by_section.items():
+            response = self.client.fetch(section_uids, [f"BODY.PEEK[{section}]<0.{limit}>"])
+            for uid, data in response.items():
+                bodies[uid] = self._section_data(data, section)
+        
+        # Декодирование и HTML -> текст выполняет пул процессов разбора
+        with_text = [uid for uid, part in parts.items() if part]
+        for uid in with_text:
+            if len(bodies.get(uid, b'')) >= limit:
+                logger.warning(f"✂️ Текст письма UID {uid} обрезан до {limit} байт")
+        texts = dict(zip(with_text, mail_parser.decode_parts(
+            [(bodies.get(uid, b''), parts[uid]) for uid in with_text]
+        )))
+        
+        for uid in parts:
+            body = texts.get(uid, '')
             try:
-                payload = msg.get_payload(decode=True)
-                if payload:
-                    charset = msg.get_content_charset() or 'utf-8'
-                    if content_type == 'text/html':
-                        html_content = payload.decode(charset, errors='ignore')
-                        body = self.html_converter.handle(html_content)
-                    else:
-                        body = payload.decode(charset, errors='ignore')
+                if isinstance(body, Exception):
+                    raise body
+                headers = email.message_from_bytes(self._section_data(meta[uid], 'HEADER'))
+                result[uid] = (headers, body, attachments.get(uid, []))
             except Exception as e:
-                logger.error(f"Ошибка декодирования: {e}")
+                result[uid] = e
         
-        return body.strip()
+        # Неразобранное письмо сохраняется заглушкой с исходной темой и отправителем
+        for uid, value in result.items():
+            if isinstance(value, Exception):
+                result[uid] = UnparsedMessage(value, self._raw_headers(meta.get(uid)))
+        return result
     
-    def fetch_new_emails(self, db: Session, mailbox: str = 'INBOX') -> List[Letter]:
-        """Получение новых непрочитанных писем (синхронный метод)"""
+    def _raw_headers(self, data: Optional[dict]):
+        """Заголовки из ответа FETCH без разбора тела (None, если прочитать не удалось)"""
+        try:
+            return email.message_from_bytes(self._section_data(data, 'HEADER'))
+        except Exception:
+            return None
+    
+    def fetch_new_emails(self, db: Session, mailbox: Optional[str] = None) -> List[Letter]:
+        """Получение новых писем по UID после последнего обработанного (синхронный метод).
+
+        Письма загружаются пачками по yandex_mail_fetch_batch_size без вложений,
+        поэтому потребление памяти не зависит от числа накопившихся писем.
+        Письма только сохраняются и ставятся в очередь анализа, поэтому скорость
+        приема не зависит от задержек Yandex GPT.
+        Одновременно выборку выполняют не больше yandex_mail_ingest_concurrency ящиков.
+        """
         if not self.client:
             if not self.connect():
                 return []
         
+        with _ingest_slots:
+            return self._fetch_new_emails(db, mailbox or self.mailbox)
+    
+    def _record_sync(self, db: Session, mailbox: str, pending: Optional[int], error: Optional[str] = None):
+        """Время синхронизации, остаток и ошибка — для отставания в /api/mail/status"""
+        try:
+            state = self._get_sync_state(db, mailbox)
+            now = datetime.now(timezone.utc)
+            state.last_sync_at = now
+            state.last_error = error[:2000] if error else None
+            if pending is not None:
+                state.pending = pending
+                if pending == 0:
+                    state.caught_up_at = now
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            logger.warning(f"Не удалось сохранить состояние синхронизации {self.name}: {e}")
+    
+    def _fetch_new_emails(self, db: Session, mailbox: str) -> List[Letter]:
         try:
             folder_status = self.client.select_folder(mailbox)
-            logger.info(f"📬 Папка {mailbox}: всего писем {folder_status.get(b'EXISTS', 0)}, непрочитанных {folder_status.get(b'UNSEEN', 0)}")
+            uidvalidity = folder_status.get(b'UIDVALIDITY')
+            uidnext = folder_status.get(b'UIDNEXT')
+            logger.info(f"📬 Папка {mailbox}: всего писем {folder_status.get(b'EXISTS', 0)}")
             
-            # Ищем непрочитанные письма
-            messages = self.client.search(['UNSEEN'])
-            
-            if not messages:
-                logger.info("Новых непрочитанных писем нет")
-                return []
-            
-            logger.info(f"📧 Найдено новых писем: {len(messages)}")
+            state = self._get_sync_state(db, mailbox)
+            # Первая синхронизация или смена UIDVALIDITY: старые UID недействительны,
+            # забираем непрочитанные письма, как раньше, и начинаем отсчет с UIDNEXT
+            bootstrap = uidvalidity is None or state.uidvalidity != uidvalidity
+            if bootstrap:
+                if state.uidvalidity is not None and uidvalidity is not None:
+                    logger.warning(f"⚠️ UIDVALIDITY папки {mailbox} изменился, повторная синхронизация")
+                state.last_uid = 0
+                uids = self.client.search(['UNSEEN'])
+            else:
+                uids = self.client.search(['UID', f"{state.last_uid + 1}:*"])
             
-            created_letters = []
+            # Диапазон n+1:* всегда включает последнее письмо, даже если его UID <= n
+            new_uids = sorted(uid for uid in uids if uid > state.last_uid)
+            if not new_uids:
+                logger.info("Новых писем нет")
+            else:
+                logger.info(f"📧 Найдено новых писем: {len(new_uids)}")
             
-            # Получаем письма пачкой
-            response = self.client.fetch(messages, ['RFC822'])
+            created_ids = []
+            completed = True
+            batch_size = max(1, settings.yandex_mail_fetch_batch_size)
             
-            for msg_id, data in response.items():
-                try:
-                    raw_email = data[b'RFC822']
-                    msg = email.message_from_bytes(raw_email)
-                    
-                    # Извлекаем данные
-                    subject = self._decode_header(msg.get('Subject', 'Без темы'))
-                    from_header = self._decode_header(msg.get('From', ''))
-                    sender_name, sender_email = self._extract_email(from_header)
-                    body = self._get_email_body(msg)
-                    
-                    # Проверяем дубликаты:
-                    # учитываем совпадение темы, отправителя и полного текста письма,
-                    # чтобы не пропускать новые письма с тем же сабжектом
-                    existing = db.query(Letter).filter(
-                        Letter.subject == subject,
-                        Letter.sender_email == sender_email,
-                        Letter.body == body
-                    ).first()
-                    
-                    if existing:
-                        logger.info(f"Письмо уже существует: {subject[:50]}...")
-                        # Помечаем как прочитанное, чтобы не возвращалось снова
-                        try:
-                            self.client.add_flags([msg_id], [b'\\Seen'])
-                        except Exception as e:
-                            logger.warning(f"Не удалось пометить дубликат как прочитанный: {e}")
+            for offset in range(0, len(new_uids), batch_size):
+                chunk = new_uids[offset:offset + batch_size]
+                messages = self._fetch_chunk(chunk)
+                seen_uids = []
+                
+                for uid in chunk:
+                    parsed = messages.get(uid)
+                    if parsed is None:
+                        # Письмо удалено из папки между SEARCH и FETCH — принимать нечего
+                        logger.warning(f"⚠️ Письмо UID {uid} удалено из папки {self.login}/{mailbox} до загрузки")
+                        state.last_uid = uid
+                        db.commit()
                         continue
                     
-                    # Создаем письмо
-                    letter = Letter(
-                        subject=subject,
-                        body=body,
-                        sender_name=sender_name,
-                        sender_email=sender_email,
-                        letter_type=LetterType.OTHER,  # Тип по умолчанию, AI определит позже
-                        status=LetterStatus.NEW,
-                        priority=3
-                    )
+                    # Неразбираемое письмо не блокирует синхронизацию и не теряется:
+                    # сохраняется заглушка с исходными заголовками для ручной обработки
+                    parse_error = None
+                    if isinstance(parsed, UnparsedMessage):
+                        parse_error = str(parsed)
+                        headers, body, attachments = parsed.headers or {}, "", []
+                    else:
+                        headers, body, attachments = parsed
                     
-                    db.add(letter)
-                    db.commit()
-                    db.refresh(letter)
+                    # Извлекаем данные
+                    try:
+                        subject = self._decode_header(headers.get('Subject', 'Без темы'))
+                        from_header = self._decode_header(headers.get('From', ''))
+                        sender_name, sender_email = self._extract_email(from_header)
+                    except Exception as e:
+                        parse_error = parse_error or str(e) or e.__class__.__name__
+                        subject = str(headers.get('Subject') or 'Без темы')
+                        sender_name, sender_email = self._extract_email(str(headers.get('From') or ''))
+                    if parse_error:
+                        logger.error(
+                            f"❌ Письмо UID {uid} папки {self.login}/{mailbox} не разобрано, "
+                            f"сохраняется заглушкой: {parse_error}"
+                        )
+                        body = f"[Текст письма не удалось разобрать: {parse_error}]"
                     
-                    created_letters.append(letter)
-                    logger.info(f"✅ Создано письмо #{letter.id}: {subject[:50]}...")
+                    message_id = (headers.get('Message-ID') or '').strip()[:998] or None
+                    # Заголовки переписки: ответ привязывается к первому письму цепочки
+                    in_reply_to = next(iter(LetterService.message_ids(headers.get('In-Reply-To'))), None)
+                    references = LetterService.message_ids(headers.get('References'))
+                    content_hash = LetterService.content_hash(subject, sender_email, body)
                     
-                    # Запускаем автоматический анализ письма
-                    try:
-                        from app.services.letter_service import LetterService
-                        import asyncio
-                        loop = asyncio.new_event_loop()
-                        asyncio.set_event_loop(loop)
-                        loop.run_until_complete(LetterService.analyze_letter(db, letter.id))
-                        loop.close()
-                        logger.info(f"✅ Письмо #{letter.id} проанализировано автоматически")
-                    except Exception as analyze_error:
-                        logger.error(f"❌ Ошибка автоматического анализа письма #{letter.id}: {analyze_error}")
-
-                    # Помечаем письмо как прочитанное в почтовом ящике
                     try:
-                        self.client.add_flags([msg_id], [b'\\Seen'])
+                        # Проверяем дубликаты по индексу хэша содержимого:
+                        # учитываются тема, отправитель и полный текст письма,
+                        # чтобы не пропускать новые письма с тем же сабжектом
+                        letter_id = None
+                        existing = db.query(Letter.id).filter(Letter.content_hash == content_hash).first()
+                        if not existing:
+                            thread_id = LetterService.find_thread(db, in_reply_to, references)
+                            # Письмо, задача анализа и чекпоинт фиксируются одной транзакцией:
+                            # после сбоя письмо не потеряется и не продублируется.
+                            # Конфликт по Message-ID — письмо уже получено (например, из другой папки)
+                            letter_id = db.execute(
+                                pg_insert(Letter)
+                                .values(
+                                    subject=subject,
+                                    body=body,
+                                    sender_name=sender_name,
+                                    sender_email=sender_email,
+                                    message_id=message_id,
+                                    content_hash=content_hash,
+                                    **LetterService.compaction_fields(body),
+                                    in_reply_to=in_reply_to[:998] if in_reply_to else None,
+                                    thread_references=" ".join(references) or None,
+                                    thread_id=thread_id,
+                                    parse_error=parse_error[:2000] if parse_error else None,
+                                    letter_type=LetterType.OTHER,  # Тип по умолчанию, AI определит позже
+                                    status=LetterStatus.NEW,
+                                    priority=3
+                                )
+                                .on_conflict_do_nothing(
+                                    index_elements=[Letter.message_id],
+                                    index_where=Letter.message_id.isnot(None)
+                                )
+                                .returning(Letter.id)
+                            ).scalar()
+                            if letter_id is not None and parse_error is None:
+                                # Анализ выполняют обработчики очереди; у нового письма
+                                # активной задачи быть не может, дедупликация не нужна.
+                                # Заглушку анализировать бессмысленно — ее разбирают вручную
+                                db.add(AnalysisJob(letter_id=letter_id))
+                            if letter_id is not None:
+                                if message_id:
+                                    LetterService.adopt_replies(db, letter_id, message_id, thread_id)
+                                # Вложения загружаются и разбираются в фоне, не задерживая прием
+                                for attachment in attachments:
+                                    db.add(LetterAttachment(
+                                        letter_id=letter_id,
+                                        account=self.login,
+                                        mailbox=mailbox,
+                                        uidvalidity=uidvalidity,
+                                        uid=uid,
+                                        **attachment
+                                    ))
+                        state.last_uid = uid
+                        db.commit()
                     except Exception as e:
-                        logger.warning(f"Не удалось пометить письмо как прочитанное: {e}")
+                        # Ошибка БД: остальные письма заберем в следующем цикле с этого UID
+                        logger.error(f"Ошибка сохранения письма UID {uid}: {e}")
+                        db.rollback()
+                        completed = False
+                        break
                     
-                except Exception as e:
-                    logger.error(f"Ошибка обработки письма {msg_id}: {e}")
-                    db.rollback()
-                    continue
+                    # Дубликаты тоже помечаем прочитанными, чтобы не возвращались снова
+                    seen_uids.append(uid)
+                    if letter_id is None:
+                        logger.info(f"Письмо уже существует: {subject[:50]}...")
+                        continue
+                    created_ids.append(letter_id)
+                    logger.info(f"✅ Создано письмо #{letter_id}: {subject[:50]}...")
+                
+                # Помечаем обработанные письма пачки прочитанными одной командой STORE
+                if seen_uids:
+                    try:
+                        self.client.add_flags(seen_uids, [b'\\Seen'])
+                    except Exception as e:
+                        logger.warning(f"Не удалось пометить письма как прочитанные: {e}")
+                if not completed:
+                    break
             
-            return created_letters
+            pending = sum(1 for uid in new_uids if uid > state.last_uid)
+            if bootstrap and completed and uidvalidity is not None:
+                # Все непрочитанные обработаны — дальше только письма с UID >= UIDNEXT
+                state.uidvalidity = uidvalidity
+                if uidnext:
+                    state.last_uid = max(state.last_uid, uidnext - 1)
+                db.commit()
+            self._record_sync(db, mailbox, pending, None if completed else "Ошибка сохранения писем")
+            
+            if not created_ids:
+                return []
+            return db.query(Letter).filter(Letter.id.in_(created_ids)).order_by(Letter.id).all()
             
         except Exception as e:
-            logger.error(f"❌ Ошибка получения писем: {e}")
+            logger.error(f"❌ Ошибка получения писем {self.name}: {e}")
+            db.rollback()
+            self._record_sync(db, mailbox, None, str(e) or e.__class__.__name__)
+            # Соединение могло оборваться — переподключимся в следующем цикле
+            self.disconnect()
             return []
     
     def get_status(self) -> dict:
@@ -242,7 +518,8 @@ class YandexMailService:
         if not self.client:
             return {
                 "connected": False,
-                "email": settings.yandex_mail_login or "Не настроено"
+                "email": self.login or "Не настроено",
+                "mailbox": self.mailbox
             }
         
         try:
@@ -250,38 +527,224 @@ class YandexMailService:
             self.client.noop()
             return {
                 "connected": True,
-                "email": settings.yandex_mail_login,
-                "server": f"{settings.yandex_mail_imap_server}:{settings.yandex_mail_imap_port}"
+                "email": self.login,
+                "mailbox": self.mailbox,
+                "server": f"{self.imap_server}:{self.imap_port}"
             }
         except:
             return {
                 "connected": False,
-                "email": settings.yandex_mail_login
+                "email": self.login,
+                "mailbox": self.mailbox
             }
 
 
-# Глобальный экземпляр сервиса
-mail_service = YandexMailService()
+# Общий лимит одновременных выборок по всем ящикам и папкам
+_ingest_slots = threading.BoundedSemaphore(max(1, settings.yandex_mail_ingest_concurrency))
 
 
-async def start_mail_monitoring(db_session_factory):
-    """Фоновая задача мониторинга почты"""
-    logger.info("🚀 Запуск мониторинга почты...")
+def configured_mailboxes() -> List[YandexMailService]:
+    """Ящики и папки из настроек: основной ящик и yandex_mail_accounts"""
+    mailboxes = []
+    if settings.yandex_mail_login:
+        for folder in settings.yandex_mail_folders.split(","):
+            if folder.strip():
+                mailboxes.append(YandexMailService(mailbox=folder.strip()))
     
-    while True:
-        try:
-            # Создаем новую сессию БД для каждой проверки
-            db = next(db_session_factory())
-            
+    accounts = json.loads(settings.yandex_mail_accounts) if settings.yandex_mail_accounts.strip() else []
+    for account in accounts:
+        if not account.get("login") or not account.get("password"):
+            raise ValueError("В yandex_mail_accounts у каждого ящика должны быть login и password")
+        for folder in account.get("folders") or ["INBOX"]:
+            mailboxes.append(YandexMailService(
+                login=account["login"],
+                password=account["password"],
+                mailbox=folder,
+                imap_server=account.get("imap_server"),
+                imap_port=account.get("imap_port")
+            ))
+    
+    names = [mailbox.name for mailbox in mailboxes]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        raise ValueError(f"Папки указаны несколько раз: {', '.join(sorted(duplicates))}")
+    return mailboxes
+
+
+# Все обслуживаемые папки; mail_service — первая (основной ящик, INBOX)
+mailboxes = configured_mailboxes()
+mail_service = mailboxes[0] if mailboxes else YandexMailService()
+
+
+def mailbox_statuses(db: Session) -> List[dict]:
+    """Состояние синхронизации каждой папки с отставанием.
+
+    lag_seconds — сколько прошло с момента, когда папка была разобрана полностью:
+    столько может ждать самое старое необработанное письмо. Состояние берется
+    из БД, поэтому отражает и прием в отдельном процессе (app.worker --ingest).
+    """
+    now = datetime.now(timezone.utc)
+    states = {
+        (state.account, state.mailbox): state
+        for state in db.query(MailboxSyncState).all()
+    }
+    result = []
+    for mailbox in mailboxes:
+        state = states.get((mailbox.login, mailbox.mailbox))
+        caught_up_at = state.caught_up_at if state else None
+        result.append({
+            "email": mailbox.login,
+            "mailbox": mailbox.mailbox,
+            "last_uid": state.last_uid if state else None,
+            "last_sync_at": state.last_sync_at if state else None,
+            "caught_up_at": caught_up_at,
+            "pending": state.pending if state else None,
+            "lag_seconds": round((now - caught_up_at).total_seconds(), 1) if caught_up_at else None,
+            "last_error": state.last_error if state else None,
+        })
+    return result
+
+
+class IdleNotSupported(Exception):
+    """Сервер не поддерживает IMAP IDLE"""
+
+
+class MailIdleListener:
+    """Отдельное IMAP-соединение в режиме IDLE: сообщает о новых письмах.
+
+    Само получение писем выполняет сервис папки по своему соединению,
+    поэтому IDLE не мешает ручной проверке почты через API.
+    """
+    
+    def __init__(self, mail: YandexMailService, mailbox: str = 'INBOX'):
+        self.mail = mail
+        self.mailbox = mailbox
+    
+    def _idle_session(self, client: IMAPClient, wake: Callable[[], None], stop: threading.Event):
+        """IDLE с перезапуском до таймаута сервера"""
+        while not stop.is_set():
+            deadline = time.monotonic() + settings.yandex_mail_idle_renew_seconds
+            new_mail = False
+            client.idle()
             try:
-                # Синхронный вызов в async контексте
-                await asyncio.to_thread(mail_service.fetch_new_emails, db)
+                # Короткие ожидания, чтобы быстро реагировать на остановку
+                while not stop.is_set() and time.monotonic() < deadline:
+                    responses = client.idle_check(timeout=1)
+                    if any(len(item) > 1 and item[1] in (b'EXISTS', b'RECENT') for item in responses):
+                        new_mail = True
+                        break
+            finally:
+                client.idle_done()
+            if new_mail:
+                wake()
+    
+    def run(self, wake: Callable[[], None], stop: threading.Event):
+        """Блокирующий цикл (выполняется в отдельном потоке) с переподключением"""
+        backoff = 1.0
+        while not stop.is_set():
+            client = None
+            try:
+                client = self.mail.create_client()
+                if b'IDLE' not in client.capabilities():
+                    raise IdleNotSupported()
+                client.select_folder(self.mailbox, readonly=True)
+                logger.info(f"📡 IMAP IDLE: ожидание новых писем в {self.mail.login}/{self.mailbox}")
+                backoff = 1.0
+                # Письма, пришедшие пока соединения не было
+                wake()
+                self._idle_session(client, wake, stop)
+            except IdleNotSupported:
+                raise
+            except Exception as e:
+                logger.warning(f"⚠️ IMAP IDLE: соединение потеряно ({e}), повтор через {backoff:.0f} с")
+                stop.wait(backoff)
+                backoff = min(backoff * 2, settings.yandex_mail_reconnect_max_seconds)
             finally:
-                db.close()
+                if client is not None:
+                    try:
+                        client.logout()
+                    except Exception:
+                        pass
+
+
+async def _fetch_once(mail: YandexMailService, db_session_factory):
+    # Создаем новую сессию БД для каждой проверки
+    db = next(db_session_factory())
+    try:
+        # Синхронный вызов в async контексте
+        await asyncio.to_thread(mail.fetch_new_emails, db)
+    finally:
+        db.close()
+
+
+async def _monitor_idle(mail: YandexMailService, db_session_factory, executor: ThreadPoolExecutor):
+    """Получение писем по уведомлениям IDLE; редкий опрос остается страховкой"""
+    loop = asyncio.get_running_loop()
+    wake_event = asyncio.Event()
+    stop = threading.Event()
+    listener = MailIdleListener(mail, mail.mailbox)
+    idle_task = loop.run_in_executor(
+        executor, listener.run, lambda: loop.call_soon_threadsafe(wake_event.set), stop
+    )
+    try:
+        while True:
+            waiter = asyncio.create_task(wake_event.wait())
+            await asyncio.wait(
+                {waiter, idle_task},
+                timeout=settings.yandex_mail_idle_fallback_poll,
+                return_when=asyncio.FIRST_COMPLETED
+            )
+            waiter.cancel()
+            wake_event.clear()
+            if idle_task.done():
+                idle_task.result()  # IdleNotSupported — переход на опрос
+                return
+            try:
+                await _fetch_once(mail, db_session_factory)
+            except Exception as e:
+                logger.error(f"❌ Ошибка мониторинга {mail.name}: {e}")
+    finally:
+        stop.set()
+
+
+async def _monitor_mailbox(mail: YandexMailService, db_session_factory, idle_executor: ThreadPoolExecutor):
+    """Мониторинг одной папки: IDLE, при его отсутствии — периодический опрос"""
+    if settings.yandex_mail_mode == "idle" and mail.login and mail.password:
+        try:
+            await _monitor_idle(mail, db_session_factory, idle_executor)
+        except IdleNotSupported:
+            logger.warning(f"⚠️ Сервер {mail.imap_server} не поддерживает IMAP IDLE, переход на периодический опрос")
+    
+    while True:
+        try:
+            await _fetch_once(mail, db_session_factory)
             
             # Ожидание до следующей проверки
             await asyncio.sleep(settings.yandex_mail_check_interval)
             
         except Exception as e:
-            logger.error(f"❌ Ошибка мониторинга: {e}")
+            logger.error(f"❌ Ошибка мониторинга {mail.name}: {e}")
             await asyncio.sleep(60)
+
+
+async def start_mail_monitoring(db_session_factory):
+    """Фоновая задача мониторинга почты: отдельная задача на каждую папку"""
+    logger.info(f"🚀 Запуск мониторинга почты: {', '.join(mail.name for mail in mailboxes) or 'ящики не настроены'}")
+    if not mailboxes:
+        return
+    
+    # IDLE блокирует поток на все время работы, поэтому у слушателей свой пул:
+    # по потоку на каждую папку, пул по умолчанию (asyncio.to_thread) остается
+    # приему писем и запросам к базе
+    idle_executor = ThreadPoolExecutor(max_workers=len(mailboxes), thread_name_prefix="mail-idle")
+    tasks = [
+        asyncio.create_task(_monitor_mailbox(mail, db_session_factory, idle_executor))
+        for mail in mailboxes
+    ]
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        idle_executor.shutdown(wait=False)
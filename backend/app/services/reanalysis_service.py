@@ -0,0 +1,288 @@
+"""
+Массовый повторный анализ писем (например, после изменения промпта или базы знаний)
+"""
+import asyncio
+import logging
+from datetime import datetime, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from sqlalchemy.orm import Session
+
+from app.config import settings
+from app.database import SessionLocal
+from app.models import Letter, LetterStatus, LetterType, ReanalysisRun
+from app.services.letter_service import LetterService
+
+logger = logging.getLogger(__name__)
+
+
+class ReanalysisService:
+    """Создание запусков, прогресс и отмена"""
+
+    @staticmethod
+    def create_run(
+        db: Session,
+        status: Optional[LetterStatus] = None,
+        letter_type: Optional[LetterType] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        concurrency: Optional[int] = None,
+        force: bool = False,
+        user_id: Optional[int] = None
+    ) -> ReanalysisRun:
+        """Постановка запуска; письма выбираются обработчиком при старте"""
+        concurrency = concurrency or settings.reanalysis_default_concurrency
+        run = ReanalysisRun(
+            filters={
+                "status": status.value if status else None,
+                "letter_type": letter_type.value if letter_type else None,
+                "date_from": date_from.isoformat() if date_from else None,
+                "date_to": date_to.isoformat() if date_to else None,
+            },
+            force=force,
+            concurrency=max(1, min(concurrency, settings.reanalysis_max_concurrency)),
+            created_by=user_id
+        )
+        db.add(run)
+        db.commit()
+        db.refresh(run)
+        logger.info(f"🔄 Создан запуск повторного анализа #{run.id}: {run.filters}")
+        return run
+
+    @staticmethod
+    def select_letter_ids(db: Session, filters: Dict[str, Any]) -> List[int]:
+        """ID писем по фильтрам запуска"""
+        query = db.query(Letter.id)
+        if filters.get("status"):
+            query = query.filter(Letter.status == LetterStatus(filters["status"]))
+        if filters.get("letter_type"):
+            query = query.filter(Letter.letter_type == LetterType(filters["letter_type"]))
+        if filters.get("date_from"):
+            query = query.filter(Letter.created_at >= datetime.fromisoformat(filters["date_from"]))
+        if filters.get("date_to"):
+            query = query.filter(Letter.created_at <= datetime.fromisoformat(filters["date_to"]))
+        return [row.id for row in query.order_by(Letter.id).all()]
+
+    @staticmethod
+    def cancel(db: Session, run_id: int) -> Optional[ReanalysisRun]:
+        """Отмена: queued завершается сразу, running — после текущих писем"""
+        run = db.query(ReanalysisRun).filter(ReanalysisRun.id == run_id).first()
+        if run is None:
+            return None
+        if run.status == "queued":
+            run.status = "cancelled"
+            run.finished_at = datetime.now(timezone.utc)
+        elif run.status == "running":
+            run.status = "cancelling"
+        db.commit()
+        db.refresh(run)
+        return run
+
+    @staticmethod
+    def run_info(run: ReanalysisRun) -> Dict[str, Any]:
+        """Состояние запуска с прогрессом и оценкой оставшегося времени"""
+        done = run.processed + run.skipped + run.failed
+        eta_seconds = None
+        if run.status == "running" and run.started_at and done:
+            elapsed = (datetime.now(timezone.utc) - run.started_at).total_seconds()
+            eta_seconds = round(elapsed / done * (run.total - done), 1)
+        return {
+            "id": run.id,
+            "status": run.status,
+            "filters": run.filters,
+            "force": run.force,
+            "concurrency": run.concurrency,
+            "total": run.total,
+            "processed": run.processed,
+            "skipped": run.skipped,
+            "failed": run.failed,
+            "progress": round(done / run.total, 3) if run.total else (1.0 if run.status == "completed" else 0.0),
+            "eta_seconds": eta_seconds,
+            "last_error": run.last_error,
+            "created_at": run.created_at,
+            "started_at": run.started_at,
+            "finished_at": run.finished_at,
+        }
+
+    @staticmethod
+    def list_runs(db: Session, limit: int = 20) -> List[Dict[str, Any]]:
+        runs = db.query(ReanalysisRun).order_by(ReanalysisRun.id.desc()).limit(limit).all()
+        return [ReanalysisService.run_info(run) for run in runs]
+
+
+reanalysis_service = ReanalysisService()
+
+
+def _claim_run(db: Session) -> Optional[tuple[int, List[int]]]:
+    """Захват ожидающего или брошенного запуска; возвращает id и письма запуска"""
+    now = datetime.now(timezone.utc)
+    run = (
+        db.query(ReanalysisRun)
+        .filter(
+            (ReanalysisRun.status == "queued")
+            | (
+                ReanalysisRun.status.in_(("running", "cancelling"))
+                & (ReanalysisRun.heartbeat_at < now - timedelta(seconds=settings.reanalysis_stale_seconds))
+            )
+        )
+        .order_by(ReanalysisRun.id)
+        .limit(1)
+        .with_for_update(skip_locked=True)
+        .first()
+    )
+    if run is None:
+        db.commit()
+        return None
+    if run.status == "cancelling":
+        run.status = "cancelled"
+        run.finished_at = now
+        db.commit()
+        return None
+
+    letter_ids = ReanalysisService.select_letter_ids(db, run.filters or {})
+    # Повторный захват после падения начинает заново: неизмененные письма будут пропущены
+    run.status = "running"
+    run.total = len(letter_ids)
+    run.processed = run.skipped = run.failed = 0
+    run.started_at = now
+    run.heartbeat_at = now
+    db.commit()
+    return run.id, letter_ids
+
+
+def _claim_with_session(db_session_factory) -> Optional[tuple[int, List[int]]]:
+    db: Session = next(db_session_factory())
+    try:
+        return _claim_run(db)
+    finally:
+        db.close()
+
+
+def _needs_analysis(letter_id: int, force: bool) -> bool:
+    db = SessionLocal()
+    try:
+        letter = db.query(Letter).filter(Letter.id == letter_id).first()
+        if letter is None:
+            return False
+        return force or letter.analysis_fingerprint != LetterService.analysis_fingerprint(db, letter)
+    finally:
+        db.close()
+
+
+async def _analyze_one(letter_id: int, force: bool) -> str:
+    """Повторный анализ одного письма; возвращает processed / skipped / failed"""
+    if not await asyncio.to_thread(_needs_analysis, letter_id, force):
+        return "skipped"
+    db = SessionLocal()
+    try:
+        # Письма в работе сохраняют статус, дедлайн и маршрут согласования
+        await LetterService.analyze_letter(db, letter_id, refresh_only=True)
+        return "processed"
+    finally:
+        db.close()
+
+
+def _run_settings(run_id: int) -> tuple[bool, int]:
+    db = SessionLocal()
+    try:
+        run = db.query(ReanalysisRun).filter(ReanalysisRun.id == run_id).first()
+        return run.force, run.concurrency
+    finally:
+        db.close()
+
+
+def _save_progress(run_id: int, counters: Dict[str, int], last_error: Optional[str],
+                   finished: bool = False, cancelled: bool = False) -> str:
+    """Запись прогресса и heartbeat; возвращает текущий статус запуска (для отмены)"""
+    db = SessionLocal()
+    try:
+        run = db.query(ReanalysisRun).filter(ReanalysisRun.id == run_id).first()
+        run.processed = counters["processed"]
+        run.skipped = counters["skipped"]
+        run.failed = counters["failed"]
+        run.last_error = last_error
+        run.heartbeat_at = datetime.now(timezone.utc)
+        if finished:
+            run.status = "cancelled" if cancelled or run.status == "cancelling" else "completed"
+            run.finished_at = datetime.now(timezone.utc)
+        db.commit()
+        if finished:
+            logger.info(
+                f"✅ Повторный анализ #{run_id} {run.status}: обработано {run.processed}, "
+                f"без изменений {run.skipped}, ошибок {run.failed}"
+            )
+        return run.status
+    finally:
+        db.close()
+
+
+def _touch(run_id: int) -> str:
+    """Heartbeat запуска; возвращает текущий статус (для отмены)"""
+    db = SessionLocal()
+    try:
+        run = db.query(ReanalysisRun).filter(ReanalysisRun.id == run_id).first()
+        run.heartbeat_at = datetime.now(timezone.utc)
+        db.commit()
+        return run.status
+    finally:
+        db.close()
+
+
+async def _execute_run(run_id: int, letter_ids: List[int]):
+    force, concurrency = await asyncio.to_thread(_run_settings, run_id)
+
+    logger.info(f"🔄 Повторный анализ #{run_id}: {len(letter_ids)} писем, параллельность {concurrency}")
+    counters = {"processed": 0, "skipped": 0, "failed": 0}
+    last_error: Optional[str] = None
+    cancelled = False
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def heartbeat():
+        # Независимо от завершения писем: долгий запрос к модели не делает запуск брошенным
+        nonlocal cancelled
+        while True:
+            await asyncio.sleep(settings.reanalysis_stale_seconds / 3)
+            try:
+                if await asyncio.to_thread(_touch, run_id) == "cancelling":
+                    cancelled = True
+            except Exception as e:
+                logger.warning(f"⚠️ Heartbeat повторного анализа #{run_id} не записан: {e}")
+
+    async def worker(letter_id: int):
+        nonlocal last_error, cancelled
+        async with semaphore:
+            if cancelled:
+                return
+            try:
+                outcome = await _analyze_one(letter_id, force)
+            except Exception as e:
+                outcome = "failed"
+                last_error = f"Письмо {letter_id}: {e}"
+            counters[outcome] += 1
+            status = await asyncio.to_thread(_save_progress, run_id, dict(counters), last_error)
+            if status == "cancelling":
+                cancelled = True
+
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        await asyncio.gather(*(worker(letter_id) for letter_id in letter_ids))
+    finally:
+        heartbeat_task.cancel()
+
+    await asyncio.to_thread(_save_progress, run_id, counters, last_error, True, cancelled)
+
+
+async def run_reanalysis_runs(db_session_factory, interval_seconds: Optional[float] = None):
+    """Фоновая задача: выполнение запусков повторного анализа по одному"""
+    interval_seconds = interval_seconds or settings.reanalysis_poll_interval
+    logger.info("🔄 Запущен обработчик массового повторного анализа")
+    while True:
+        try:
+            claimed = await asyncio.to_thread(_claim_with_session, db_session_factory)
+            if claimed is None:
+                await asyncio.sleep(interval_seconds)
+                continue
+            await _execute_run(*claimed)
+        except Exception as e:
+            logger.error(f"❌ Ошибка массового повторного анализа: {e}")
+            await asyncio.sleep(interval_seconds)
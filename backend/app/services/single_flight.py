@@ -0,0 +1,164 @@
+"""
+Объединение одновременных анализов одного письма (single-flight).
+
+В процессе второй вызов ждет результата первого, между репликами то же
+обеспечивает короткий захват письма в Postgres (letters.analysis_claimed_until).
+Захват ставится и продлевается отдельными короткими транзакциями, поэтому
+соединение пула не удерживается на все время запроса к модели, а захват
+упавшей реплики или не снятый из-за ошибки истекает сам.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import uuid
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from sqlalchemy import text
+
+from app.config import settings
+from app.database import engine
+
+logger = logging.getLogger(__name__)
+
+
+class SingleFlight:
+    """Один выполняющийся вызов на ключ (id письма); остальные ждут его завершения.
+
+    Результат выставляется в concurrent.futures.Future: ошибку выполнявшего
+    вызова, которую никто не ждал, asyncio не логирует как неполученную.
+    """
+
+    def __init__(self, pg_enabled: bool, claim_ttl: float = 120.0, poll_interval: float = 0.5):
+        self.pg_enabled = pg_enabled
+        self.claim_ttl = claim_ttl
+        self.poll_interval = poll_interval
+        self._inflight: Dict[int, concurrent.futures.Future] = {}
+        self._lock = threading.Lock()
+        self.stats = {"leaders": 0, "coalesced_local": 0, "coalesced_remote": 0, "pg_errors": 0}
+
+    # --- Захват письма в Postgres ---
+
+    def _pg_claim(self, key: int, token: str) -> bool:
+        """Захват или продление захвата; False — анализ идет в другой реплике"""
+        with engine.begin() as connection:
+            claimed = connection.execute(
+                text(
+                    "UPDATE letters SET analysis_claimed_until = now() + make_interval(secs => :ttl), "
+                    "analysis_claimed_by = :token "
+                    "WHERE id = :key AND (analysis_claimed_by = :token "
+                    "OR analysis_claimed_until IS NULL OR analysis_claimed_until < now()) "
+                    "RETURNING id"
+                ),
+                {"key": key, "token": token, "ttl": self.claim_ttl}
+            ).first()
+            if claimed is None:
+                # Письма нет — захватывать нечего, ошибку вернет сам анализ
+                exists = connection.execute(text("SELECT 1 FROM letters WHERE id = :key"), {"key": key}).first()
+                return exists is None
+        return True
+
+    def _pg_release(self, key: int, token: str):
+        with engine.begin() as connection:
+            connection.execute(
+                text(
+                    "UPDATE letters SET analysis_claimed_until = NULL, analysis_claimed_by = NULL "
+                    "WHERE id = :key AND analysis_claimed_by = :token"
+                ),
+                {"key": key, "token": token}
+            )
+
+    async def _pg_acquire(self, key: int, token: str) -> tuple[bool, bool]:
+        """(claimed, waited): waited=True, если ждали завершения анализа в другой реплике"""
+        waited = False
+        while True:
+            try:
+                claimed = await asyncio.to_thread(self._pg_claim, key, token)
+            except Exception as e:
+                # Без Postgres остается только объединение внутри процесса
+                self.stats["pg_errors"] += 1
+                logger.warning(f"⚠️ Межрепличный захват анализа недоступен: {e}")
+                return False, waited
+            if claimed:
+                return True, waited
+            waited = True
+            await asyncio.sleep(self.poll_interval)
+
+    async def _pg_keep_alive(self, key: int, token: str):
+        """Продление захвата, пока выполняется анализ"""
+        while True:
+            await asyncio.sleep(self.claim_ttl / 3)
+            try:
+                if not await asyncio.to_thread(self._pg_claim, key, token):
+                    logger.warning(f"⚠️ Захват анализа письма {key} перехвачен другой репликой")
+                    return
+            except Exception as e:
+                self.stats["pg_errors"] += 1
+                logger.warning(f"⚠️ Не удалось продлить захват анализа письма {key}: {e}")
+
+    # --- Основной интерфейс ---
+
+    async def run(self, key: int, func: Callable[[], Awaitable[Any]]) -> tuple[bool, Optional[Any]]:
+        """Выполнение func, если по ключу ничего не выполняется.
+
+        Возвращает (True, результат) для выполнившего вызова и (False, None)
+        для дождавшихся чужого; ошибка выполнявшего передается всем ожидавшим.
+        """
+        with self._lock:
+            shared = self._inflight.get(key)
+            leader = shared is None
+            if leader:
+                shared = concurrent.futures.Future()
+                self._inflight[key] = shared
+
+        if not leader:
+            self.stats["coalesced_local"] += 1
+            await asyncio.wrap_future(shared)
+            return False, None
+
+        token = uuid.uuid4().hex
+        claimed = False
+        keep_alive = None
+        try:
+            if self.pg_enabled:
+                claimed, waited = await self._pg_acquire(key, token)
+                if waited:
+                    # Другая реплика уже выполнила анализ — повторять не нужно
+                    self.stats["coalesced_remote"] += 1
+                    shared.set_result(None)
+                    return False, None
+                if claimed:
+                    keep_alive = asyncio.create_task(self._pg_keep_alive(key, token))
+
+            self.stats["leaders"] += 1
+            result = await func()
+            shared.set_result(None)
+            return True, result
+        except asyncio.CancelledError:
+            shared.set_exception(RuntimeError("Анализ письма прерван"))
+            raise
+        except Exception as e:
+            shared.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                self._inflight.pop(key, None)
+            if keep_alive is not None:
+                keep_alive.cancel()
+            if claimed:
+                try:
+                    await asyncio.to_thread(self._pg_release, key, token)
+                except Exception as e:
+                    # Захват истечет через claim_ttl
+                    logger.warning(f"⚠️ Не удалось снять захват анализа письма {key}: {e}")
+
+    def get_metrics(self) -> Dict[str, Any]:
+        metrics = dict(self.stats)
+        metrics["in_flight"] = len(self._inflight)
+        return metrics
+
+
+letter_single_flight = SingleFlight(
+    pg_enabled=settings.analysis_pg_single_flight,
+    claim_ttl=settings.analysis_claim_ttl_seconds
+)
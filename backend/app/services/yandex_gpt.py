@@ -1,9 +1,78 @@
+import asyncio
+import hashlib
 import httpx
 import json
-import os
-from typing import Dict, Any
+import logging
+import time
+from contextlib import asynccontextmanager
+from typing import Dict, Any, Optional, Callable, Awaitable, AsyncIterator
 from datetime import datetime
 from app.config import settings
+from app.services.llm_cache import llm_cache, make_cache_key
+from app.services.knowledge_base import knowledge_base_store
+from app.services.kb_retrieval import estimate_tokens
+from app.services.llm_limiter import llm_limiter, RETRY_STATUSES
+from app.services.llm_circuit_breaker import llm_circuit_breaker, CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# Версия промптов: увеличивать при любом изменении текста промптов,
+# иначе кэш будет возвращать результаты старых промптов
+PROMPT_VERSION = "3"
+
+# Стили черновиков ответа: ключ -> (название, для кого, требования)
+DRAFT_TONES = {
+    "strict_official": (
+        "СТРОГИЙ ОФИЦИАЛЬНЫЙ",
+        "для государственных органов, регуляторов, судов",
+        [
+            'Пассивные конструкции: "Банком установлено", "Принято решение"',
+            'Избегать местоимения "мы"',
+            "Юридическая терминология",
+            "Обязательные ссылки на законы",
+            "Использовать полное название банка и реквизиты из базы знаний",
+        ],
+    ),
+    "corporate": (
+        "ДЕЛОВОЙ КОРПОРАТИВНЫЙ",
+        "для партнеров, корпоративных клиентов",
+        [
+            'Активные конструкции: "Мы рады сообщить"',
+            "Фокус на партнерстве",
+            "Умеренная официальность",
+            "Указывать контактные данные из базы знаний",
+        ],
+    ),
+    "client_oriented": (
+        "КЛИЕНТООРИЕНТИРОВАННЫЙ",
+        "для физических лиц, жалоб",
+        [
+            "Эмпатия и понимание",
+            "Простые объяснения без жаргона",
+            "Персонализация",
+            "Позитивный тон",
+            "Конкретные цифры из базы знаний (ставки, суммы, сроки)",
+        ],
+    ),
+    "brief_info": (
+        "КРАТКИЙ ИНФОРМАЦИОННЫЙ",
+        "для простых запросов",
+        [
+            "Максимальная лаконичность",
+            "Структурированная информация (списки)",
+            "Без лишних слов",
+            "Точные данные из базы знаний",
+        ],
+    ),
+}
+
+
+def _format_tone(index: int, key: str) -> str:
+    """Описание стиля ответа для системного промпта"""
+    title, audience, rules = DRAFT_TONES[key]
+    lines = [f"{index}. {title} ({key}) - {audience}:"]
+    lines.extend(f"   - {rule}" for rule in rules)
+    return "\n".join(lines)
 
 
 class YandexGPTService:
@@ -11,105 +80,143 @@ class YandexGPTService:
         self.api_key = settings.yandex_api_key
         self.folder_id = settings.yandex_folder_id
         self.model = settings.yandex_model
-        self.base_url = "https://llm.api.cloud.yandex.net/foundationModels/v1/completion"
-        self.knowledge_base = self._load_knowledge_base()
+        self.base_url = f"{settings.yandex_gpt_base_url.rstrip('/')}/completion"
+        self.async_url = f"{settings.yandex_gpt_base_url.rstrip('/')}/completionAsync"
+        
+        # Общий HTTP-клиент создается в lifespan приложения и живет до остановки
+        self._client: Optional[httpx.AsyncClient] = None
+        self._client_loop: Optional[asyncio.AbstractEventLoop] = None
+        self._http_stats = {
+            "requests_total": 0,
+            "requests_failed": 0,
+            "in_flight": 0,
+            "max_in_flight": 0,
+            "ephemeral_clients": 0,
+            "hedged": 0,
+            "hedge_wins": 0,
+            "streams_total": 0,
+        }
     
-    def _load_knowledge_base(self) -> Dict[str, Any]:
-        """Загрузка базы знаний банка из JSON файла"""
-        try:
-            kb_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), "..", "knowledge_base.json")
-            with open(kb_path, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except Exception as e:
-            print(f"Ошибка загрузки базы знаний: {e}")
-            return {}
+    def _build_client(self) -> httpx.AsyncClient:
+        """Создание HTTP-клиента с пулом соединений и keep-alive"""
+        http2 = settings.yandex_gpt_http2
+        if http2:
+            try:
+                import h2  # noqa: F401
+            except ImportError:
+                logger.warning("⚠️ Пакет h2 не установлен, HTTP/2 отключен")
+                http2 = False
+        
+        limits = httpx.Limits(
+            max_connections=settings.yandex_gpt_max_connections,
+            max_keepalive_connections=settings.yandex_gpt_max_keepalive_connections,
+            keepalive_expiry=settings.yandex_gpt_keepalive_expiry
+        )
+        timeout = httpx.Timeout(
+            settings.yandex_gpt_read_timeout,
+            connect=settings.yandex_gpt_connect_timeout
+        )
+        return httpx.AsyncClient(limits=limits, timeout=timeout, http2=http2)
     
-    def _format_knowledge_base(self) -> str:
-        """Форматирование базы знаний для промпта"""
-        if not self.knowledge_base:
-            return ""
-        
-        kb_text = "\n\n=== БАЗА ЗНАНИЙ БАНКА ===\n\n"
-        
-        # Основная информация о банке
-        if "bank_info" in self.knowledge_base:
-            info = self.knowledge_base["bank_info"]
-            kb_text += f"**{info.get('full_name')}**\n"
-            kb_text += f"Краткое название: {info.get('short_name')}\n"
-            kb_text += f"Слоган: {info.get('slogan')}\n\n"
-            
-            if "legal_details" in info:
-                legal = info["legal_details"]
-                kb_text += f"ИНН: {legal.get('inn')}, КПП: {legal.get('kpp')}\n"
-                kb_text += f"ОГРН: {legal.get('ogrn')}, БИК: {legal.get('bik')}\n"
-                kb_text += f"Юр. адрес: {legal.get('legal_address')}\n\n"
-            
-            if "contact_info" in info:
-                contact = info["contact_info"]
-                kb_text += f"Телефон: {contact.get('main_phone')}\n"
-                kb_text += f"Email: {contact.get('email_general')}\n"
-                kb_text += f"Сайт: {contact.get('website')}\n\n"
-        
-        # Кредитные продукты
-        if "credit_products" in self.knowledge_base:
-            kb_text += "**КРЕДИТНЫЕ ПРОДУКТЫ:**\n\n"
-            credits = self.knowledge_base["credit_products"]
-            
-            if "consumer_loans" in credits:
-                cl = credits["consumer_loans"]
-                kb_text += f"1. {cl.get('name')}: ставка от {cl['interest_rate']['min']}%, "
-                kb_text += f"сумма от {cl['amount']['min']:,} до {cl['amount']['max']:,} руб, "
-                kb_text += f"срок до {cl['term']['max_months']} мес\n"
-            
-            if "mortgage" in credits:
-                mort = credits["mortgage"]
-                kb_text += f"2. {mort.get('name')}: ставка от {mort['programs']['standard']['interest_rate']['min']}%, "
-                kb_text += f"первый взнос от {mort['programs']['standard']['initial_payment']['min_percent']}%\n"
-            
-            if "car_loan" in credits:
-                car = credits["car_loan"]
-                kb_text += f"3. {car.get('name')}: ставка от {car['new_car']['interest_rate']['min']}%, "
-                kb_text += f"сумма до {car['new_car']['amount']['max']:,} руб\n"
-            
-            if "credit_cards" in credits:
-                cc = credits["credit_cards"]
-                kb_text += f"4. {cc.get('name')}: лимит до {cc['limit']['max']:,} руб, "
-                kb_text += f"льготный период {cc['interest_rate']['grace_period_days']} дней, кэшбэк {cc['cashback']['standard']}\n"
-            
-            kb_text += "\n"
+    async def startup(self):
+        """Создание общего HTTP-клиента (вызывается из lifespan)"""
+        if self._client is None:
+            self._client = self._build_client()
+            self._client_loop = asyncio.get_running_loop()
+            logger.info("🔗 HTTP-клиент Yandex GPT создан")
+    
+    async def shutdown(self):
+        """Закрытие общего HTTP-клиента (вызывается из lifespan)"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+            self._client_loop = None
+            logger.info("🔌 HTTP-клиент Yandex GPT закрыт")
+    
+    @asynccontextmanager
+    async def _http_client(self):
+        """Общий клиент, если он принадлежит текущему event loop.
+
+        Соединения httpx привязаны к event loop, поэтому вызовы из другого
+        loop (например, скрипт с собственным asyncio.run) получают временный клиент.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            loop = None
         
-        # Депозиты
-        if "deposit_products" in self.knowledge_base:
-            kb_text += "**ВКЛАДЫ:**\n\n"
-            deposits = self.knowledge_base["deposit_products"]
-            
-            for key, dep in deposits.items():
-                if isinstance(dep, dict) and "name" in dep:
-                    rates = dep.get("interest_rate", {})
-                    if isinstance(rates, dict):
-                        max_rate = max([v for v in rates.values() if isinstance(v, (int, float))], default=0)
-                        kb_text += f"- {dep['name']}: до {max_rate}% годовых\n"
-            
-            kb_text += "\n"
+        if self._client is not None and loop is self._client_loop:
+            yield self._client
+            return
         
-        # Тарифы
-        if "tariffs_and_fees" in self.knowledge_base:
-            kb_text += "**ОСНОВНЫЕ ТАРИФЫ:**\n"
-            tariffs = self.knowledge_base["tariffs_and_fees"]
-            
-            if "transfers" in tariffs:
-                kb_text += "- Переводы внутри банка: бесплатно\n"
-                kb_text += "- Переводы по СБП: бесплатно\n"
-            
-            if "account_services" in tariffs:
-                services = tariffs["account_services"]
-                if "sms_notifications" in services:
-                    kb_text += f"- СМС-уведомления: {services['sms_notifications']['fee_per_month']} руб/мес\n"
+        self._http_stats["ephemeral_clients"] += 1
+        async with self._build_client() as client:
+            yield client
+    
+    def get_http_metrics(self) -> Dict[str, Any]:
+        """Метрики использования пула соединений"""
+        metrics = dict(self._http_stats)
+        metrics["shared_client"] = self._client is not None
+        metrics["http2"] = settings.yandex_gpt_http2
+        metrics["max_connections"] = settings.yandex_gpt_max_connections
+        metrics["max_keepalive_connections"] = settings.yandex_gpt_max_keepalive_connections
         
-        return kb_text
+        # Состояние пула берем из транспорта httpx (если доступно)
+        pool = getattr(getattr(self._client, "_transport", None), "_pool", None)
+        connections = getattr(pool, "connections", None)
+        if connections is not None:
+            metrics["pool_connections"] = len(connections)
+            metrics["pool_idle_connections"] = sum(1 for c in connections if c.is_idle())
+        return metrics
     
-    async def generate(self, prompt: str, system_prompt: str = "") -> str:
-        """Отправка запроса к Yandex GPT"""
+    @property
+    def knowledge_base(self) -> Dict[str, Any]:
+        """Актуальная база знаний (перечитывается при изменении файла)"""
+        return knowledge_base_store.current().data
+    
+    @property
+    def kb_version(self) -> str:
+        """Хеш содержимого базы знаний — используется в ключах кэша"""
+        return knowledge_base_store.current().content_hash
+    
+    def _cache_key(self, kind: str, subject: str, body: str, extra: Optional[Dict[str, Any]] = None) -> Optional[str]:
+        """Ключ кэша для запроса (None, если кэш выключен)"""
+        if not settings.llm_cache_enabled:
+            return None
+        return make_cache_key(kind, subject, body, PROMPT_VERSION, self.kb_version, self.model, extra)
+    
+    def analysis_fingerprint(self, subject: str, body: str) -> str:
+        """Отпечаток входных данных анализа: письмо, версия промпта, база знаний, модель"""
+        return make_cache_key("letter", subject, body, PROMPT_VERSION, self.kb_version, self.model)
+    
+    async def _cache_get(self, key: Optional[str]) -> Optional[Any]:
+        if key is None:
+            return None
+        return await asyncio.to_thread(llm_cache.get, key)
+    
+    async def _cache_set(self, key: Optional[str], kind: str, value: Any):
+        if key is None:
+            return
+        await asyncio.to_thread(llm_cache.set, key, kind, value)
+    
+    def _format_knowledge_base(self) -> str:
+        """Блок базы знаний для промпта (скомпилирован заранее)"""
+        return knowledge_base_store.current().prompt_block
+    
+    def _knowledge_base_for(self, subject: str, body: str) -> str:
+        """Блок базы знаний для конкретного письма: фиксированная сводка
+        или релевантные разделы, если включен выбор по релевантности"""
+        if not settings.kb_retrieval_enabled:
+            return self._format_knowledge_base()
+        return knowledge_base_store.current().index.prompt_block(
+            f"{subject}\n{body}",
+            top_k=settings.kb_retrieval_top_k,
+            token_budget=settings.kb_retrieval_token_budget,
+            min_score_ratio=settings.kb_retrieval_min_score_ratio
+        )
+    
+    def _build_request(self, prompt: str, system_prompt: str, stream: bool) -> tuple[Dict[str, str], Dict[str, Any]]:
+        """Заголовки и тело запроса к API completion"""
         headers = {
             "Content-Type": "application/json",
             "Authorization": f"Api-Key {self.api_key}",
@@ -130,25 +237,238 @@ class YandexGPTService:
         payload = {
             "modelUri": f"gpt://{self.folder_id}/{self.model}/latest",
             "completionOptions": {
-                "stream": False,
+                "stream": stream,
                 "temperature": 0.3,
                 "maxTokens": 4000
             },
             "messages": messages
         }
+        return headers, payload
+    
+    async def generate(self, prompt: str, system_prompt: str = "") -> str:
+        """Отправка запроса к Yandex GPT"""
+        headers, payload = self._build_request(prompt, system_prompt, stream=False)
+        
+        estimated_tokens = estimate_tokens(system_prompt + prompt)
+        attempt = 0
+        while True:
+            # При деградации провайдера отказываем сразу, не занимая очередь
+            llm_circuit_breaker.precheck()
+            # Общий лимит процесса: очередь, запросы/сек, токены/мин, пауза после 429.
+            # Слот занимает каждая попытка; отсрочка перед повтором — без слота
+            async with llm_limiter.slot(estimated_tokens) as slot:
+                trial = llm_circuit_breaker.check()
+                try:
+                    result = await self._post(headers, payload, estimated_tokens)
+                except asyncio.CancelledError:
+                    # Отмена до результата: свой пробный вызов освобождается здесь,
+                    # _post_once при отмене breaker не трогает
+                    if trial:
+                        llm_circuit_breaker.abandon()
+                    raise
+                except httpx.HTTPStatusError as e:
+                    status_code = e.response.status_code
+                    if status_code not in RETRY_STATUSES or attempt >= settings.llm_max_retries:
+                        raise
+                    delay = llm_limiter.retry_delay(attempt, e.response.headers.get("Retry-After"))
+                    if status_code == 429:
+                        llm_limiter.stats["throttled"] += 1
+                        llm_limiter.pause(delay)
+                except httpx.TransportError:
+                    if attempt >= settings.llm_max_retries:
+                        raise
+                    delay = llm_limiter.retry_delay(attempt)
+                else:
+                    total_tokens = result["result"].get("usage", {}).get("totalTokens")
+                    if total_tokens:
+                        slot.record_usage(int(total_tokens))
+                    return result["result"]["alternatives"][0]["message"]["text"]
+            
+            llm_limiter.stats["retries"] += 1
+            attempt += 1
+            logger.warning(f"⚠️ Повтор запроса к Yandex GPT через {delay:.1f} с (попытка {attempt})")
+            await asyncio.sleep(delay)
+    
+    async def generate_stream(self, prompt: str, system_prompt: str = "") -> AsyncIterator[str]:
+        """Потоковый запрос к Yandex GPT: отдает накопленный текст по мере генерации"""
+        headers, payload = self._build_request(prompt, system_prompt, stream=True)
         
-        async with httpx.AsyncClient(timeout=120.0) as client:
-            response = await client.post(
-                self.base_url,
-                headers=headers,
-                json=payload
+        llm_circuit_breaker.precheck()
+        async with llm_limiter.slot(estimate_tokens(system_prompt + prompt)) as slot:
+            # Пробный вызов half-open занимается только после получения слота
+            trial = llm_circuit_breaker.check()
+            stats = self._http_stats
+            stats["requests_total"] += 1
+            stats["streams_total"] += 1
+            stats["in_flight"] += 1
+            stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+            started = time.monotonic()
+            total_tokens = None
+            try:
+                async with self._http_client() as client:
+                    async with client.stream("POST", self.base_url, headers=headers, json=payload) as response:
+                        response.raise_for_status()
+                        # Каждая строка — JSON с накопленным текстом альтернативы
+                        async for line in response.aiter_lines():
+                            if not line.strip():
+                                continue
+                            result = json.loads(line).get("result", {})
+                            total_tokens = result.get("usage", {}).get("totalTokens", total_tokens)
+                            alternatives = result.get("alternatives") or []
+                            if alternatives:
+                                yield alternatives[0]["message"]["text"]
+            except (asyncio.CancelledError, GeneratorExit):
+                if trial:
+                    llm_circuit_breaker.abandon()
+                raise
+            except httpx.HTTPStatusError as e:
+                stats["requests_failed"] += 1
+                llm_circuit_breaker.record(e.response.status_code < 500, time.monotonic() - started)
+                raise
+            except Exception:
+                stats["requests_failed"] += 1
+                llm_circuit_breaker.record(False, time.monotonic() - started)
+                raise
+            finally:
+                stats["in_flight"] -= 1
+            
+            llm_circuit_breaker.record(True, time.monotonic() - started)
+            if total_tokens:
+                slot.record_usage(int(total_tokens))
+    
+    async def submit_operation(self, prompt: str, system_prompt: str = "") -> str:
+        """Запуск асинхронной операции completionAsync; возвращает id операции"""
+        headers, payload = self._build_request(prompt, system_prompt, stream=False)
+        
+        llm_circuit_breaker.precheck()
+        async with llm_limiter.slot(estimate_tokens(system_prompt + prompt)):
+            trial = llm_circuit_breaker.check()
+            started = time.monotonic()
+            try:
+                async with self._http_client() as client:
+                    response = await client.post(
+                        self.async_url,
+                        headers=headers,
+                        json=payload
+                    )
+                    response.raise_for_status()
+                    operation_id = response.json()["id"]
+            except asyncio.CancelledError:
+                if trial:
+                    llm_circuit_breaker.abandon()
+                raise
+            except httpx.HTTPStatusError as e:
+                llm_circuit_breaker.record(e.response.status_code < 500, time.monotonic() - started)
+                raise
+            except httpx.TransportError:
+                llm_circuit_breaker.record(False, time.monotonic() - started)
+                raise
+            except Exception:
+                # Провайдер ответил, но ответ не разобран — о доступности это не говорит
+                if trial:
+                    llm_circuit_breaker.abandon()
+                raise
+            llm_circuit_breaker.record(True, time.monotonic() - started)
+            return operation_id
+    
+    async def get_operation(self, operation_id: str) -> Optional[str]:
+        """Текст результата операции; None, если она еще выполняется.
+
+        Опрос идет мимо circuit breaker и ограничителя: операция уже принята
+        и учтена при отправке, запрос статуса не расходует токены модели, а отказ
+        в опросе при разомкнутой цепи лишь засчитывал бы элементам пакета
+        неудачные попытки.
+        """
+        headers = {"Authorization": f"Api-Key {self.api_key}"}
+        async with self._http_client() as client:
+            response = await client.get(
+                f"{settings.yandex_operation_url}/{operation_id}",
+                headers=headers
             )
             response.raise_for_status()
-            result = response.json()
-            return result["result"]["alternatives"][0]["message"]["text"]
+            operation = response.json()
+        
+        if not operation.get("done"):
+            return None
+        if "error" in operation:
+            raise RuntimeError(operation["error"].get("message", "Ошибка операции"))
+        return operation["response"]["alternatives"][0]["message"]["text"]
     
-    async def analyze_letter(self, subject: str, body: str) -> Dict[str, Any]:
-        """Анализ входящего письма"""
+    async def _post(self, headers: Dict[str, str], payload: Dict[str, Any], estimated_tokens: int = 0) -> Dict[str, Any]:
+        """HTTP-запрос к API completion (с хеджированием, если оно включено)"""
+        if settings.llm_hedge_enabled:
+            hedge_after = llm_circuit_breaker.latency_percentile(
+                settings.llm_hedge_percentile, settings.llm_hedge_min_samples
+            )
+            if hedge_after is not None:
+                return await self._post_hedged(headers, payload, hedge_after, estimated_tokens)
+        return await self._post_once(headers, payload)
+    
+    async def _post_hedged(self, headers: Dict[str, str], payload: Dict[str, Any], hedge_after: float,
+                           estimated_tokens: int = 0) -> Dict[str, Any]:
+        """Второй запрос, если первый не уложился в перцентиль задержки; побеждает первый успешный"""
+        primary = asyncio.create_task(self._post_once(headers, payload))
+        pending = {primary}
+        try:
+            done, pending = await asyncio.wait(pending, timeout=hedge_after)
+            if done:
+                return primary.result()
+            
+            # Копия запроса тоже расходует лимиты и ждет окончания паузы после 429
+            await llm_limiter.charge(estimated_tokens)
+            if primary.done():
+                return primary.result()
+            
+            self._http_stats["hedged"] += 1
+            backup = asyncio.create_task(self._post_once(headers, payload))
+            pending = {primary, backup}
+            error: Optional[BaseException] = None
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is backup:
+                            self._http_stats["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    async def _post_once(self, headers: Dict[str, str], payload: Dict[str, Any]) -> Dict[str, Any]:
+        """Один HTTP-запрос к API completion"""
+        stats = self._http_stats
+        stats["requests_total"] += 1
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        started = time.monotonic()
+        try:
+            async with self._http_client() as client:
+                response = await client.post(
+                    self.base_url,
+                    headers=headers,
+                    json=payload
+                )
+                response.raise_for_status()
+                result = response.json()
+        except httpx.HTTPStatusError as e:
+            stats["requests_failed"] += 1
+            # 4xx (в т.ч. 429) — провайдер отвечает, в ошибки breaker не считаем
+            llm_circuit_breaker.record(e.response.status_code < 500, time.monotonic() - started)
+            raise
+        except Exception:
+            stats["requests_failed"] += 1
+            llm_circuit_breaker.record(False, time.monotonic() - started)
+            raise
+        finally:
+            stats["in_flight"] -= 1
+        
+        llm_circuit_breaker.record(True, time.monotonic() - started)
+        return result
+    
+    def analysis_request(self, subject: str, body: str) -> tuple[str, str]:
+        """Системный промпт и промпт анализа письма"""
         system_prompt = """Вы — профессиональный ИИ-ассистент для обработки деловой корреспонденции банка. Вы работаете на базе Yandex GPT и интегрированы в систему AI Banking Assistant. Ваша задача — провести глубокий анализ входящего письма.
 
 ВАЖНО: В банке всего 2 отдела:
@@ -203,7 +523,8 @@ class YandexGPTService:
 {{
   "classification": {{
     "type": "один из: notification, info_request, complaint, regulatory, partnership, approval_request, other",
-    "description": "краткое описание типа письма"
+    "description": "краткое описание типа письма",
+    "confidence": число_от_0_до_1 (уверенность в выборе типа)
   }},
   "sla_hours": число_часов_на_ответ (используй правила выше: 2/4/24/72/0),
   "sla_reasoning": "объяснение почему выбран именно этот SLA",
@@ -237,9 +558,10 @@ class YandexGPTService:
 ВАЖНО: Если type == "notification" (письмо содержит "ответ не требуется"), то approval_route должен быть []
 
 Возвращай ТОЛЬКО валидный JSON, без дополнительного текста."""
-
-        response_text = await self.generate(prompt, system_prompt)
-        
+        return system_prompt, prompt
+    
+    def parse_analysis(self, response_text: str) -> Optional[Dict[str, Any]]:
+        """Разбор JSON анализа из ответа модели (None, если разобрать не удалось)"""
         # Извлечение JSON из ответа
         try:
             # Пытаемся найти JSON в ответе
@@ -248,35 +570,52 @@ class YandexGPTService:
             if start_idx != -1 and end_idx > start_idx:
                 json_str = response_text[start_idx:end_idx]
                 return json.loads(json_str)
-            else:
-                return json.loads(response_text)
-        except json.JSONDecodeError as e:
-            # Если не удалось распарсить, возвращаем структуру по умолчанию
-            return {
-                "classification": {"type": "other", "description": "Ошибка анализа"},
-                "sla_hours": 24,
-                "sla_reasoning": "Стандартный SLA применен из-за ошибки анализа",
-                "priority": 2,
-                "formality_level": "neutral",
-                "required_departments": [],
-                "extracted_entities": {},
-                "risks": [],
-                "approval_route": [],
-                "controversial_points": []
-            }
-    
-    async def generate_responses(self, subject: str, body: str, analysis: Dict[str, Any]) -> Dict[str, str]:
-        """Генерация 4 вариантов ответа на основе нового системного промпта"""
+            return json.loads(response_text)
+        except json.JSONDecodeError:
+            return None
+    
+    async def analyze_letter(self, subject: str, body: str) -> Dict[str, Any]:
+        """Анализ входящего письма"""
+        cache_key = self._cache_key("analysis", subject, body)
+        cached = await self._cache_get(cache_key)
+        if cached is not None:
+            return cached
         
-        # Проверка: если это уведомление, не генерируем ответы (ответ не требуется)
-        classification = analysis.get("classification", {})
-        if classification.get("type") == "notification":
-            return None  # Не генерируем варианты ответов для уведомлений
+        system_prompt, prompt = self.analysis_request(subject, body)
+        response_text = await self.generate(prompt, system_prompt)
         
+        analysis = self.parse_analysis(response_text)
+        if analysis is None:
+            # Если не удалось распарсить, возвращаем структуру по умолчанию
+            return self.default_analysis()
+        # Ответы-заглушки при ошибке разбора в кэш не попадают
+        await self._cache_set(cache_key, "analysis", analysis)
+        return analysis
+    
+    def default_analysis(self) -> Dict[str, Any]:
+        """Результат анализа по умолчанию (ошибка разбора или недоступность модели)"""
+        return {
+            "classification": {"type": "other", "description": "Ошибка анализа", "confidence": 0.0},
+            "sla_hours": 24,
+            "sla_reasoning": "Стандартный SLA применен из-за ошибки анализа",
+            "priority": 2,
+            "formality_level": "neutral",
+            "required_departments": [],
+            "extracted_entities": {},
+            "risks": [],
+            "approval_route": [],
+            "controversial_points": []
+        }
+    
+    def _drafts_system_prompt(self, task: str, knowledge_base_text: str, tones_title: str,
+                              tone_keys, output_rule: str) -> str:
+        """Системный промпт генерации черновиков для указанных стилей"""
         # Полный системный промпт из Version 2 с базой знаний
-        knowledge_base_text = self._format_knowledge_base()
+        tones_text = "\n\n".join(
+            _format_tone(index, key) for index, key in enumerate(tone_keys, start=1)
+        )
         
-        system_prompt = f"""Вы — профессиональный ИИ-ассистент для обработки деловой корреспонденции банка. Вы работаете на базе Yandex GPT и интегрированы в систему AI Banking Assistant. Ваша задача — автоматически сгенерировать 4 варианта качественного ответа, полностью соответствующих корпоративным стандартам, юридическим нормам и регуляторным требованиям.
+        return f"""Вы — профессиональный ИИ-ассистент для обработки деловой корреспонденции банка. Вы работаете на базе Yandex GPT и интегрированы в систему AI Banking Assistant. Ваша задача — {task}, полностью соответствующих корпоративным стандартам, юридическим нормам и регуляторным требованиям.
 
 {knowledge_base_text}
 
@@ -286,44 +625,102 @@ class YandexGPTService:
 - Юридический отдел — согласование для регуляторных запросов, жалоб с юридическими рисками, запросов с упоминанием законов
 - Отдел маркетинга — согласование для партнерских предложений, запросов от СМИ, вопросов о тарифах/продуктах
 
-Вы должны сгенерировать 4 варианта ответа:
-
-1. СТРОГИЙ ОФИЦИАЛЬНЫЙ (strict_official) - для государственных органов, регуляторов, судов:
-   - Пассивные конструкции: "Банком установлено", "Принято решение"
-   - Избегать местоимения "мы"
-   - Юридическая терминология
-   - Обязательные ссылки на законы
-   - Использовать полное название банка и реквизиты из базы знаний
-
-2. ДЕЛОВОЙ КОРПОРАТИВНЫЙ (corporate) - для партнеров, корпоративных клиентов:
-   - Активные конструкции: "Мы рады сообщить"
-   - Фокус на партнерстве
-   - Умеренная официальность
-   - Указывать контактные данные из базы знаний
-
-3. КЛИЕНТООРИЕНТИРОВАННЫЙ (client_oriented) - для физических лиц, жалоб:
-   - Эмпатия и понимание
-   - Простые объяснения без жаргона
-   - Персонализация
-   - Позитивный тон
-   - Конкретные цифры из базы знаний (ставки, суммы, сроки)
-
-4. КРАТКИЙ ИНФОРМАЦИОННЫЙ (brief_info) - для простых запросов:
-   - Максимальная лаконичность
-   - Структурированная информация (списки)
-   - Без лишних слов
-   - Точные данные из базы знаний
+{tones_title}
+
+{tones_text}
 
 КРИТИЧЕСКИ ВАЖНО:
 ✅ Используйте: "В соответствии с...", "Согласно положениям...", "Стремимся обеспечить"
 ❌ НИКОГДА: "Всегда", "Никогда", "Гарантируем 100%", признание вины без оговорок
 ✅ ОБЯЗАТЕЛЬНО: Все цифры, условия, тарифы ТОЛЬКО из базы знаний выше
 
-Верните ТОЛЬКО JSON объект без markdown разметки, без дополнительного текста."""
-        
+{output_rule}"""
+    
+    def _draft_context(self, analysis: Dict[str, Any], knowledge_base_text: str) -> tuple[str, Dict[str, Any]]:
+        """Сведения из анализа для промпта черновиков и соответствующая часть ключа кэша"""
+        classification = analysis.get("classification", {})
         extracted = analysis.get("extracted_entities", {})
         risks = analysis.get("risks", [])
         
+        text = f"""Анализ письма:
+- Тип: {classification.get('description', 'не определён')}
+- Суть запроса: {extracted.get('request_summary', 'не указана')}
+- Количество рисков: {len(risks)}"""
+        # Черновики зависят и от письма, и от тех полей анализа, что попадают в промпт
+        extra = {
+            "description": classification.get('description'),
+            "request_summary": extracted.get('request_summary'),
+            "risks_count": len(risks),
+        }
+        if settings.kb_retrieval_enabled:
+            # Набор выбранных разделов зависит от письма — учитываем его в ключе
+            extra["kb_block"] = hashlib.sha256(knowledge_base_text.encode("utf-8")).hexdigest()[:16]
+        return text, extra
+    
+    def fallback_responses(self, subject: str, analysis: Dict[str, Any]) -> Dict[str, str]:
+        """Шаблонные ответы на случай ошибки генерации"""
+        return {
+            "strict_official": f"Уважаемый отправитель,\n\nВаше обращение от {datetime.now().strftime('%d.%m.%Y')} по теме \"{subject}\" принято к рассмотрению. Ответ будет предоставлен в установленные сроки.\n\nС уважением,\nБанк",
+            "corporate": f"Добрый день,\n\nБлагодарим за обращение. Ваш запрос принят в работу и будет обработан в ближайшее время.\n\nС уважением,\nКоманда банка",
+            "client_oriented": f"Здравствуйте!\n\nСпасибо за ваше письмо. Мы получили ваш запрос и уже работаем над ним. В ближайшее время наши специалисты свяжутся с вами.\n\nС наилучшими пожеланиями,\nВаш банк",
+            "brief_info": f"Ваше обращение принято. Ответ будет направлен в течение {analysis.get('sla_hours', 24)} часов."
+        }
+    
+    async def generate_responses(
+        self,
+        subject: str,
+        body: str,
+        analysis: Dict[str, Any],
+        on_variant: Optional[Callable[[str, str], Awaitable[None]]] = None
+    ) -> Dict[str, str]:
+        """Генерация 4 вариантов ответа на основе нового системного промпта
+
+        В режиме parallel каждый стиль генерируется отдельным запросом,
+        готовые варианты передаются в on_variant по мере поступления.
+        """
+        
+        # Проверка: если это уведомление, не генерируем ответы (ответ не требуется)
+        classification = analysis.get("classification", {})
+        if classification.get("type") == "notification":
+            return None  # Не генерируем варианты ответов для уведомлений
+        
+        if settings.draft_generation_mode == "parallel":
+            return await self._generate_responses_parallel(subject, body, analysis, on_variant)
+        
+        system_prompt, prompt, cache_key = self.drafts_request(subject, body, analysis)
+        cached = await self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
+        try:
+            response_text = await self.generate(prompt, system_prompt)
+            responses = self.parse_drafts(response_text)
+            if responses is not None:
+                await self._cache_set(cache_key, "drafts", responses)
+                return responses
+                    
+        except CircuitOpenError:
+            # Решение о шаблонных ответах и повторном анализе принимает вызывающий код
+            raise
+        except Exception as e:
+            print(f"Ошибка генерации ответов: {e}")
+        
+        # Fallback - генерируем простой ответ
+        return self.fallback_responses(subject, analysis)
+    
+    def drafts_request(self, subject: str, body: str, analysis: Dict[str, Any]) -> tuple[str, str, Optional[str]]:
+        """Системный промпт, промпт и ключ кэша генерации 4 вариантов одним запросом"""
+        knowledge_base_text = self._knowledge_base_for(subject, body)
+        system_prompt = self._drafts_system_prompt(
+            "автоматически сгенерировать 4 варианта качественного ответа",
+            knowledge_base_text,
+            "Вы должны сгенерировать 4 варианта ответа:",
+            DRAFT_TONES.keys(),
+            "Верните ТОЛЬКО JSON объект без markdown разметки, без дополнительного текста."
+        )
+        analysis_text, cache_extra = self._draft_context(analysis, knowledge_base_text)
+        cache_key = self._cache_key("drafts", subject, body, extra=cache_extra)
+        
         prompt = f"""На основе входящего письма сгенерируй 4 полноценных варианта ответа.
 
 Тема письма: {subject}
@@ -331,10 +728,7 @@ class YandexGPTService:
 Текст письма:
 {body}
 
-Анализ письма:
-- Тип: {classification.get('description', 'не определён')}
-- Суть запроса: {extracted.get('request_summary', 'не указана')}
-- Количество рисков: {len(risks)}
+{analysis_text}
 
 Верни JSON в формате:
 {{
@@ -351,35 +745,163 @@ class YandexGPTService:
 - Соответствовать стилю своей категории
 
 Верни ТОЛЬКО валидный JSON без markdown блоков."""
+        return system_prompt, prompt, cache_key
+    
+    def parse_drafts(self, response_text: str) -> Optional[Dict[str, str]]:
+        """Разбор JSON с 4 вариантами (None, если JSON неполный или невалидный)"""
+        # Очистка от markdown разметки
+        response_text = response_text.strip()
+        response_text = response_text.replace('```json', '').replace('```', '')
+        
+        start_idx = response_text.find('{')
+        end_idx = response_text.rfind('}') + 1
+        if start_idx == -1 or end_idx <= start_idx:
+            return None
+        try:
+            responses = json.loads(response_text[start_idx:end_idx])
+        except json.JSONDecodeError:
+            return None
+        
+        # Проверка что все ключи присутствуют
+        if not all(key in responses for key in DRAFT_TONES):
+            return None
+        return responses
+    
+    def _variant_request(self, subject: str, body: str, analysis: Dict[str, Any], tone: str) -> tuple[str, str, Optional[str]]:
+        """Системный промпт, промпт и ключ кэша для одного стиля ответа"""
+        knowledge_base_text = self._knowledge_base_for(subject, body)
+        analysis_text, cache_extra = self._draft_context(analysis, knowledge_base_text)
+        cache_key = self._cache_key(f"draft:{tone}", subject, body, extra=cache_extra)
+        
+        system_prompt = self._drafts_system_prompt(
+            "автоматически сгенерировать качественный ответ в заданном стиле",
+            knowledge_base_text,
+            "Стиль ответа:",
+            [tone],
+            "Верните ТОЛЬКО текст письма без markdown разметки, без пояснений."
+        )
+        prompt = f"""На основе входящего письма сгенерируй полноценный ответ в стиле {tone}.
+
+Тема письма: {subject}
+
+Текст письма:
+{body}
+
+{analysis_text}
+
+Ответ должен:
+- Быть полным законченным письмом
+- Отвечать на ВСЕ вопросы входящего письма
+- Быть юридически безопасным
+- Соответствовать стилю своей категории
 
+Верни ТОЛЬКО текст письма."""
+        return system_prompt, prompt, cache_key
+    
+    async def generate_response_variant(self, subject: str, body: str, analysis: Dict[str, Any], tone: str) -> str:
+        """Генерация одного варианта ответа в заданном стиле"""
+        system_prompt, prompt, cache_key = self._variant_request(subject, body, analysis, tone)
+        cached = await self._cache_get(cache_key)
+        if cached is not None:
+            return cached
+        
+        response_text = await self.generate(prompt, system_prompt)
+        text = response_text.replace('```', '').strip()
+        if not text:
+            raise ValueError(f"Пустой ответ модели для стиля {tone}")
+        
+        await self._cache_set(cache_key, f"draft:{tone}", text)
+        return text
+    
+    async def stream_responses(
+        self,
+        subject: str,
+        body: str,
+        analysis: Dict[str, Any]
+    ) -> AsyncIterator[tuple[str, str, bool, bool]]:
+        """Потоковая генерация всех стилей: (стиль, накопленный текст, готов ли вариант,
+        подставлен ли шаблон вместо неудавшейся генерации)
+
+        Для уведомлений ничего не отдает — ответ не требуется.
+        """
+        if analysis.get("classification", {}).get("type") == "notification":
+            return
+        
+        semaphore = asyncio.Semaphore(max(1, settings.draft_parallel_concurrency))
+        fallback = self.fallback_responses(subject, analysis)
+        queue: asyncio.Queue = asyncio.Queue()
+        
+        async def run(tone: str):
+            text = ""
+            fallback_used = False
+            try:
+                async with semaphore:
+                    system_prompt, prompt, cache_key = self._variant_request(subject, body, analysis, tone)
+                    cached = await self._cache_get(cache_key)
+                    if cached is not None:
+                        text = cached
+                    else:
+                        async for text in self.generate_stream(prompt, system_prompt):
+                            await queue.put((tone, text, False, False))
+                        text = text.replace('```', '').strip()
+                        if not text:
+                            raise ValueError(f"Пустой ответ модели для стиля {tone}")
+                        await self._cache_set(cache_key, f"draft:{tone}", text)
+            except Exception as e:
+                logger.warning(f"⚠️ Ошибка потоковой генерации варианта {tone}: {e}")
+                text = fallback[tone]
+                fallback_used = True
+            await queue.put((tone, text, True, fallback_used))
+        
+        tasks = [asyncio.create_task(run(tone)) for tone in DRAFT_TONES]
         try:
-            response_text = await self.generate(prompt, system_prompt)
-            
-            # Очистка от markdown разметки
-            response_text = response_text.strip()
-            response_text = response_text.replace('```json', '').replace('```', '')
-            
-            start_idx = response_text.find('{')
-            end_idx = response_text.rfind('}') + 1
-            if start_idx != -1 and end_idx > start_idx:
-                json_str = response_text[start_idx:end_idx]
-                responses = json.loads(json_str)
-                
-                # Проверка что все ключи присутствуют
-                required_keys = ["strict_official", "corporate", "client_oriented", "brief_info"]
-                if all(key in responses for key in required_keys):
-                    return responses
-                    
-        except Exception as e:
-            print(f"Ошибка генерации ответов: {e}")
+            finished = 0
+            while finished < len(tasks):
+                item = await queue.get()
+                if item[2]:
+                    finished += 1
+                yield item
+        finally:
+            # Клиент отключился — незачем тратить квоту
+            for task in tasks:
+                task.cancel()
+    
+    async def _generate_responses_parallel(
+        self,
+        subject: str,
+        body: str,
+        analysis: Dict[str, Any],
+        on_variant: Optional[Callable[[str, str], Awaitable[None]]]
+    ) -> Dict[str, str]:
+        """Параллельная генерация стилей с ограничением числа одновременных запросов"""
+        semaphore = asyncio.Semaphore(max(1, settings.draft_parallel_concurrency))
+        fallback = self.fallback_responses(subject, analysis)
+        rejected = []
         
-        # Fallback - генерируем простой ответ
-        return {
-            "strict_official": f"Уважаемый отправитель,\n\nВаше обращение от {datetime.now().strftime('%d.%m.%Y')} по теме \"{subject}\" принято к рассмотрению. Ответ будет предоставлен в установленные сроки.\n\nС уважением,\nБанк",
-            "corporate": f"Добрый день,\n\nБлагодарим за обращение. Ваш запрос принят в работу и будет обработан в ближайшее время.\n\nС уважением,\nКоманда банка",
-            "client_oriented": f"Здравствуйте!\n\nСпасибо за ваше письмо. Мы получили ваш запрос и уже работаем над ним. В ближайшее время наши специалисты свяжутся с вами.\n\nС наилучшими пожеланиями,\nВаш банк",
-            "brief_info": f"Ваше обращение принято. Ответ будет направлен в течение {analysis.get('sla_hours', 24)} часов."
-        }
+        async def run(tone: str) -> tuple[str, str]:
+            # Неудачный вариант повторяется отдельно, остальные не ждут
+            for attempt in range(settings.draft_variant_retries + 1):
+                try:
+                    async with semaphore:
+                        return tone, await self.generate_response_variant(subject, body, analysis, tone)
+                except CircuitOpenError:
+                    rejected.append(tone)
+                    break
+                except Exception as e:
+                    logger.warning(f"⚠️ Ошибка генерации варианта {tone} (попытка {attempt + 1}): {e}")
+            return tone, fallback[tone]
+        
+        responses: Dict[str, str] = {}
+        for next_done in asyncio.as_completed([run(tone) for tone in DRAFT_TONES]):
+            tone, text = await next_done
+            responses[tone] = text
+            if on_variant is not None:
+                await on_variant(tone, text)
+        
+        if rejected:
+            # Шаблонные варианты уже сохранены через on_variant; письмо нужно перегенерировать
+            raise CircuitOpenError(f"Варианты не сгенерированы: {', '.join(rejected)}")
+        return {tone: responses[tone] for tone in DRAFT_TONES}
 
 
 yandex_gpt_service = YandexGPTService()
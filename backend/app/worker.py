@@ -0,0 +1,65 @@
+"""
+Отдельный процесс фоновых задач (без HTTP).
+
+Запуск из каталога backend:
+    python -m app.worker --analyze                      # только очередь анализа
+    python -m app.worker --ingest --scheduler           # почта, приоритеты и SLA
+    python -m app.worker                                # все роли
+
+API при этом запускается с BACKGROUND_ROLES="" и только обслуживает HTTP.
+"""
+import argparse
+import asyncio
+import logging
+import signal
+
+from app.background import ROLES, start_background_tasks, stop_background_tasks
+from app.database import engine, Base, get_db
+from app.services.yandex_gpt import yandex_gpt_service
+from app.services.llm_cache import llm_cache
+from app.services.mail_parser import mail_parser
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger("app.worker")
+
+
+async def run(roles):
+    Base.metadata.create_all(bind=engine)
+    await yandex_gpt_service.startup()
+    if "scheduler" in roles:
+        await asyncio.to_thread(llm_cache.purge_expired)
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:
+            pass  # Windows: остановка по KeyboardInterrupt
+
+    tasks = start_background_tasks(roles, get_db)
+    try:
+        await stop.wait()
+    finally:
+        logger.info("⏸️ Остановка обработчика, незавершенные задачи возвращаются в очередь")
+        await stop_background_tasks(tasks)
+        await asyncio.to_thread(mail_parser.shutdown)
+        await yandex_gpt_service.shutdown()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Фоновые задачи AI Banking Assistant")
+    parser.add_argument("--ingest", action="store_true", help="мониторинг почты")
+    parser.add_argument("--analyze", action="store_true", help="очередь анализа, повторный и пакетный анализ")
+    parser.add_argument("--scheduler", action="store_true", help="пересчет приоритетов и контроль SLA")
+    args = parser.parse_args()
+
+    roles = {role for role in ROLES if getattr(args, role)} or set(ROLES)
+    asyncio.run(run(roles))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""Микробенчмарк разбора писем: MIME, кодировки и HTML -> текст.
+
+Сравнивает разбор в одном процессе и в пуле процессов mail_parser на корпусе .eml.
+Без --corpus корпус генерируется из kb_eval_samples.json: text/plain,
+multipart/alternative и тяжелые HTML-рассылки с таблицами (как выписки банков).
+Небольшой корпус реальных форматов (cp1251, quoted-printable, битая структура)
+лежит в tests/fixtures/mail; для замеров его лучше дополнить выгрузкой ящика.
+
+Запуск из каталога backend:
+    python benchmark_mail_parser.py --corpus tests/fixtures/mail --processes 4 --repeat 3
+"""
+
+import argparse
+import glob
+import json
+import os
+import time
+from email.message import EmailMessage
+from typing import Dict, List
+
+from app.config import settings
+from app.services.mail_parser import MailParser, parse_message_body
+
+
+def html_newsletter(subject: str, body: str, rows: int) -> str:
+    """HTML с вложенными таблицами и стилями — тяжелый случай для html2text"""
+    cells = "".join(
+        f"<tr><td style='padding:4px;border:1px solid #ccc'>{index}</td>"
+        f"<td><span style='color:#333'><b>{word}</b></span></td>"
+        f"<td><a href='https://bank.example/{index}'>{index * 1000:,} ₽</a></td></tr>"
+        for index, word in enumerate((body.split() * rows)[:rows])
+    )
+    return (
+        "<html><head><style>td{font-family:Arial}</style></head><body>"
+        f"<h1>{subject}</h1><p>{body}</p>"
+        f"<table><tr><td><table>{cells}</table></td></tr></table>"
+        "</body></html>"
+    )
+
+
+def generate_corpus(samples_path: str, count: int) -> Dict[str, List[bytes]]:
+    with open(samples_path, "r", encoding="utf-8") as f:
+        samples = json.load(f)
+    corpus: Dict[str, List[bytes]] = {"plain": [], "alternative": [], "html": []}
+    for index in range(count):
+        sample = samples[index % len(samples)]
+        for kind in corpus:
+            message = EmailMessage()
+            message["Subject"] = sample["subject"]
+            message["From"] = "Bank Client <client@example.com>"
+            if kind == "plain":
+                message.set_content(sample["body"])
+            elif kind == "alternative":
+                message.set_content(sample["body"])
+                message.add_alternative(html_newsletter(sample["subject"], sample["body"], 50), subtype="html")
+            else:
+                message.set_content(html_newsletter(sample["subject"], sample["body"], 400), subtype="html")
+            corpus[kind].append(message.as_bytes())
+    return corpus
+
+
+def load_corpus(path: str) -> Dict[str, List[bytes]]:
+    messages = []
+    for name in sorted(glob.glob(os.path.join(path, "**", "*.eml"), recursive=True)):
+        with open(name, "rb") as f:
+            messages.append(f.read())
+    return {"eml": messages}
+
+
+def bench_inline(messages: List[bytes], repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        for raw in messages:
+            parse_message_body(raw)
+    return len(messages) * repeat / (time.perf_counter() - started)
+
+
+def bench_pool(parser: MailParser, messages: List[bytes], repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        parser.parse_bodies(messages)
+    return len(messages) * repeat / (time.perf_counter() - started)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Микробенчмарк разбора писем")
+    parser.add_argument("--corpus", help="каталог с .eml (по умолчанию — сгенерированный корпус)")
+    parser.add_argument("--samples", default="kb_eval_samples.json", help="JSON-массив писем {subject, body}")
+    parser.add_argument("--count", type=int, default=100, help="писем каждого вида в сгенерированном корпусе")
+    parser.add_argument("--processes", type=int, default=settings.mail_parser_processes or os.cpu_count())
+    parser.add_argument("--cpu-seconds", type=float, default=settings.mail_parser_cpu_seconds)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus) if args.corpus else generate_corpus(args.samples, args.count)
+    pool = MailParser(processes=args.processes, cpu_seconds=args.cpu_seconds)
+    # Запуск процессов (spawn) не входит в измерение
+    pool.parse_bodies([raw for messages in corpus.values() for raw in messages[:args.processes]])
+
+    print(f"Процессов в пуле: {args.processes}, лимит CPU на письмо: {args.cpu_seconds} с\n")
+    print(f"{'Корпус':<12} {'писем':>6} {'1 процесс, п/с':>16} {'пул, п/с':>10} {'пул на ядро, п/с':>18}")
+    try:
+        for kind, messages in corpus.items():
+            if not messages:
+                continue
+            inline = bench_inline(messages, args.repeat)
+            pooled = bench_pool(pool, messages, args.repeat)
+            print(f"{kind:<12} {len(messages):>6} {inline:>16.1f} {pooled:>10.1f} {pooled / args.processes:>18.1f}")
+    finally:
+        pool.shutdown()
+
+    metrics = pool.get_metrics()
+    print(
+        f"\nПревышений лимита: {metrics['timeouts']}, ошибок: {metrics['errors']}, "
+        f"повторно отправлено после пересоздания пула: {metrics['resubmitted']}"
+    )
+
+
+if __name__ == "__main__":
+    main()
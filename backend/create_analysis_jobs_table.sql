@@ -0,0 +1,29 @@
+-- Создание таблицы analysis_jobs: очередь анализа писем
+-- Дата: 2026-10-17
+
+CREATE TABLE IF NOT EXISTS analysis_jobs (
+    id SERIAL PRIMARY KEY,
+    letter_id INTEGER NOT NULL,
+    status VARCHAR(20) DEFAULT 'queued' NOT NULL,
+    attempts INTEGER DEFAULT 0 NOT NULL,
+    run_after TIMESTAMP WITH TIME ZONE DEFAULT NOW() NOT NULL,
+    locked_at TIMESTAMP WITH TIME ZONE,
+    locked_by VARCHAR(100),
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Индексы для выборки очереди (SELECT ... FOR UPDATE SKIP LOCKED)
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_letter_id ON analysis_jobs(letter_id);
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_status ON analysis_jobs(status);
+CREATE INDEX IF NOT EXISTS idx_analysis_jobs_run_after ON analysis_jobs(run_after);
+
+-- Не больше одной активной задачи на письмо
+CREATE UNIQUE INDEX IF NOT EXISTS uq_analysis_jobs_active_letter
+    ON analysis_jobs(letter_id) WHERE status IN ('queued', 'running');
+
+-- Комментарии
+COMMENT ON TABLE analysis_jobs IS 'Очередь анализа писем через Yandex GPT';
+COMMENT ON COLUMN analysis_jobs.status IS 'Статус: queued, running, done, dead (исчерпаны попытки)';
+COMMENT ON COLUMN analysis_jobs.run_after IS 'Не раньше этого времени (отсрочка повтора)';
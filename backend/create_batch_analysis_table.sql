@@ -0,0 +1,24 @@
+-- Создание таблицы batch_analysis_items для пакетного анализа через асинхронные операции
+-- Дата: 2026-10-16
+
+CREATE TABLE IF NOT EXISTS batch_analysis_items (
+    id SERIAL PRIMARY KEY,
+    letter_id INTEGER NOT NULL,
+    stage VARCHAR(20) DEFAULT 'analysis' NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending' NOT NULL,
+    operation_id VARCHAR(100),
+    analysis JSON,
+    attempts INTEGER DEFAULT 0 NOT NULL,
+    error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE
+);
+
+-- Индексы для выборки очереди
+CREATE INDEX IF NOT EXISTS idx_batch_analysis_items_letter_id ON batch_analysis_items(letter_id);
+CREATE INDEX IF NOT EXISTS idx_batch_analysis_items_status ON batch_analysis_items(status);
+
+-- Комментарии
+COMMENT ON TABLE batch_analysis_items IS 'Письма в пакетном анализе: состояние асинхронных операций Yandex GPT';
+COMMENT ON COLUMN batch_analysis_items.stage IS 'Этап: analysis (классификация) или drafts (черновики)';
+COMMENT ON COLUMN batch_analysis_items.status IS 'Статус: pending, submitted, done, failed';
@@ -0,0 +1,36 @@
+-- Создание таблицы letter_attachments: вложения писем и извлеченный из них текст
+-- Дата: 2026-10-17
+
+CREATE TABLE IF NOT EXISTS letter_attachments (
+    id SERIAL PRIMARY KEY,
+    letter_id INTEGER NOT NULL,
+    account VARCHAR(255) NOT NULL,
+    mailbox VARCHAR(255) NOT NULL,
+    uidvalidity BIGINT,
+    uid BIGINT NOT NULL,
+    section VARCHAR(50) NOT NULL,
+    filename VARCHAR(500) NOT NULL,
+    content_type VARCHAR(255) NOT NULL,
+    charset VARCHAR(50),
+    encoding VARCHAR(50),
+    size BIGINT DEFAULT 0 NOT NULL,
+    status VARCHAR(20) DEFAULT 'pending' NOT NULL,
+    attempts INTEGER DEFAULT 0 NOT NULL,
+    locked_at TIMESTAMP WITH TIME ZONE,
+    storage_path VARCHAR(500),
+    content_hash VARCHAR(64),
+    extracted_text TEXT,
+    error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    processed_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS ix_letter_attachments_letter_id ON letter_attachments(letter_id);
+CREATE INDEX IF NOT EXISTS ix_letter_attachments_status ON letter_attachments(status);
+CREATE INDEX IF NOT EXISTS ix_letter_attachments_content_hash ON letter_attachments(content_hash);
+
+-- Комментарии
+COMMENT ON TABLE letter_attachments IS 'Вложения писем: загружаются в фоне, текст используется в анализе';
+COMMENT ON COLUMN letter_attachments.section IS 'Раздел письма для BODY.PEEK[section]';
+COMMENT ON COLUMN letter_attachments.status IS 'pending, processing, done, no_text, unsupported, skipped, expired, failed';
+COMMENT ON COLUMN letter_attachments.content_hash IS 'sha256 содержимого; одинаковые файлы разбираются один раз';
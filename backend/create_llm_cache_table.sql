@@ -0,0 +1,19 @@
+-- Создание таблицы llm_cache для кэширования результатов Yandex GPT
+-- Дата: 2026-10-16
+
+CREATE TABLE IF NOT EXISTS llm_cache (
+    key VARCHAR(64) PRIMARY KEY,
+    kind VARCHAR(32) NOT NULL,
+    value JSON NOT NULL,
+    hits INTEGER DEFAULT 0 NOT NULL,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    expires_at TIMESTAMP WITH TIME ZONE NOT NULL
+);
+
+-- Индексы для очистки устаревших записей
+CREATE INDEX IF NOT EXISTS idx_llm_cache_kind ON llm_cache(kind);
+CREATE INDEX IF NOT EXISTS idx_llm_cache_expires_at ON llm_cache(expires_at);
+
+-- Комментарии
+COMMENT ON TABLE llm_cache IS 'Кэш результатов анализа и генерации черновиков Yandex GPT';
+COMMENT ON COLUMN llm_cache.key IS 'SHA-256 от темы, нормализованного текста, версии промпта, версии базы знаний и модели';
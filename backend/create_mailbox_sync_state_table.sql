@@ -0,0 +1,17 @@
+-- Создание таблицы mailbox_sync_state: чекпоинт UID-синхронизации почтовых папок
+-- Дата: 2026-10-17
+
+CREATE TABLE IF NOT EXISTS mailbox_sync_state (
+    id SERIAL PRIMARY KEY,
+    account VARCHAR(255) NOT NULL,
+    mailbox VARCHAR(255) NOT NULL,
+    uidvalidity BIGINT,
+    last_uid BIGINT DEFAULT 0 NOT NULL,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    CONSTRAINT uq_mailbox_sync_state_account_mailbox UNIQUE (account, mailbox)
+);
+
+-- Комментарии
+COMMENT ON TABLE mailbox_sync_state IS 'Последний обработанный UID по каждой папке IMAP';
+COMMENT ON COLUMN mailbox_sync_state.uidvalidity IS 'UIDVALIDITY папки; при смене синхронизация начинается заново';
+COMMENT ON COLUMN mailbox_sync_state.last_uid IS 'Письма с UID больше этого еще не обработаны';
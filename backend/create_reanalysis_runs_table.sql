@@ -0,0 +1,29 @@
+-- Массовый повторный анализ: таблица запусков и отпечаток входных данных анализа
+-- Дата: 2026-10-17
+
+ALTER TABLE letters ADD COLUMN IF NOT EXISTS analysis_fingerprint VARCHAR(64);
+
+CREATE TABLE IF NOT EXISTS reanalysis_runs (
+    id SERIAL PRIMARY KEY,
+    filters JSON,
+    force BOOLEAN DEFAULT FALSE NOT NULL,
+    concurrency INTEGER DEFAULT 2 NOT NULL,
+    status VARCHAR(20) DEFAULT 'queued' NOT NULL,
+    created_by INTEGER,
+    total INTEGER DEFAULT 0 NOT NULL,
+    processed INTEGER DEFAULT 0 NOT NULL,
+    skipped INTEGER DEFAULT 0 NOT NULL,
+    failed INTEGER DEFAULT 0 NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    started_at TIMESTAMP WITH TIME ZONE,
+    heartbeat_at TIMESTAMP WITH TIME ZONE,
+    finished_at TIMESTAMP WITH TIME ZONE
+);
+
+CREATE INDEX IF NOT EXISTS idx_reanalysis_runs_status ON reanalysis_runs(status);
+
+-- Комментарии
+COMMENT ON COLUMN letters.analysis_fingerprint IS 'Хеш письма, версии промпта, базы знаний и модели последнего полного анализа';
+COMMENT ON TABLE reanalysis_runs IS 'Запуски массового повторного анализа писем';
+COMMENT ON COLUMN reanalysis_runs.skipped IS 'Письма, входные данные которых не изменились';
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Оффлайн-оценка выбора разделов базы знаний: размер блока базы знаний
+в промпте черновиков до (фиксированная сводка) и после (релевантные разделы).
+
+Запуск из каталога backend:
+    python evaluate_kb_retrieval.py [--samples kb_eval_samples.json] [--top-k 3] [--budget 1200]
+"""
+
+import argparse
+import json
+
+from app.config import settings
+from app.services.kb_retrieval import estimate_tokens
+from app.services.knowledge_base import knowledge_base_store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Оценка выбора разделов базы знаний")
+    parser.add_argument("--samples", default="kb_eval_samples.json", help="JSON-массив писем {subject, body}")
+    parser.add_argument("--top-k", type=int, default=settings.kb_retrieval_top_k)
+    parser.add_argument("--budget", type=int, default=settings.kb_retrieval_token_budget)
+    parser.add_argument("--min-score-ratio", type=float, default=settings.kb_retrieval_min_score_ratio)
+    args = parser.parse_args()
+
+    with open(args.samples, "r", encoding="utf-8") as f:
+        samples = json.load(f)
+
+    artifact = knowledge_base_store.current()
+    before = estimate_tokens(artifact.prompt_block)
+    print(f"База знаний: версия {artifact.version}, хеш {artifact.content_hash}, "
+          f"разделов в индексе {len(artifact.index.sections)}")
+    print(f"Фиксированная сводка: {len(artifact.prompt_block)} симв., ~{before} токенов\n")
+
+    total_after = 0
+    for sample in samples:
+        query = f"{sample['subject']}\n{sample['body']}"
+        sections = artifact.index.select(query, args.top_k, args.budget, args.min_score_ratio)
+        block = artifact.index.prompt_block(query, args.top_k, args.budget, args.min_score_ratio)
+        after = estimate_tokens(block)
+        total_after += after
+        print(f"- {sample['subject'][:50]}")
+        print(f"  токенов: {before} -> {after} ({after - before:+d})")
+        print(f"  разделы: {', '.join(section.key for section in sections)}")
+
+    if samples:
+        average = total_after / len(samples)
+        print(f"\nСреднее: {before} -> {average:.0f} токенов на письмо ({average - before:+.0f})")
+
+
+if __name__ == "__main__":
+    main()
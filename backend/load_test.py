@@ -0,0 +1,300 @@
+#!/usr/bin/env python3
+"""Нагрузочный тест конвейера «письмо → анализ → черновики».
+
+Письма проходят те же пути, что и в приложении:
+  api  — LetterService.create_letter + очередь analysis_jobs (как в POST /api/letters),
+         очередь разбирают обработчики, запущенные в этом же процессе;
+  mail — YandexMailService.fetch_new_emails с подставным почтовым ящиком вместо IMAP,
+         письма попадают в ту же очередь анализа.
+
+Рассчитан на работу с mock_yandex_gpt.py, чтобы не расходовать квоту.
+Запуск из каталога backend:
+    python mock_yandex_gpt.py --latency lognormal:1.5,0.5 --rate-429 0.05 &
+    YANDEX_GPT_BASE_URL=http://localhost:8090/foundationModels/v1 \\
+        python load_test.py --letters 200 --path both --concurrency 16
+"""
+
+import argparse
+import asyncio
+import json
+import time
+import uuid
+from email import message_from_bytes
+from email.message import EmailMessage
+from typing import Dict, List
+
+from app.config import settings
+from app.database import SessionLocal, get_db
+from app.models import AnalysisJob, Letter, MailboxSyncState
+from app.schemas import LetterCreate
+from app.services.letter_service import LetterService
+from app.services.analysis_queue import analysis_queue, run_analysis_workers
+from app.services.mail_service import YandexMailService
+from app.services.yandex_gpt import yandex_gpt_service
+from app.services.llm_cache import llm_cache
+from app.services.llm_limiter import llm_limiter
+from app.services.llm_circuit_breaker import llm_circuit_breaker
+
+
+# Синтетический ящик: чекпоинт mailbox_sync_state настоящего ящика не затрагивается
+LOAD_TEST_ACCOUNT = "load-test@example.invalid"
+LOAD_TEST_MAILBOX = "LOAD_TEST"
+
+
+class FakeMailbox:
+    """Почтовый ящик в памяти с интерфейсом IMAPClient, нужным fetch_new_emails.
+
+    Время установки флага \\Seen — момент приема письма (до анализа).
+    """
+
+    def __init__(self, messages: List[bytes]):
+        self.messages = {index + 1: raw for index, raw in enumerate(messages)}
+        self.seen: Dict[int, float] = {}
+        self.uidvalidity = int(time.time())
+
+    def select_folder(self, mailbox, readonly=False):
+        return {
+            b"EXISTS": len(self.messages),
+            b"UNSEEN": len(self.messages) - len(self.seen),
+            # Новая UIDVALIDITY на каждый ящик: синхронизация начинается с непрочитанных
+            b"UIDVALIDITY": self.uidvalidity,
+            b"UIDNEXT": len(self.messages) + 1,
+        }
+
+    def search(self, criteria):
+        if criteria[0] == "UID":
+            # Диапазон UID вида "n:*"; как и IMAP, всегда включает последнее письмо
+            start = int(criteria[1].split(":")[0])
+            return [msg_id for msg_id in self.messages if msg_id >= start] or [max(self.messages)]
+        return [msg_id for msg_id in self.messages if msg_id not in self.seen]
+
+    def _item(self, raw: bytes, item: str):
+        """Элемент FETCH для однораздельного text/plain письма"""
+        header, _, body = raw.partition(b"\n\n")
+        message = message_from_bytes(raw)
+        if item == "BODY.PEEK[HEADER]":
+            return b"BODY[HEADER]", header + b"\n\n"
+        if item == "BODYSTRUCTURE":
+            return b"BODYSTRUCTURE", (
+                b"text", b"plain", (b"charset", (message.get_content_charset() or "utf-8").encode()),
+                None, None, (message.get("Content-Transfer-Encoding") or "7bit").encode(),
+                len(body), body.count(b"\n")
+            )
+        if item == "RFC822.SIZE":
+            return b"RFC822.SIZE", len(raw)
+        if item == "BODY.PEEK[]":
+            return b"BODY[]", raw
+        # BODY.PEEK[1]<0.N>
+        limit = int(item.rsplit(".", 1)[1].rstrip(">"))
+        return b"BODY[1]<0>", body[:limit]
+
+    def fetch(self, msg_ids, data_items):
+        return {
+            msg_id: dict(self._item(self.messages[msg_id], item) for item in data_items)
+            for msg_id in msg_ids
+        }
+
+    def add_flags(self, msg_ids, flags):
+        now = time.monotonic()
+        for msg_id in msg_ids:
+            self.seen.setdefault(msg_id, now)
+
+    def logout(self):
+        pass
+
+
+def load_samples(path: str, count: int, marker: str) -> List[Dict[str, str]]:
+    """N писем из примеров; маркер делает их уникальными и позволяет удалить после теста"""
+    with open(path, "r", encoding="utf-8") as f:
+        samples = json.load(f)
+    letters = []
+    for index in range(count):
+        sample = samples[index % len(samples)]
+        letters.append({
+            "subject": f"{sample['subject']} [{marker}-{index}]",
+            "body": f"{sample['body']}\n\n{marker}-{index}",
+        })
+    return letters
+
+
+async def wait_for_jobs(started_at: Dict[int, float]) -> List[float]:
+    """Ожидание завершения задач анализа; время от started_at до done/dead"""
+    timings: Dict[int, float] = {}
+    while len(timings) < len(started_at):
+        await asyncio.sleep(0.2)
+        db = SessionLocal()
+        try:
+            finished = db.query(AnalysisJob.letter_id).filter(
+                AnalysisJob.letter_id.in_(list(started_at)),
+                AnalysisJob.status.in_(("done", "dead"))
+            ).all()
+        finally:
+            db.close()
+        now = time.monotonic()
+        for row in finished:
+            timings.setdefault(row.letter_id, now - started_at[row.letter_id])
+    return list(timings.values())
+
+
+async def run_api_path(letters: List[Dict[str, str]], concurrency: int) -> tuple[List[float], List[int]]:
+    """Создание писем с постановкой в очередь; время — до завершения задачи анализа"""
+    workers = asyncio.create_task(run_analysis_workers(get_db, concurrency))
+    started_at: Dict[int, float] = {}
+    try:
+        db = SessionLocal()
+        try:
+            for sample in letters:
+                # Отдаем управление обработчикам, как при поступлении писем через API
+                await asyncio.sleep(0)
+                letter = LetterService.create_letter(db, LetterCreate(
+                    subject=sample["subject"],
+                    body=sample["body"],
+                    sender_email="load-test@example.com",
+                    sender_name="Load Test"
+                ))
+                analysis_queue.enqueue(db, letter.id)
+                started_at[letter.id] = time.monotonic()
+        finally:
+            db.close()
+
+        timings = await wait_for_jobs(started_at)
+    finally:
+        workers.cancel()
+        await asyncio.gather(workers, return_exceptions=True)
+    return timings, list(started_at)
+
+
+async def run_mail_path(letters: List[Dict[str, str]], concurrency: int) -> tuple[List[float], List[int]]:
+    """Доставка всех писем в ящик и один проход fetch_new_emails;
+    время — от начала прохода до завершения задачи анализа"""
+    messages = []
+    for sample in letters:
+        message = EmailMessage()
+        message["Subject"] = sample["subject"]
+        message["From"] = "Load Test <load-test@example.com>"
+        message["To"] = "bank@example.com"
+        message.set_content(sample["body"])
+        messages.append(message.as_bytes())
+
+    mailbox = FakeMailbox(messages)
+    service = YandexMailService(login=LOAD_TEST_ACCOUNT, password="", mailbox=LOAD_TEST_MAILBOX)
+    service.client = mailbox
+    # Остаток от прерванного прогона: прием начинается с первичной синхронизации
+    clear_sync_state()
+
+    workers = asyncio.create_task(run_analysis_workers(get_db, concurrency))
+    try:
+        db = SessionLocal()
+        try:
+            started = time.monotonic()
+            created = await asyncio.to_thread(service.fetch_new_emails, db)
+            letter_ids = [letter.id for letter in created]
+        finally:
+            db.close()
+        ingest = [seen_at - started for seen_at in mailbox.seen.values()]
+        if ingest:
+            print(f"Прием писем: {len(ingest)} за {max(ingest):.2f} с")
+        timings = await wait_for_jobs({letter_id: started for letter_id in letter_ids})
+    finally:
+        workers.cancel()
+        await asyncio.gather(workers, return_exceptions=True)
+        clear_sync_state()
+    return timings, letter_ids
+
+
+def clear_sync_state():
+    """Удаление чекпоинта синтетического ящика"""
+    db = SessionLocal()
+    try:
+        db.query(MailboxSyncState).filter(MailboxSyncState.account == LOAD_TEST_ACCOUNT).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(p / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def report(name: str, timings: List[float], letter_ids: List[int], elapsed: float):
+    db = SessionLocal()
+    try:
+        letters = db.query(Letter).filter(Letter.id.in_(letter_ids)).all() if letter_ids else []
+        with_drafts = sum(1 for letter in letters if letter.draft_responses)
+        notifications = sum(1 for letter in letters if (letter.classification_data or {}).get("type") == "notification")
+        degraded = sum(1 for letter in letters if letter.needs_reanalysis)
+    finally:
+        db.close()
+
+    print(f"\n=== Путь {name} ===")
+    print(f"Писем обработано: {len(timings)} за {elapsed:.1f} с, пропускная способность {len(timings) / elapsed:.2f} писем/с")
+    print(f"С черновиками: {with_drafts}, уведомлений (без черновиков): {notifications}, отложено (degraded): {degraded}")
+    if timings:
+        print(f"Время до черновика: p50 {percentile(timings, 50):.2f} с, "
+              f"p95 {percentile(timings, 95):.2f} с, p99 {percentile(timings, 99):.2f} с, "
+              f"max {max(timings):.2f} с")
+
+
+def cleanup(letter_ids: List[int]):
+    db = SessionLocal()
+    try:
+        db.query(AnalysisJob).filter(AnalysisJob.letter_id.in_(letter_ids)).delete(synchronize_session=False)
+        db.query(Letter).filter(Letter.id.in_(letter_ids)).delete(synchronize_session=False)
+        db.commit()
+    finally:
+        db.close()
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Нагрузочный тест анализа писем")
+    parser.add_argument("--letters", type=int, default=100, help="число писем на каждый путь")
+    parser.add_argument("--path", choices=["api", "mail", "both"], default="both")
+    parser.add_argument("--concurrency", type=int, default=settings.analysis_worker_concurrency,
+                        help="обработчиков очереди анализа")
+    parser.add_argument("--samples", default="kb_eval_samples.json", help="JSON-массив писем {subject, body}")
+    parser.add_argument("--keep", action="store_true", help="не удалять созданные письма")
+    parser.add_argument("--allow-real-api", action="store_true", help="разрешить запуск против настоящего Yandex GPT")
+    args = parser.parse_args()
+
+    if "api.cloud.yandex.net" in settings.yandex_gpt_base_url and not args.allow_real_api:
+        parser.error("YANDEX_GPT_BASE_URL указывает на Yandex Cloud; запустите mock_yandex_gpt.py "
+                     "или добавьте --allow-real-api")
+
+    marker = f"load-{uuid.uuid4().hex[:8]}"
+    print(f"Mock: {settings.yandex_gpt_base_url}, метка писем: {marker}, "
+          f"кэш LLM: {'вкл' if settings.llm_cache_enabled else 'выкл'}")
+
+    await yandex_gpt_service.startup()
+    created: List[int] = []
+    try:
+        if args.path in ("api", "both"):
+            letters = load_samples(args.samples, args.letters, f"{marker}-api")
+            started = time.monotonic()
+            timings, letter_ids = await run_api_path(letters, args.concurrency)
+            report("api", timings, letter_ids, time.monotonic() - started)
+            created.extend(letter_ids)
+
+        if args.path in ("mail", "both"):
+            letters = load_samples(args.samples, args.letters, f"{marker}-mail")
+            started = time.monotonic()
+            timings, letter_ids = await run_mail_path(letters, args.concurrency)
+            report("mail", timings, letter_ids, time.monotonic() - started)
+            created.extend(letter_ids)
+
+        print("\n=== Метрики LLM ===")
+        print(json.dumps({
+            "http": yandex_gpt_service.get_http_metrics(),
+            "cache": llm_cache.get_metrics(),
+            "limiter": llm_limiter.get_metrics(),
+            "circuit_breaker": llm_circuit_breaker.get_metrics(),
+        }, ensure_ascii=False, indent=2))
+    finally:
+        await yandex_gpt_service.shutdown()
+        if created and not args.keep:
+            cleanup(created)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+"""Локальная замена Yandex GPT для нагрузочных тестов (без расхода квоты).
+
+Отвечает на completion (в т.ч. stream), completionAsync и опрос операций
+валидным по схеме JSON анализа и черновиков. Задержка, доля ошибок 5xx,
+ответов 429 и испорченного JSON задаются параметрами.
+
+Запуск из каталога backend:
+    python mock_yandex_gpt.py --port 8090 --latency lognormal:1.5,0.5 \\
+        --error-rate 0.02 --rate-429 0.05 --malformed-rate 0.01
+
+Переменные окружения приложения для работы через mock:
+    YANDEX_GPT_BASE_URL=http://localhost:8090/foundationModels/v1
+    YANDEX_OPERATION_URL=http://localhost:8090/operations
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import re
+import time
+import uuid
+from typing import Any, Dict, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Mock Yandex GPT")
+
+DRAFT_TONES = ("strict_official", "corporate", "client_oriented", "brief_info")
+
+# Ключевые слова -> (тип, SLA в часах, формальность)
+_TYPE_RULES = [
+    (("ответ не требуется", "уведомляем"), ("notification", 0, "neutral")),
+    (("предписан", "центральн", "банк россии", "цб рф", "налогов"), ("regulatory", 4, "strict_official")),
+    (("жалоб", "требую", "возмущ", "суд"), ("complaint", 4, "client_oriented")),
+    (("сотруднич", "партнер", "партнёр"), ("partnership", 72, "corporate")),
+    (("согласова",), ("approval_request", 24, "corporate")),
+]
+
+
+class MockConfig:
+    latency: str = "uniform:0.5,2.0"
+    error_rate: float = 0.0
+    rate_429: float = 0.0
+    retry_after: float = 1.0
+    malformed_rate: float = 0.0
+    stream_chunks: int = 8
+
+
+config = MockConfig()
+operations: Dict[str, Dict[str, Any]] = {}
+stats = {"requests": 0, "errors": 0, "throttled": 0, "malformed": 0, "operations": 0}
+
+
+def sample_latency() -> float:
+    """Задержка по распределению: fixed:S, uniform:A,B, lognormal:MEDIAN,SIGMA, exp:MEAN"""
+    kind, _, raw = config.latency.partition(":")
+    params = [float(x) for x in raw.split(",") if x]
+    if kind == "fixed":
+        return params[0]
+    if kind == "uniform":
+        return random.uniform(params[0], params[1])
+    if kind == "lognormal":
+        return random.lognormvariate(math.log(params[0]), params[1])
+    if kind == "exp":
+        return random.expovariate(1 / params[0])
+    raise ValueError(f"Неизвестное распределение задержки: {config.latency}")
+
+
+def _messages_text(payload: Dict[str, Any]) -> tuple[str, str]:
+    system_prompt, prompt = "", ""
+    for message in payload.get("messages", []):
+        if message.get("role") == "system":
+            system_prompt = message.get("text", "")
+        else:
+            prompt = message.get("text", "")
+    return system_prompt, prompt
+
+
+def _letter_text(prompt: str) -> str:
+    match = re.search(r"Тема письма:(.*?)(?:Верни|Ответ должен)", prompt, re.S)
+    return (match.group(1) if match else prompt).lower()
+
+
+def _analysis(prompt: str) -> Dict[str, Any]:
+    text = _letter_text(prompt)
+    letter_type, sla, formality = "info_request", 24, "neutral"
+    for keywords, rule in _TYPE_RULES:
+        if any(keyword in text for keyword in keywords):
+            letter_type, sla, formality = rule
+            break
+    route = [] if letter_type == "notification" else [{
+        "department": "Юридический отдел",
+        "reason": "Проверка юридической корректности ответа",
+        "check_points": ["Соответствие законодательству"]
+    }]
+    return {
+        "classification": {"type": letter_type, "description": "Сгенерировано mock-сервером"},
+        "sla_hours": sla,
+        "sla_reasoning": "Правило mock-сервера по ключевым словам",
+        "priority": 1 if sla and sla <= 4 else 2,
+        "formality_level": formality,
+        "required_departments": [step["department"] for step in route],
+        "extracted_entities": {
+            "request_summary": text.strip()[:200],
+            "sender_details": "",
+            "legal_references": [],
+            "mentioned_documents": [],
+            "contact_info": ""
+        },
+        "risks": [],
+        "approval_route": route,
+        "controversial_points": []
+    }
+
+
+def _draft(tone: str) -> str:
+    return (
+        "Уважаемый клиент!\n\n"
+        f"Благодарим за обращение. Это тестовый ответ в стиле {tone}, "
+        "сформированный локальным mock-сервером Yandex GPT.\n\n"
+        "С уважением,\nБанк"
+    )
+
+
+def completion_text(payload: Dict[str, Any]) -> str:
+    """Ответ модели по виду запроса: анализ, 4 варианта или один стиль"""
+    _, prompt = _messages_text(payload)
+    if prompt.startswith("Проанализируй"):
+        text = json.dumps(_analysis(prompt), ensure_ascii=False)
+    elif "4 полноценных варианта" in prompt:
+        text = json.dumps({tone: _draft(tone) for tone in DRAFT_TONES}, ensure_ascii=False)
+    else:
+        match = re.search(r"в стиле (\w+)", prompt)
+        text = _draft(match.group(1) if match else "neutral")
+
+    if random.random() < config.malformed_rate:
+        stats["malformed"] += 1
+        return text[:len(text) // 2]
+    return text
+
+
+def _usage(payload: Dict[str, Any], text: str) -> Dict[str, str]:
+    system_prompt, prompt = _messages_text(payload)
+    input_tokens = (len(system_prompt) + len(prompt)) // 3 + 1
+    completion_tokens = len(text) // 3 + 1
+    return {
+        "inputTextTokens": str(input_tokens),
+        "completionTokens": str(completion_tokens),
+        "totalTokens": str(input_tokens + completion_tokens)
+    }
+
+
+def _result(payload: Dict[str, Any], text: str, final: bool = True) -> Dict[str, Any]:
+    return {
+        "alternatives": [{
+            "message": {"role": "assistant", "text": text},
+            "status": "ALTERNATIVE_STATUS_FINAL" if final else "ALTERNATIVE_STATUS_PARTIAL"
+        }],
+        "usage": _usage(payload, text),
+        "modelVersion": "mock"
+    }
+
+
+def injected_fault() -> Optional[JSONResponse]:
+    """Случайный 429 или 5xx согласно настройкам"""
+    roll = random.random()
+    if roll < config.rate_429:
+        stats["throttled"] += 1
+        return JSONResponse(
+            {"error": {"grpcCode": 8, "message": "ai.textGenerationCompletionSessionsCount.count gauge quota limit exceed"}},
+            status_code=429,
+            headers={"Retry-After": str(config.retry_after)}
+        )
+    if roll < config.rate_429 + config.error_rate:
+        stats["errors"] += 1
+        return JSONResponse({"error": {"grpcCode": 14, "message": "Service unavailable"}},
+                            status_code=random.choice([500, 503]))
+    return None
+
+
+@app.post("/foundationModels/v1/completion")
+async def completion(request: Request):
+    stats["requests"] += 1
+    payload = await request.json()
+    fault = injected_fault()
+    latency = sample_latency()
+    if fault is not None:
+        await asyncio.sleep(latency / 4)
+        return fault
+
+    text = completion_text(payload)
+    if not payload.get("completionOptions", {}).get("stream"):
+        await asyncio.sleep(latency)
+        return {"result": _result(payload, text)}
+
+    async def chunks():
+        # Каждая строка содержит накопленный текст, как в настоящем API
+        step = max(1, math.ceil(len(text) / config.stream_chunks))
+        for end in range(step, len(text) + step, step):
+            await asyncio.sleep(latency / config.stream_chunks)
+            final = end >= len(text)
+            yield json.dumps({"result": _result(payload, text[:end], final)}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(chunks(), media_type="application/json")
+
+
+@app.post("/foundationModels/v1/completionAsync")
+async def completion_async(request: Request):
+    stats["requests"] += 1
+    payload = await request.json()
+    fault = injected_fault()
+    if fault is not None:
+        return fault
+
+    operation_id = f"mock{uuid.uuid4().hex}"
+    operations[operation_id] = {
+        "ready_at": time.monotonic() + sample_latency(),
+        "payload": payload,
+        "text": completion_text(payload)
+    }
+    stats["operations"] += 1
+    return {"id": operation_id, "description": "Async GPT Completion", "done": False}
+
+
+@app.get("/operations/{operation_id}")
+async def get_operation(operation_id: str):
+    operation = operations.get(operation_id)
+    if operation is None:
+        return JSONResponse({"error": {"message": "Operation not found"}}, status_code=404)
+    if time.monotonic() < operation["ready_at"]:
+        return {"id": operation_id, "done": False}
+    operations.pop(operation_id)
+    return {
+        "id": operation_id,
+        "done": True,
+        "response": _result(operation["payload"], operation["text"])
+    }
+
+
+@app.get("/stats")
+async def get_stats():
+    return {**stats, "pending_operations": len(operations)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mock-сервер Yandex GPT")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8090)
+    parser.add_argument("--latency", default=config.latency,
+                        help="fixed:S | uniform:A,B | lognormal:MEDIAN,SIGMA | exp:MEAN (секунды)")
+    parser.add_argument("--error-rate", type=float, default=config.error_rate, help="доля ответов 500/503")
+    parser.add_argument("--rate-429", type=float, default=config.rate_429, help="доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=config.retry_after, help="Retry-After для 429, секунды")
+    parser.add_argument("--malformed-rate", type=float, default=config.malformed_rate, help="доля обрезанного JSON")
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    config.latency = args.latency
+    config.error_rate = args.error_rate
+    config.rate_429 = args.rate_429
+    config.retry_after = args.retry_after
+    config.malformed_rate = args.malformed_rate
+    if args.seed is not None:
+        random.seed(args.seed)
+    sample_latency()  # проверка формата распределения до старта
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
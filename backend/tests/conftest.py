@@ -0,0 +1,54 @@
+import os
+import sys
+
+import pytest
+
+# Тесты запускаются из любого каталога: пакет app лежит в backend/
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Обязательные настройки без .env: тесты не обращаются к Postgres и Yandex GPT
+os.environ.setdefault("DATABASE_URL", "sqlite://")
+os.environ.setdefault("YANDEX_API_KEY", "test")
+os.environ.setdefault("YANDEX_FOLDER_ID", "test")
+os.environ.setdefault("LLM_CACHE_DB_ENABLED", "false")
+os.environ.setdefault("ANALYSIS_PG_SINGLE_FLIGHT", "false")
+
+
+@pytest.fixture
+def db_engine():
+    """Пустая база SQLite в памяти со схемой приложения"""
+    pytest.importorskip("sqlalchemy")
+    from sqlalchemy import create_engine
+    from sqlalchemy.pool import StaticPool
+
+    from app.database import Base
+    import app.models  # noqa: F401
+
+    engine = create_engine("sqlite://", connect_args={"check_same_thread": False}, poolclass=StaticPool)
+    Base.metadata.create_all(engine)
+    yield engine
+    engine.dispose()
+
+
+@pytest.fixture
+def session_factory(db_engine):
+    """Фабрика сессий в стиле get_db: next(factory()) — новая сессия"""
+    from sqlalchemy.orm import sessionmaker
+
+    maker = sessionmaker(autocommit=False, autoflush=False, bind=db_engine)
+
+    def factory():
+        db = maker()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    return factory
+
+
+@pytest.fixture
+def db(session_factory):
+    session = next(session_factory())
+    yield session
+    session.close()
@@ -0,0 +1,141 @@
+"""
+Очередь анализа: захват, повтор с отсрочкой, dead и возврат задач упавших процессов
+"""
+import asyncio
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.config import settings  # noqa: E402
+from app.models import AnalysisJob, Letter, LetterStatus  # noqa: E402
+from app.services import analysis_queue as queue_module  # noqa: E402
+from app.services.analysis_queue import AnalysisQueue  # noqa: E402
+
+MAX_ATTEMPTS = 3
+
+
+@pytest.fixture(autouse=True)
+def queue_settings(monkeypatch):
+    monkeypatch.setattr(settings, "analysis_job_max_attempts", MAX_ATTEMPTS)
+    monkeypatch.setattr(settings, "analysis_job_stale_seconds", 60)
+
+
+def crash(db, job_id: int):
+    """Процесс упал во время анализа: задача осталась running с давним locked_at"""
+    job = db.get(AnalysisJob, job_id)
+    job.locked_at = datetime.now(timezone.utc) - timedelta(seconds=3600)
+    db.commit()
+
+
+def make_ready(db, job_id: int):
+    job = db.get(AnalysisJob, job_id)
+    job.run_after = datetime.now(timezone.utc) - timedelta(seconds=1)
+    db.commit()
+
+
+def test_enqueue_does_not_duplicate_active_job(db):
+    first = AnalysisQueue.enqueue(db, 1)
+    second = AnalysisQueue.enqueue(db, 1)
+    assert first.id == second.id
+    assert db.query(AnalysisJob).count() == 1
+
+
+def test_claim_marks_running_and_counts_attempt(db):
+    job = AnalysisQueue.enqueue(db, 1)
+    make_ready(db, job.id)
+
+    assert AnalysisQueue.claim(db, 10) == [(job.id, 1)]
+    db.refresh(job)
+    assert job.status == "running"
+    assert job.attempts == 1
+    assert job.locked_by == queue_module.WORKER_ID
+    # Захваченная задача другим обработчикам не достается
+    assert AnalysisQueue.claim(db, 10) == []
+
+
+def test_fail_retries_with_backoff_then_dead(db):
+    job = AnalysisQueue.enqueue(db, 1)
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        make_ready(db, job.id)
+        assert AnalysisQueue.claim(db, 10) == [(job.id, 1)]
+        AnalysisQueue.fail(db, job.id, "ошибка модели")
+        db.refresh(job)
+        assert job.attempts == attempt
+        if attempt < MAX_ATTEMPTS:
+            assert job.status == "queued"
+            # Повтор отложен: сразу задача не захватывается
+            assert AnalysisQueue.claim(db, 10) == []
+    assert job.status == "dead"
+    assert job.last_error == "ошибка модели"
+
+
+def test_release_does_not_count_attempt(db):
+    job = AnalysisQueue.enqueue(db, 1)
+    make_ready(db, job.id)
+    AnalysisQueue.claim(db, 10)
+    AnalysisQueue.release(db, job.id)
+    db.refresh(job)
+    assert job.status == "queued"
+    assert job.attempts == 0
+
+
+def test_crash_recover_claim_counts_each_crash_once(db):
+    job = AnalysisQueue.enqueue(db, 1)
+    for attempt in range(1, MAX_ATTEMPTS):
+        make_ready(db, job.id)
+        assert AnalysisQueue.claim(db, 10) == [(job.id, 1)]
+        crash(db, job.id)
+        assert AnalysisQueue.recover_stale(db) == 1
+        db.refresh(job)
+        assert job.status == "queued"
+        assert job.attempts == attempt
+        assert job.locked_at is None
+
+    # Последняя разрешенная попытка тоже падает — задача уходит в dead
+    make_ready(db, job.id)
+    assert AnalysisQueue.claim(db, 10) == [(job.id, 1)]
+    crash(db, job.id)
+    assert AnalysisQueue.recover_stale(db) == 1
+    db.refresh(job)
+    assert job.status == "dead"
+    assert job.attempts == MAX_ATTEMPTS
+
+
+def test_recover_leaves_fresh_running_jobs(db):
+    job = AnalysisQueue.enqueue(db, 1)
+    make_ready(db, job.id)
+    AnalysisQueue.claim(db, 10)
+    assert AnalysisQueue.recover_stale(db) == 0
+    db.refresh(job)
+    assert job.status == "running"
+
+
+def test_heartbeat_keeps_long_job_from_recovery(db):
+    job = AnalysisQueue.enqueue(db, 1)
+    make_ready(db, job.id)
+    AnalysisQueue.claim(db, 10)
+    crash(db, job.id)
+    AnalysisQueue.heartbeat(db, job.id)
+    assert AnalysisQueue.recover_stale(db) == 0
+
+
+def test_worker_completes_and_fails_jobs(db, session_factory, monkeypatch):
+    ok = AnalysisQueue.enqueue(db, 1)
+    broken = AnalysisQueue.enqueue(db, 2)
+
+    async def analyze_letter(db, letter_id, refresh_only=False):
+        if letter_id == 2:
+            raise RuntimeError("модель недоступна")
+        return Letter(id=letter_id, subject="Тема", body="Текст", status=LetterStatus.NEW)
+
+    monkeypatch.setattr(queue_module.LetterService, "analyze_letter", staticmethod(analyze_letter))
+    asyncio.run(queue_module._process_job(session_factory, ok.id, 1))
+    asyncio.run(queue_module._process_job(session_factory, broken.id, 2))
+
+    db.refresh(ok)
+    db.refresh(broken)
+    assert ok.status == "done"
+    assert broken.status == "queued"
+    assert broken.last_error == "модель недоступна"
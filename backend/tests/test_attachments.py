@@ -0,0 +1,205 @@
+"""
+Текст вложений: извлечение из DOCX/PDF и повтор анализа, если текст появился во время анализа
+"""
+import asyncio
+import zipfile
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("imapclient")
+
+from app.models import AnalysisJob, Letter, LetterAttachment, LetterStatus  # noqa: E402
+from app.services import analysis_queue as queue_module  # noqa: E402
+from app.services.analysis_queue import AnalysisQueue  # noqa: E402
+from app.services.attachment_service import AttachmentService  # noqa: E402
+from app.services.attachment_text import UnsupportedAttachment, extract_text  # noqa: E402
+from app.services.letter_service import LetterService  # noqa: E402
+
+DOCUMENT_XML = (
+    '<?xml version="1.0" encoding="UTF-8"?>'
+    '<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main"><w:body>'
+    '<w:p><w:r><w:t>Договор поставки </w:t></w:r><w:r><w:t>№ 45-1</w:t></w:r></w:p>'
+    '<w:p/>'
+    '<w:p><w:r><w:t>Сумма: 120 000 ₽</w:t></w:r></w:p>'
+    '</w:body></w:document>'
+)
+
+
+def write_docx(path, document_xml=DOCUMENT_XML):
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("[Content_Types].xml", "<Types/>")
+        archive.writestr("word/document.xml", document_xml)
+    return str(path)
+
+
+def write_pdf(path, text: str):
+    """Одностраничный PDF с текстовым слоем"""
+    stream = f"BT /F1 12 Tf 72 720 Td ({text}) Tj ET".encode("latin-1")
+    objects = [
+        b"<< /Type /Catalog /Pages 2 0 R >>",
+        b"<< /Type /Pages /Kids [3 0 R] /Count 1 >>",
+        b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] "
+        b"/Resources << /Font << /F1 5 0 R >> >> /Contents 4 0 R >>",
+        b"<< /Length %d >>\nstream\n%s\nendstream" % (len(stream), stream),
+        b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>",
+    ]
+    data = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(data))
+        data += b"%d 0 obj\n%s\nendobj\n" % (number, body)
+    xref = len(data)
+    data += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    data += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    data += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    path.write_bytes(data)
+    return str(path)
+
+
+# --- Извлечение текста ---
+
+def test_docx_paragraphs_are_extracted(tmp_path):
+    text = extract_text(write_docx(tmp_path / "contract.docx"), "docx", 1000)
+    assert text == "Договор поставки № 45-1\nСумма: 120 000 ₽"
+
+
+def test_docx_text_is_limited(tmp_path):
+    assert len(extract_text(write_docx(tmp_path / "contract.docx"), "docx", 10)) == 10
+
+
+def test_pdf_text_layer_is_extracted(tmp_path):
+    pytest.importorskip("pypdf")
+    text = extract_text(write_pdf(tmp_path / "invoice.pdf", "Invoice 2026-10 total 120000"), "pdf", 1000)
+    assert "Invoice 2026-10 total 120000" in text
+
+
+@pytest.mark.parametrize("kind, content", [
+    ("docx", b"not a zip archive"),
+    ("pdf", b"%PDF-1.4\nbroken"),
+])
+def test_corrupt_attachment_is_unsupported(tmp_path, kind, content):
+    if kind == "pdf":
+        pytest.importorskip("pypdf")
+    path = tmp_path / f"broken.{kind}"
+    path.write_bytes(content)
+    with pytest.raises(UnsupportedAttachment):
+        extract_text(str(path), kind, 1000)
+
+
+def test_docx_without_document_xml_is_unsupported(tmp_path):
+    path = tmp_path / "empty.docx"
+    with zipfile.ZipFile(path, "w") as archive:
+        archive.writestr("[Content_Types].xml", "<Types/>")
+    with pytest.raises(UnsupportedAttachment):
+        extract_text(str(path), "docx", 1000)
+
+
+# --- Повтор анализа ---
+
+def add_letter(db, status=LetterStatus.NEW, fingerprint=None):
+    letter = Letter(subject="Счет", body="Оплата по договору во вложении", status=status, analysis_fingerprint=fingerprint)
+    db.add(letter)
+    db.commit()
+    return letter
+
+
+def add_attachment_text(db, letter_id: int):
+    db.add(LetterAttachment(
+        letter_id=letter_id, account="office@example.com", mailbox="INBOX", uid=1, section="2",
+        filename="invoice.pdf", content_type="application/pdf", size=100,
+        status="done", extracted_text="Итого к оплате 120 000 ₽"
+    ))
+    db.commit()
+
+
+def claim_job(db, letter_id: int) -> int:
+    job = AnalysisQueue.enqueue(db, letter_id)
+    job.run_after = job.created_at
+    db.commit()
+    (job_id, _), = AnalysisQueue.claim(db, 1)
+    return job_id
+
+
+def analysis_reading_text_before(db, during=None):
+    """Анализ, прочитавший письмо до извлечения текста вложений"""
+    async def analyze_letter(session, letter_id, refresh_only=False):
+        letter = session.get(Letter, letter_id)
+        fingerprint = LetterService.analysis_fingerprint(session, letter)
+        letter.status = LetterStatus.ANALYZING
+        session.commit()
+        if during:
+            during()
+        letter.analysis_fingerprint = fingerprint
+        letter.status = LetterStatus.NEW
+        session.commit()
+        return letter
+
+    return analyze_letter
+
+
+def test_attachment_text_during_analysis_requeues_running_job(db, session_factory, monkeypatch):
+    letter = add_letter(db)
+    job_id = claim_job(db, letter.id)
+
+    def attachment_cycle_finishes():
+        # Письмо в ANALYZING без отпечатка: задача уже выполняется
+        add_attachment_text(db, letter.id)
+        AttachmentService._requeue_analysis(db, {letter.id})
+        assert db.get(AnalysisJob, job_id).rerun_requested
+
+    monkeypatch.setattr(
+        queue_module.LetterService, "analyze_letter", staticmethod(analysis_reading_text_before(db, attachment_cycle_finishes))
+    )
+    asyncio.run(queue_module._process_job(session_factory, job_id, letter.id))
+
+    db.expire_all()
+    jobs = db.query(AnalysisJob).order_by(AnalysisJob.id).all()
+    assert [(job.letter_id, job.status) for job in jobs] == [(letter.id, "done"), (letter.id, "queued")]
+
+
+def test_outdated_fingerprint_after_analysis_requeues_letter(db, session_factory, monkeypatch):
+    letter = add_letter(db)
+    job_id = claim_job(db, letter.id)
+
+    # Текст вложений сохранен без вызова _requeue_analysis (например, процесс вложений упал после commit)
+    monkeypatch.setattr(
+        queue_module.LetterService, "analyze_letter",
+        staticmethod(analysis_reading_text_before(db, lambda: add_attachment_text(db, letter.id)))
+    )
+    asyncio.run(queue_module._process_job(session_factory, job_id, letter.id))
+
+    db.expire_all()
+    assert [job.status for job in db.query(AnalysisJob).order_by(AnalysisJob.id)] == ["done", "queued"]
+
+
+def test_analysis_with_attachment_text_is_not_repeated(db, session_factory, monkeypatch):
+    letter = add_letter(db)
+    add_attachment_text(db, letter.id)
+    job_id = claim_job(db, letter.id)
+
+    monkeypatch.setattr(queue_module.LetterService, "analyze_letter", staticmethod(analysis_reading_text_before(db)))
+    asyncio.run(queue_module._process_job(session_factory, job_id, letter.id))
+
+    db.expire_all()
+    assert [job.status for job in db.query(AnalysisJob)] == ["done"]
+
+
+def test_letters_in_workflow_are_not_requeued(db):
+    letter = add_letter(db, status=LetterStatus.IN_PROGRESS, fingerprint="old")
+    add_attachment_text(db, letter.id)
+
+    AttachmentService._requeue_analysis(db, {letter.id})
+
+    assert db.query(AnalysisJob).count() == 0
+
+
+def test_analyzed_letter_is_requeued_with_attachment_text(db):
+    letter = add_letter(db)
+    letter.analysis_fingerprint = LetterService.analysis_fingerprint(db, letter)
+    db.commit()
+    add_attachment_text(db, letter.id)
+
+    AttachmentService._requeue_analysis(db, {letter.id})
+
+    assert [job.status for job in db.query(AnalysisJob)] == ["queued"]
@@ -0,0 +1,107 @@
+"""
+Пакетный анализ: запросы к API идут вне транзакции, результат сохраняется через single-flight
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("httpx")
+
+from app.models import BatchAnalysisItem, Letter, LetterStatus  # noqa: E402
+from app.services import batch_analysis as batch_module  # noqa: E402
+from app.services.batch_analysis import BatchAnalysisService, StubOperationAPI  # noqa: E402
+from app.services.single_flight import SingleFlight  # noqa: E402
+
+
+class CheckedAPI(StubOperationAPI):
+    """Заглушка, проверяющая, что во время запроса транзакция сессии закрыта"""
+
+    def __init__(self, db):
+        super().__init__(delay=0)
+        self.db = db
+        self.calls = 0
+
+    async def submit(self, stage, prompt, system_prompt):
+        assert not self.db.in_transaction()
+        self.calls += 1
+        return await super().submit(stage, prompt, system_prompt)
+
+    async def get(self, operation_id):
+        assert not self.db.in_transaction()
+        self.calls += 1
+        return await super().get(operation_id)
+
+
+@pytest.fixture
+def single_flight(monkeypatch):
+    flight = SingleFlight(pg_enabled=False)
+    monkeypatch.setattr(batch_module, "letter_single_flight", flight)
+    return flight
+
+
+@pytest.fixture
+def letter(db):
+    letter = Letter(subject="Запрос выписки", body="Прошу направить выписку", status=LetterStatus.NEW)
+    db.add(letter)
+    db.commit()
+    return letter
+
+
+def test_cycle_runs_api_calls_outside_transactions(db, letter, single_flight):
+    api = CheckedAPI(db)
+    service = BatchAnalysisService(api)
+    assert service.enqueue(db, [letter.id]) == 1
+
+    for _ in range(4):
+        asyncio.run(service.run_cycle(db))
+
+    item = db.query(BatchAnalysisItem).one()
+    assert item.status == "done"
+    assert item.stage == "drafts"
+    assert item.locked_at is None
+    assert api.calls == 4  # отправка и опрос на каждом из двух этапов
+    db.refresh(letter)
+    assert letter.classification_data is not None
+    assert letter.draft_responses
+
+
+def test_claimed_items_are_skipped_by_other_workers(db, letter):
+    BatchAnalysisService.enqueue(db, [letter.id])
+    first = BatchAnalysisService._claim(db, "pending", 10)
+    assert first and not db.in_transaction()
+    assert BatchAnalysisService._claim(db, "pending", 10) == []
+
+    BatchAnalysisService._release(db, first)
+    assert BatchAnalysisService._claim(db, "pending", 10) == first
+
+
+def test_result_is_not_applied_over_a_concurrent_analysis(db, letter, single_flight):
+    api = CheckedAPI(db)
+    service = BatchAnalysisService(api)
+    service.enqueue(db, [letter.id])
+    asyncio.run(service._submit(db))
+
+    async def scenario():
+        release = asyncio.Event()
+
+        async def interactive_analysis():
+            await release.wait()
+            letter.draft_responses = {"official": "Интерактивный черновик"}
+            db.commit()
+
+        running = asyncio.create_task(single_flight.run(letter.id, interactive_analysis))
+        await asyncio.sleep(0)
+        poll = asyncio.create_task(service._poll(db))
+        await asyncio.sleep(0.05)
+        release.set()
+        await running
+        return await poll
+
+    assert asyncio.run(scenario()) == 1
+    item = db.query(BatchAnalysisItem).one()
+    assert item.status == "done"
+    assert item.locked_at is None
+    db.refresh(letter)
+    assert letter.classification_data is None
+    assert letter.draft_responses == {"official": "Интерактивный черновик"}
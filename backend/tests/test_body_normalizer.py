@@ -0,0 +1,68 @@
+"""
+Сокращение текста письма: цитаты и подписи убираются, текст письма — нет
+"""
+from app.services.body_normalizer import compact_body
+
+
+def test_reply_with_attribution_and_quote_is_cut():
+    body = (
+        "Добрый день! Документы направили повторно.\n"
+        "\n"
+        "15.10.2026, 12:00, \"Банк\" <info@bank.ru>:\n"
+        "> Просим направить копию договора.\n"
+        "> С уважением, банк"
+    )
+    assert compact_body(body) == "Добрый день! Документы направили повторно."
+
+
+def test_outlook_header_with_address_is_cut():
+    body = (
+        "Согласуем до пятницы.\n"
+        "\n"
+        "От: Иванов Иван <ivanov@partner.ru>\n"
+        "Отправлено: 14 октября 2026 г. 10:15\n"
+        "Кому: info@bank.ru\n"
+        "Тема: Договор\n"
+        "\n"
+        "Направляем проект договора."
+    )
+    assert compact_body(body) == "Согласуем до пятницы."
+
+
+def test_complaint_quoting_a_person_is_kept():
+    body = (
+        "Здравствуйте!\n"
+        "Сотрудник отделения мне написал:\n"
+        "«Комиссия будет возвращена в течение трех дней».\n"
+        "Прошло две недели, деньги не вернули. Прошу разобраться."
+    )
+    assert compact_body(body) == body
+
+
+def test_regulator_requisites_are_kept():
+    body = (
+        "Центральный банк Российской Федерации\n"
+        "От: 12.10.2026 № 45-1\n"
+        "Дата: 12.10.2026\n"
+        "\n"
+        "Предписание: в срок до 30.10.2026 представить сведения о жалобах клиентов."
+    )
+    assert compact_body(body) == body
+
+
+def test_mid_body_double_dash_is_kept():
+    lines = ["Прошу рассмотреть следующие вопросы:", "--"]
+    lines += [f"{number}. Вопрос по операции {number}" for number in range(1, 21)]
+    lines += ["", "Жду ответа."]
+    body = "\n".join(lines)
+    assert compact_body(body) == body
+
+
+def test_signature_after_delimiter_is_cut():
+    body = (
+        "Прошу перезвонить.\n"
+        "-- \n"
+        "Петров Петр\n"
+        "+7 900 000-00-00"
+    )
+    assert compact_body(body) == "Прошу перезвонить."
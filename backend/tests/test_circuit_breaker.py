@@ -0,0 +1,98 @@
+"""
+Circuit breaker: пробный вызов half-open освобождает только его владелец
+"""
+import asyncio
+from contextlib import asynccontextmanager
+
+import pytest
+
+pytest.importorskip("httpx")
+pytest.importorskip("pydantic_settings")
+
+from app.services import yandex_gpt as yandex_gpt_module  # noqa: E402
+from app.services.llm_circuit_breaker import CircuitBreaker, CircuitOpenError  # noqa: E402
+
+
+def make_breaker() -> CircuitBreaker:
+    return CircuitBreaker(window=4, min_calls=2, error_rate=0.5,
+                          slow_call_seconds=60, slow_call_rate=1.0, open_seconds=0)
+
+
+def open_breaker(breaker: CircuitBreaker):
+    breaker.record(False, 0.1)
+    breaker.record(False, 0.1)
+    assert breaker.state == "open"
+
+
+def test_check_reports_trial_ownership():
+    breaker = make_breaker()
+    assert breaker.check() is False
+
+    open_breaker(breaker)
+    assert breaker.check() is True
+    # Второй вызов в half-open отклоняется, пока идет пробный
+    with pytest.raises(CircuitOpenError):
+        breaker.check()
+
+    breaker.record(True, 0.1)
+    assert breaker.state == "closed"
+
+
+@pytest.fixture
+def breaker(monkeypatch):
+    breaker = make_breaker()
+    monkeypatch.setattr(yandex_gpt_module, "llm_circuit_breaker", breaker)
+    return breaker
+
+
+def test_cancelled_generate_releases_its_trial(breaker, monkeypatch):
+    service = yandex_gpt_module.YandexGPTService()
+    started = asyncio.Event()
+
+    async def slow_post(headers, payload, estimated_tokens=0):
+        started.set()
+        await asyncio.sleep(30)
+
+    monkeypatch.setattr(service, "_post", slow_post)
+    open_breaker(breaker)
+
+    async def scenario():
+        task = asyncio.create_task(service.generate("prompt"))
+        await started.wait()
+        assert breaker._trial_in_flight
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert breaker._trial_in_flight is False
+    assert breaker.check() is True
+
+
+def test_cancelled_request_does_not_release_foreign_trial(breaker, monkeypatch):
+    service = yandex_gpt_module.YandexGPTService()
+    started = asyncio.Event()
+
+    class SlowClient:
+        async def post(self, *args, **kwargs):
+            started.set()
+            await asyncio.sleep(30)
+
+    @asynccontextmanager
+    async def http_client():
+        yield SlowClient()
+
+    monkeypatch.setattr(service, "_http_client", http_client)
+    open_breaker(breaker)
+    # Пробный вызов занят другим запросом
+    assert breaker.check() is True
+
+    async def scenario():
+        task = asyncio.create_task(service._post_once({}, {}))
+        await started.wait()
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(scenario())
+    assert breaker._trial_in_flight is True
@@ -0,0 +1,188 @@
+"""
+Прием писем из IMAP: чекпоинт по UID, UIDVALIDITY и письма, которые не удалось разобрать
+"""
+import email
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("imapclient")
+
+from app.models import AnalysisJob, Letter, MailboxSyncState  # noqa: E402
+from app.services.letter_service import LetterService  # noqa: E402
+from app.services.mail_service import UnparsedMessage, YandexMailService  # noqa: E402
+
+
+def message(subject: str, sender: str = "Клиент <client@example.com>", message_id: str = None, **extra):
+    lines = [f"Subject: {subject}", f"From: {sender}"]
+    if message_id:
+        lines.append(f"Message-ID: {message_id}")
+    lines += [f"{name.replace('_', '-')}: {value}" for name, value in extra.items()]
+    return email.message_from_string("\n".join(lines) + "\n\n")
+
+
+class FakeIMAP:
+    def __init__(self, uidvalidity: int, uidnext: int, uids, unseen=None):
+        self.folder = {b'UIDVALIDITY': uidvalidity, b'UIDNEXT': uidnext, b'EXISTS': len(uids)}
+        self.uids = list(uids)
+        self.unseen = list(unseen if unseen is not None else uids)
+        self.searches = []
+        self.seen = []
+
+    def select_folder(self, mailbox):
+        return self.folder
+
+    def search(self, criteria):
+        self.searches.append(criteria)
+        return self.unseen if criteria == ['UNSEEN'] else self.uids
+
+    def add_flags(self, uids, flags):
+        self.seen.extend(uids)
+
+
+def service(client, messages):
+    """Сервис с подставленным IMAP и готовыми результатами разбора {uid: (заголовки, текст, вложения)}"""
+    mail = YandexMailService(login="office@example.com", password="secret")
+    mail.client = client
+    mail._fetch_chunk = lambda uids: {uid: messages[uid] for uid in uids if uid in messages}
+    return mail
+
+
+def sync_state(db, uidvalidity: int, last_uid: int):
+    state = MailboxSyncState(account="office@example.com", mailbox="INBOX", uidvalidity=uidvalidity, last_uid=last_uid)
+    db.add(state)
+    db.commit()
+    return state
+
+
+def test_uidvalidity_change_resyncs_unseen_and_moves_checkpoint(db):
+    sync_state(db, uidvalidity=1, last_uid=500)
+    client = FakeIMAP(uidvalidity=2, uidnext=13, uids=[], unseen=[7, 12])
+    mail = service(client, {
+        7: (message("Старое непрочитанное"), "Текст 1", []),
+        12: (message("Новое письмо"), "Текст 2", []),
+    })
+
+    created = mail._fetch_new_emails(db, "INBOX")
+
+    assert [letter.subject for letter in created] == ["Старое непрочитанное", "Новое письмо"]
+    assert client.searches == [['UNSEEN']]
+    state = db.query(MailboxSyncState).one()
+    assert state.uidvalidity == 2
+    assert state.last_uid == 12
+    assert state.pending == 0
+
+
+def test_checkpoint_continues_from_last_uid(db):
+    sync_state(db, uidvalidity=1, last_uid=10)
+    client = FakeIMAP(uidvalidity=1, uidnext=12, uids=[10, 11])
+    mail = service(client, {11: (message("Ответ"), "Текст", [])})
+
+    created = mail._fetch_new_emails(db, "INBOX")
+
+    assert [letter.subject for letter in created] == ["Ответ"]
+    assert client.searches == [['UID', "11:*"]]
+    assert db.query(MailboxSyncState).one().last_uid == 11
+
+
+def test_unparsed_message_is_stored_as_placeholder(db, caplog):
+    sync_state(db, uidvalidity=1, last_uid=10)
+    client = FakeIMAP(uidvalidity=1, uidnext=13, uids=[11, 12])
+    mail = service(client, {
+        11: UnparsedMessage(ValueError("битая кодировка"), message("Счет за октябрь", message_id="<broken@example.com>")),
+        12: (message("Обычное письмо"), "Текст", []),
+    })
+
+    with caplog.at_level("ERROR"):
+        created = mail._fetch_new_emails(db, "INBOX")
+
+    placeholder, regular = created
+    assert placeholder.subject == "Счет за октябрь"
+    assert placeholder.sender_email == "client@example.com"
+    assert placeholder.parse_error == "битая кодировка"
+    assert "не удалось разобрать" in placeholder.body
+    assert regular.parse_error is None
+    # Заглушку не анализируют, обычное письмо стоит в очереди
+    assert [job.letter_id for job in db.query(AnalysisJob).all()] == [regular.id]
+    assert db.query(MailboxSyncState).one().last_uid == 12
+    assert client.seen == [11, 12]
+    assert any("UID 11" in record.message and "office@example.com/INBOX" in record.message for record in caplog.records)
+
+
+def test_unparsed_message_without_headers_is_not_lost(db):
+    sync_state(db, uidvalidity=1, last_uid=10)
+    client = FakeIMAP(uidvalidity=1, uidnext=12, uids=[11])
+    mail = service(client, {11: UnparsedMessage(ValueError("нет BODYSTRUCTURE"))})
+
+    created = mail._fetch_new_emails(db, "INBOX")
+
+    assert len(created) == 1
+    assert created[0].subject == "Без темы"
+    assert created[0].parse_error == "нет BODYSTRUCTURE"
+    assert db.query(Letter).count() == 1
+
+
+def test_same_message_id_from_another_folder_is_not_duplicated(db):
+    sync_state(db, uidvalidity=1, last_uid=0)
+    inbox = service(FakeIMAP(uidvalidity=1, uidnext=2, uids=[1]), {
+        1: (message("Претензия", message_id="<claim-1@example.com>"), "Текст письма", []),
+    })
+    assert len(inbox._fetch_new_emails(db, "INBOX")) == 1
+
+    # Копия в другой папке: текст отличается (например, добавлена пересылка), Message-ID тот же
+    archive_client = FakeIMAP(uidvalidity=7, uidnext=5, uids=[4])
+    archive = service(archive_client, {
+        4: (message("Претензия", message_id="<claim-1@example.com>"), "Текст письма\n-- переслано", []),
+    })
+    assert archive._fetch_new_emails(db, "Archive") == []
+
+    assert db.query(Letter).count() == 1
+    assert db.query(AnalysisJob).count() == 1
+    # Дубликат помечен прочитанным и чекпоинт продвинут
+    assert archive_client.seen == [4]
+    assert db.query(MailboxSyncState).filter(MailboxSyncState.mailbox == "Archive").one().last_uid == 4
+
+
+def test_same_content_without_message_id_is_deduplicated_by_hash(db):
+    sync_state(db, uidvalidity=1, last_uid=0)
+    client = FakeIMAP(uidvalidity=1, uidnext=3, uids=[1, 2])
+    mail = service(client, {
+        1: (message("Заявка", sender="Client@Example.com"), "Прошу выставить счет\nИНН 7701", []),
+        2: (message("Заявка", sender="client@example.com"), "Прошу выставить счет\r\nИНН 7701\r\n", []),
+    })
+
+    created = mail._fetch_new_emails(db, "INBOX")
+
+    assert len(created) == 1
+    assert db.query(Letter).count() == 1
+    assert client.seen == [1, 2]
+
+
+def test_same_subject_with_different_text_is_a_new_letter(db):
+    sync_state(db, uidvalidity=1, last_uid=0)
+    mail = service(FakeIMAP(uidvalidity=1, uidnext=3, uids=[1, 2]), {
+        1: (message("Вопрос"), "Первый вопрос", []),
+        2: (message("Вопрос"), "Второй вопрос", []),
+    })
+
+    assert len(mail._fetch_new_emails(db, "INBOX")) == 2
+
+
+def test_ingest_enqueues_analysis_instead_of_analyzing(db, monkeypatch):
+    async def analyze_inline(*args, **kwargs):
+        raise AssertionError("прием не должен ждать Yandex GPT")
+
+    monkeypatch.setattr(LetterService, "analyze_letter", analyze_inline)
+    sync_state(db, uidvalidity=1, last_uid=0)
+    mail = service(FakeIMAP(uidvalidity=1, uidnext=3, uids=[1, 2]), {
+        1: (message("Первое"), "Текст 1", []),
+        2: (message("Второе"), "Текст 2", []),
+    })
+
+    created = mail._fetch_new_emails(db, "INBOX")
+
+    jobs = db.query(AnalysisJob).order_by(AnalysisJob.letter_id).all()
+    assert [job.letter_id for job in jobs] == [letter.id for letter in created]
+    assert all(job.status == "queued" and job.attempts == 0 for job in jobs)
+    # Письма остаются новыми до обработки очередью
+    assert all(letter.letter_type.value == "other" and letter.classification_data is None for letter in created)
@@ -0,0 +1,86 @@
+"""
+Пул разбора писем: ожидание от начала задачи и повтор задач, прерванных пересозданием пула
+"""
+import os
+import time
+
+import pytest
+
+pytest.importorskip("html2text")
+
+from app.services.mail_parser import MailParser  # noqa: E402
+
+HANG = 30
+
+
+@pytest.fixture
+def parser():
+    parser = MailParser(processes=1, cpu_seconds=5)
+    parser.wall_seconds = 1.5
+    # Запуск процессов (spawn) не входит в ожидание задач теста
+    parser.call(len, b"warm-up")
+    yield parser
+    parser.shutdown()
+
+
+def test_queued_tasks_are_not_timed_out_while_waiting_for_a_process(parser):
+    # Каждая задача укладывается в лимит, вместе — нет: отсчет идет от начала каждой
+    results = parser._run_pool([(time.sleep, (0.9,)), (time.sleep, (0.9,)), (len, (b"abc",))])
+
+    assert results == [None, None, 3]
+    assert parser.stats["timeouts"] == 0
+
+
+def test_hung_task_does_not_discard_its_siblings(parser):
+    started = time.monotonic()
+    results = parser._run_pool([(time.sleep, (HANG,)), (len, (b"ab",)), (len, (b"abcd",))])
+
+    assert isinstance(results[0], TimeoutError)
+    assert results[1:] == [2, 4]
+    assert time.monotonic() - started < HANG / 2
+    assert parser.stats["timeouts"] == 1
+    assert parser.stats["resubmitted"] == 2
+    assert parser.stats["pool_restarts"] == 1
+
+
+def test_timeout_counts_from_task_start_not_from_await():
+    parser = MailParser(processes=2, cpu_seconds=5)
+    parser.wall_seconds = 1.5
+    try:
+        parser._run_pool([(time.sleep, (0.3,)), (time.sleep, (0.3,))])
+        started = time.monotonic()
+        results = parser._run_pool([(time.sleep, (1.2,)), (time.sleep, (HANG,))])
+        elapsed = time.monotonic() - started
+    finally:
+        parser.shutdown()
+
+    assert results[0] is None
+    assert isinstance(results[1], TimeoutError)
+    # Ожидание зависшей задачи не продлевается временем ожидания первой
+    assert elapsed < 2.5
+
+
+def test_call_raises_task_error(parser):
+    with pytest.raises(TypeError):
+        parser.call(len, 5)
+    assert parser.stats["errors"] == 1
+
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "mail")
+
+
+@pytest.mark.parametrize("name, expected", [
+    ("plain_utf8.eml", "выписку по счету"),
+    ("alternative.eml", "банковских реквизитов"),
+    ("html_statement.eml", "Платеж 299"),
+    ("cp1251_quoted_printable.eml", "Претензия по договору 45-1"),
+    ("broken_multipart.eml", "Unclosed"),
+])
+def test_fixture_corpus_is_parsed_in_pool(parser, name, expected):
+    with open(os.path.join(FIXTURES, name), "rb") as f:
+        raw = f.read()
+
+    body, = parser.parse_bodies([raw])
+
+    assert expected in body
+    assert parser.stats["timeouts"] == 0
@@ -0,0 +1,80 @@
+"""
+Отставание приема по каждой папке каждого ящика (/api/mail/status)
+"""
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("imapclient")
+
+from app.models import MailboxSyncState  # noqa: E402
+from app.services import mail_service as mail_module  # noqa: E402
+from app.services.mail_service import YandexMailService  # noqa: E402
+
+
+class SQLiteClock(datetime):
+    """SQLite возвращает время без часового пояса: сервис считает в UTC без пояса"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+@pytest.fixture
+def configured(monkeypatch):
+    monkeypatch.setattr(mail_module, "datetime", SQLiteClock)
+    mailboxes = [
+        YandexMailService(login="office@example.com", password="x", mailbox="INBOX"),
+        YandexMailService(login="office@example.com", password="x", mailbox="Archive"),
+        YandexMailService(login="sales@example.com", password="x", mailbox="INBOX"),
+    ]
+    monkeypatch.setattr(mail_module, "mailboxes", mailboxes)
+    return mailboxes
+
+
+def add_state(db, account, mailbox, caught_up_ago, pending, error=None):
+    now = SQLiteClock.now()
+    state = MailboxSyncState(
+        account=account, mailbox=mailbox, last_uid=100, pending=pending,
+        last_sync_at=now, caught_up_at=now - timedelta(seconds=caught_up_ago), last_error=error
+    )
+    db.add(state)
+    db.commit()
+    return state
+
+
+def test_lag_is_reported_per_account_and_folder(db, configured):
+    add_state(db, "office@example.com", "INBOX", caught_up_ago=5, pending=0)
+    add_state(db, "office@example.com", "Archive", caught_up_ago=600, pending=40, error="Ошибка сохранения писем")
+
+    statuses = {(item["email"], item["mailbox"]): item for item in mail_module.mailbox_statuses(db)}
+
+    assert list(statuses) == [
+        ("office@example.com", "INBOX"),
+        ("office@example.com", "Archive"),
+        ("sales@example.com", "INBOX"),
+    ]
+    assert statuses[("office@example.com", "INBOX")]["pending"] == 0
+    assert 5 <= statuses[("office@example.com", "INBOX")]["lag_seconds"] < 60
+    archive = statuses[("office@example.com", "Archive")]
+    assert archive["pending"] == 40
+    assert archive["lag_seconds"] >= 600
+    assert archive["last_error"] == "Ошибка сохранения писем"
+    # Папка еще ни разу не синхронизировалась
+    assert statuses[("sales@example.com", "INBOX")]["lag_seconds"] is None
+    assert statuses[("sales@example.com", "INBOX")]["last_uid"] is None
+
+
+def test_caught_up_time_moves_only_when_backlog_is_cleared(db, configured):
+    mail = configured[1]
+    state = add_state(db, "office@example.com", "Archive", caught_up_ago=600, pending=40)
+    previous = state.caught_up_at
+
+    mail._record_sync(db, "Archive", pending=15)
+    assert state.pending == 15
+    assert state.caught_up_at == previous
+
+    mail._record_sync(db, "Archive", pending=0)
+    assert state.pending == 0
+    assert state.caught_up_at > previous
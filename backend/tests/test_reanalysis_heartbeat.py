@@ -0,0 +1,47 @@
+"""
+Heartbeat запуска повторного анализа не зависит от завершения писем
+"""
+import asyncio
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from sqlalchemy.orm import sessionmaker  # noqa: E402
+
+from app.config import settings  # noqa: E402
+from app.models import ReanalysisRun  # noqa: E402
+from app.services import reanalysis_service as reanalysis_module  # noqa: E402
+
+
+def test_heartbeat_advances_during_long_analysis(db, db_engine, monkeypatch):
+    run = ReanalysisRun(filters={}, status="running", concurrency=1, total=1)
+    db.add(run)
+    db.commit()
+
+    monkeypatch.setattr(settings, "reanalysis_stale_seconds", 0.3)
+    monkeypatch.setattr(reanalysis_module, "SessionLocal", sessionmaker(bind=db_engine))
+
+    touches = []
+    real_touch = reanalysis_module._touch
+
+    def touch(run_id):
+        touches.append(run_id)
+        return real_touch(run_id)
+
+    async def slow_analysis(letter_id, force):
+        # Запрос к модели дольше stale-таймаута
+        await asyncio.sleep(0.35)
+        return "processed"
+
+    monkeypatch.setattr(reanalysis_module, "_touch", touch)
+    monkeypatch.setattr(reanalysis_module, "_analyze_one", slow_analysis)
+
+    asyncio.run(reanalysis_module._execute_run(run.id, [1]))
+
+    db.expire_all()
+    run = db.get(ReanalysisRun, run.id)
+    assert len(touches) >= 2
+    assert run.status == "completed"
+    assert run.processed == 1
+    assert run.heartbeat_at is not None
@@ -0,0 +1,143 @@
+"""
+Повторный анализ письма в работе: статус, дедлайн и маршрут согласования сохраняются
+"""
+import asyncio
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+pytest.importorskip("psycopg2")
+pytest.importorskip("pydantic_settings")
+pytest.importorskip("httpx")
+
+from app.models import Letter, LetterStatus  # noqa: E402
+from app.services import letter_service as letter_service_module  # noqa: E402
+from app.services.letter_service import LetterService  # noqa: E402
+
+DEADLINE = datetime(2026, 10, 20, 18, 0)
+ROUTE = [{"department": "legal", "order": 1}]
+
+ANALYSIS = {
+    "classification": {"type": "complaint", "confidence": 0.9},
+    "formality_level": "corporate",
+    "sla_hours": 4,
+    "sla_reasoning": "Жалоба клиента",
+    "required_departments": ["compliance"],
+    "extracted_entities": {"contract": "45-1"},
+    "risks": ["репутационный"],
+    "approval_route": [{"department": "compliance", "order": 1}],
+}
+
+
+class FakeQuery:
+    def __init__(self, letter):
+        self.letter = letter
+
+    def filter(self, *args):
+        return self
+
+    def first(self):
+        return self.letter
+
+
+class FakeSession:
+    def __init__(self, letter):
+        self.letter = letter
+
+    def query(self, *args):
+        return FakeQuery(self.letter)
+
+    def commit(self):
+        pass
+
+    def refresh(self, obj):
+        pass
+
+
+def make_letter(status: LetterStatus) -> Letter:
+    return Letter(
+        id=1,
+        subject="Претензия по договору",
+        body="Прошу вернуть комиссию",
+        status=status,
+        classification_data={"type": "info_request"},
+        letter_type="info_request",
+        sla_hours=48,
+        deadline=DEADLINE,
+        priority=2,
+        required_departments=["legal"],
+        approval_route=ROUTE,
+        draft_responses={"official": "Старый черновик"},
+    )
+
+
+@pytest.fixture
+def fake_gpt(monkeypatch):
+    async def analyze_letter(subject, content):
+        return dict(ANALYSIS)
+
+    async def generate_responses(subject, content, analysis, on_variant=None):
+        return {"official": "Новый черновик"}
+
+    gpt = letter_service_module.yandex_gpt_service
+    monkeypatch.setattr(gpt, "analyze_letter", analyze_letter)
+    monkeypatch.setattr(gpt, "generate_responses", generate_responses)
+    monkeypatch.setattr(gpt, "analysis_fingerprint", lambda subject, content: "fingerprint")
+    monkeypatch.setattr(LetterService, "analysis_text", staticmethod(lambda db, letter: letter.body))
+    monkeypatch.setattr(LetterService, "align_with_thread", staticmethod(lambda db, letter, analysis: analysis))
+
+
+def test_refresh_keeps_workflow_fields(fake_gpt):
+    letter = make_letter(LetterStatus.IN_APPROVAL)
+    asyncio.run(LetterService._analyze_letter(FakeSession(letter), 1, refresh_only=True))
+
+    assert letter.status == LetterStatus.IN_APPROVAL
+    assert letter.deadline == DEADLINE
+    assert letter.sla_hours == 48
+    assert letter.approval_route == ROUTE
+    assert letter.required_departments == ["legal"]
+    # Классификация и черновики обновлены
+    assert letter.letter_type == "complaint"
+    assert letter.risks == ["репутационный"]
+    assert letter.draft_responses == {"official": "Новый черновик"}
+
+
+def test_refresh_of_new_letter_applies_full_analysis(fake_gpt):
+    letter = make_letter(LetterStatus.NEW)
+    asyncio.run(LetterService._analyze_letter(FakeSession(letter), 1, refresh_only=True))
+
+    assert letter.status == LetterStatus.NEW
+    assert letter.sla_hours == 4
+    assert letter.deadline != DEADLINE
+    assert letter.approval_route == ANALYSIS["approval_route"]
+
+
+def test_manual_analysis_still_resets_to_new(fake_gpt):
+    letter = make_letter(LetterStatus.IN_PROGRESS)
+    asyncio.run(LetterService._analyze_letter(FakeSession(letter), 1))
+
+    assert letter.status == LetterStatus.NEW
+    assert letter.approval_route == ANALYSIS["approval_route"]
+
+
+def test_deferred_retry_keeps_workflow_of_taken_letters(db, session_factory, monkeypatch):
+    new_letter = Letter(subject="Новое", body="Текст", status=LetterStatus.NEW, needs_reanalysis=True)
+    taken = Letter(subject="В работе", body="Текст", status=LetterStatus.IN_APPROVAL, needs_reanalysis=True)
+    db.add_all([new_letter, taken])
+    db.commit()
+
+    calls = {}
+
+    async def analyze_letter(db, letter_id, refresh_only=False):
+        calls[letter_id] = refresh_only
+
+    async def stop(seconds):
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(LetterService, "analyze_letter", staticmethod(analyze_letter))
+    monkeypatch.setattr(letter_service_module.asyncio, "sleep", stop)
+    with pytest.raises(asyncio.CancelledError):
+        asyncio.run(letter_service_module.retry_deferred_analysis(session_factory))
+
+    assert calls == {new_letter.id: False, taken.id: True}
@@ -0,0 +1,149 @@
+"""
+Single-flight анализа: объединение в процессе и захват письма между репликами
+"""
+import asyncio
+import time
+
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.services.single_flight import SingleFlight  # noqa: E402
+
+
+class ClaimStore:
+    """letters.analysis_claimed_until / analysis_claimed_by в памяти, общие для реплик"""
+
+    def __init__(self):
+        self.claims = {}  # key -> (token, expires_at)
+
+    def claim(self, key, token, ttl):
+        holder = self.claims.get(key)
+        if holder is None or holder[0] == token or holder[1] < time.monotonic():
+            self.claims[key] = (token, time.monotonic() + ttl)
+            return True
+        return False
+
+    def release(self, key, token):
+        if self.claims.get(key, (None,))[0] == token:
+            del self.claims[key]
+
+
+def replica(store, claim_ttl=1.0):
+    flight = SingleFlight(pg_enabled=True, claim_ttl=claim_ttl, poll_interval=0.02)
+    flight._pg_claim = lambda key, token: store.claim(key, token, flight.claim_ttl)
+    flight._pg_release = store.release
+    return flight
+
+
+def test_concurrent_calls_in_process_are_coalesced():
+    flight = SingleFlight(pg_enabled=False)
+    calls = []
+
+    async def analyze():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "done"
+
+    async def main():
+        return await asyncio.gather(flight.run(1, analyze), flight.run(1, analyze))
+
+    results = asyncio.run(main())
+    assert sorted(results, key=lambda r: not r[0]) == [(True, "done"), (False, None)]
+    assert len(calls) == 1
+    assert flight.stats["leaders"] == 1
+    assert flight.stats["coalesced_local"] == 1
+
+
+def test_expired_claim_of_crashed_replica_is_taken_over():
+    store = ClaimStore()
+    store.claims[1] = ("crashed", time.monotonic() - 1)
+    flight = replica(store)
+
+    async def analyze():
+        return "done"
+
+    assert asyncio.run(flight.run(1, analyze)) == (True, "done")
+    assert flight.stats["coalesced_remote"] == 0
+    assert 1 not in store.claims
+
+
+def test_active_claim_of_other_replica_is_waited_for():
+    store = ClaimStore()
+    store.claims[1] = ("other", time.monotonic() + 60)
+    flight = replica(store)
+    calls = []
+
+    async def analyze():
+        calls.append(1)
+
+    async def other_replica_finishes():
+        await asyncio.sleep(0.1)
+        store.release(1, "other")
+
+    async def main():
+        finisher = asyncio.create_task(other_replica_finishes())
+        result = await flight.run(1, analyze)
+        await finisher
+        return result
+
+    assert asyncio.run(main()) == (False, None)
+    assert calls == []
+    assert flight.stats["coalesced_remote"] == 1
+
+
+def test_keep_alive_holds_claim_longer_than_ttl():
+    store = ClaimStore()
+    leader = replica(store, claim_ttl=0.15)
+    follower = replica(store, claim_ttl=0.15)
+    order = []
+
+    async def slow_analysis():
+        await asyncio.sleep(0.5)
+        order.append("leader")
+
+    async def quick_analysis():
+        order.append("follower")
+
+    async def main():
+        first = asyncio.create_task(leader.run(1, slow_analysis))
+        await asyncio.sleep(0.3)  # дольше claim_ttl: без продления захват бы истек
+        second = await follower.run(1, quick_analysis)
+        return await first, second
+
+    first, second = asyncio.run(main())
+    assert first == (True, None)
+    assert second == (False, None)
+    assert order == ["leader"]
+
+
+def test_claim_errors_fall_back_to_in_process_coalescing():
+    flight = SingleFlight(pg_enabled=True, poll_interval=0.01)
+
+    def broken_claim(key, token):
+        raise ConnectionError("Postgres недоступен")
+
+    flight._pg_claim = broken_claim
+
+    async def analyze():
+        return "done"
+
+    assert asyncio.run(flight.run(1, analyze)) == (True, "done")
+    assert flight.stats["pg_errors"] == 1
+
+
+def test_release_failure_does_not_fail_analysis():
+    store = ClaimStore()
+    flight = replica(store)
+
+    def broken_release(key, token):
+        raise ConnectionError("Postgres недоступен")
+
+    flight._pg_release = broken_release
+
+    async def analyze():
+        return "done"
+
+    assert asyncio.run(flight.run(1, analyze)) == (True, "done")
+    # Захват останется до истечения claim_ttl
+    assert 1 in store.claims
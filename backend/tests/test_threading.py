@@ -0,0 +1,152 @@
+"""
+Переписка: привязка по In-Reply-To/References и согласование анализа ответа с первым письмом
+"""
+import pytest
+
+pytest.importorskip("sqlalchemy")
+
+from app.config import settings  # noqa: E402
+from app.models import Letter, LetterStatus  # noqa: E402
+from app.services.letter_service import LetterService  # noqa: E402
+
+ROOT_ROUTE = [{"department": "legal", "order": 1}]
+
+
+def add_letter(db, message_id=None, thread_id=None, in_reply_to=None, **fields):
+    letter = Letter(
+        subject=fields.pop("subject", "Письмо"), body="Текст", status=LetterStatus.NEW,
+        message_id=message_id, thread_id=thread_id, in_reply_to=in_reply_to, **fields
+    )
+    db.add(letter)
+    db.commit()
+    return letter
+
+
+def analysis(letter_type: str, confidence: float, sla_hours: int = 48):
+    return {
+        "classification": {"type": letter_type, "confidence": confidence},
+        "formality_level": "neutral",
+        "sla_hours": sla_hours,
+        "sla_reasoning": "Оценка модели",
+        "required_departments": ["support"],
+        "approval_route": [{"department": "support", "order": 1}],
+    }
+
+
+# --- Привязка к переписке ---
+
+def test_message_ids_are_parsed_from_headers():
+    header = "<a@example.com>\r\n <b@example.com> junk <c@example.com>"
+    assert LetterService.message_ids(header) == ["<a@example.com>", "<b@example.com>", "<c@example.com>"]
+    assert LetterService.message_ids(None) == []
+
+
+def test_reply_joins_thread_of_replied_letter(db):
+    root = add_letter(db, "<root@example.com>")
+    add_letter(db, "<reply@example.com>", thread_id=root.id)
+
+    # Ответ на ответ относится к первому письму переписки
+    assert LetterService.find_thread(db, "<reply@example.com>", []) == root.id
+    assert LetterService.find_thread(db, "<root@example.com>", []) == root.id
+
+
+def test_references_are_used_from_last_when_in_reply_to_is_unknown(db):
+    first = add_letter(db, "<first@example.com>")
+    second = add_letter(db, "<second@example.com>")
+
+    thread = LetterService.find_thread(
+        db, "<missing@example.com>", ["<first@example.com>", "<second@example.com>", "<other@example.com>"]
+    )
+
+    assert thread == second.id
+    assert LetterService.find_thread(db, None, ["<first@example.com>"]) == first.id
+    assert LetterService.find_thread(db, None, []) is None
+
+
+def test_replies_received_before_root_are_adopted(db):
+    reply = add_letter(db, "<reply@example.com>", in_reply_to="<root@example.com>")
+    nested = add_letter(db, "<nested@example.com>", thread_id=reply.id, in_reply_to="<reply@example.com>")
+    root = add_letter(db, "<root@example.com>")
+
+    LetterService.adopt_replies(db, root.id, "<root@example.com>", None)
+    db.commit()
+    db.expire_all()
+
+    assert db.get(Letter, reply.id).thread_id == root.id
+    assert db.get(Letter, nested.id).thread_id == root.id
+    assert db.get(Letter, root.id).thread_id is None
+
+
+# --- Согласование анализа с перепиской ---
+
+@pytest.fixture
+def thread(db):
+    root = add_letter(
+        db, "<root@example.com>", subject="Претензия",
+        classification_data={"type": "complaint", "confidence": 0.95},
+        required_departments=["legal"], approval_route=ROOT_ROUTE,
+        formality_level="corporate", sla_hours=8
+    )
+    reply = add_letter(db, "<reply@example.com>", thread_id=root.id, subject="Re: Претензия")
+    return root, reply
+
+
+def test_reply_inherits_root_classification_when_model_is_unsure(db, thread):
+    root, reply = thread
+
+    aligned = LetterService.align_with_thread(db, reply, analysis("request", settings.thread_reclassify_confidence - 0.1))
+
+    assert aligned["classification"]["type"] == "complaint"
+    assert aligned["required_departments"] == ["legal"]
+    assert aligned["approval_route"] == ROOT_ROUTE
+    assert aligned["formality_level"] == "corporate"
+
+
+def test_reply_typed_other_inherits_root_even_when_confident(db, thread):
+    _, reply = thread
+
+    aligned = LetterService.align_with_thread(db, reply, analysis("other", 0.99))
+
+    assert aligned["classification"]["type"] == "complaint"
+
+
+def test_confident_reclassification_is_kept(db, thread):
+    _, reply = thread
+
+    aligned = LetterService.align_with_thread(db, reply, analysis("request", settings.thread_reclassify_confidence))
+
+    assert aligned["classification"]["type"] == "request"
+    assert aligned["required_departments"] == ["support"]
+
+
+def test_reply_sla_is_capped_by_previous_letter(db, thread):
+    root, reply = thread
+
+    aligned = LetterService.align_with_thread(db, reply, analysis("complaint", 0.9, sla_hours=48))
+    assert aligned["sla_hours"] == root.sla_hours
+    assert f"#{root.id}" in aligned["sla_reasoning"]
+
+    shorter = LetterService.align_with_thread(db, reply, analysis("complaint", 0.9, sla_hours=4))
+    assert shorter["sla_hours"] == 4
+
+
+def test_root_is_used_even_outside_summary_window(db, thread, monkeypatch):
+    root, _ = thread
+    monkeypatch.setattr(settings, "thread_summary_letters", 1)
+    middle = add_letter(
+        db, "<middle@example.com>", thread_id=root.id,
+        classification_data={"type": "request", "confidence": 0.9}, sla_hours=24
+    )
+    latest = add_letter(db, "<latest@example.com>", thread_id=root.id)
+
+    aligned = LetterService.align_with_thread(db, latest, analysis("request", 0.5))
+
+    assert aligned["classification"]["type"] == "complaint"
+    # SLA ограничивается предыдущим письмом, а не первым
+    assert aligned["sla_hours"] == middle.sla_hours
+
+
+def test_letter_outside_thread_is_unchanged(db):
+    letter = add_letter(db, "<single@example.com>")
+    result = analysis("request", 0.3)
+    assert LetterService.align_with_thread(db, letter, result) == result
@@ -65,6 +65,12 @@ export const KanbanBoard: React.FC<KanbanBoardProps> = ({
     };
 
     const getLettersByStatus = (status: LetterStatus) => {
+        // Письма, для которых еще готовятся черновики, показываем во входящих
+        if (status === LetterStatus.NEW) {
+            return letters.filter(letter =>
+                letter.status === LetterStatus.NEW || letter.status === LetterStatus.ANALYZING
+            );
+        }
         return letters.filter(letter => letter.status === status);
     };
 
@@ -161,6 +167,11 @@ export const KanbanBoard: React.FC<KanbanBoardProps> = ({
                                                         SLA {letter.sla_hours}ч
                                                     </span>
                                                 )}
+                                                {letter.status === LetterStatus.ANALYZING && (
+                                                    <span className="badge">
+                                                        Черновики готовятся
+                                                    </span>
+                                                )}
                                             </div>
 
                                             {letter.sender_name && (